@@ -6,6 +6,7 @@ Import classes exposed as the API to consumer modules.
 
 __copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
 __license__ = '3-clause BSD'
+__version__ = '0.1.7'
 
 from .entity import IdHolder
 from .payment import Payment
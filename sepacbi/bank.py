@@ -8,12 +8,33 @@ Bank class.
 __copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
 __license__ = '3-clause BSD'
 
-from .util import AttributeCarrier
+from .util import AttributeCarrier, check
 from lxml import etree
 import re
 
 ABI_RE = re.compile(r'\d{5}')
 
+# ISO 9362: institution code, country code, location code, optional branch
+BIC_RE = re.compile(r'^[A-Z]{4}[A-Z]{2}[A-Z0-9]{2}([A-Z0-9]{3})?$')
+
+
+class InvalidBICError(Exception):
+    """
+    Raised when a BIC code does not have the ISO 9362 format.
+    """
+
+
+class UnknownBankCodeError(Exception):
+    """
+    Raised when an ABI or CAB code is not found in the bank directory.
+    """
+
+
+def validate_bic(bic):
+    "Check that a BIC code has the ISO 9362 format."
+    if BIC_RE.match(bic) is None:
+        raise InvalidBICError('Invalid BIC: %r' % bic)
+
 
 class Bank(AttributeCarrier):
     """
@@ -25,11 +46,10 @@ class Bank(AttributeCarrier):
     def perform_checks(self):
         'Checks that the BIC or the ABI are present, and that they are valid.'
         if hasattr(self, 'bic'):
-            code_length = len(self.bic)
-            # TODO: more formal checks (ISO 9362)
-            assert code_length in (8, 11)
+            validate_bic(self.bic)
         if hasattr(self, 'abi'):
-            assert ABI_RE.match(self.abi) is not None
+            check(ABI_RE.match(self.abi) is not None,
+                  'Invalid ABI code: %r' % self.abi)
 
     def emit_tag(self, output_abi=False):
         "Returns a XML tree for the bank, optionally providing the ABI code."
@@ -0,0 +1,281 @@
+#!/usr/bin/python
+
+"""
+Batch generation of many independent payment files from a manifest.
+
+A manifest is a dictionary (or the name of a JSON file containing one) such
+as::
+
+    {
+        "parties": {
+            "acme": {"name": "ACME S.p.A.", "cf": "01234567890",
+                     "cuc": "S0215325Z"}
+        },
+        "jobs": [
+            {
+                "name": "acme-january",
+                "output": "acme-january.xml",
+                "format": "xml",
+                "payment": {"debtor": "acme",
+                            "account": "IT37Z0760101600000028426203",
+                            "execution_date": "2014-01-31"},
+                "transactions": [
+                    {"amount": "100.00", "rmtinfo": "Invoice 1",
+                     "account": "IT86U0760111500000010117463",
+                     "creditor": {"name": "Beta s.n.c."}}
+                ]
+            }
+        ]
+    }
+
+Parties can be referenced by name wherever an `IdHolder` is expected.
+
+Jobs run in a process pool. The caches shared by all jobs (the IBAN
+registry, the transliteration tables, the parties) are warmed up before the
+pool is created, so that forked workers inherit them; the party definitions
+reach the workers once, through the pool initializer, rather than with each
+job. Each job reports its own timing and outcome; a failing job does not
+stop the batch.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import json
+import os
+import sys
+import time
+import traceback
+from datetime import datetime
+
+from six import unichr
+
+from .cache import canonical
+from .entity import IdHolder
+from .payment import Payment
+
+if sys.version_info[0] >= 3:
+    # pylint: disable=redefined-builtin
+    # pylint: disable=invalid-name
+    basestring = str
+
+# Attributes holding an IdHolder, by the object they belong to
+PAYMENT_PARTIES = ('debtor', 'initiator', 'ultimate_debtor')
+TRANSACTION_PARTIES = ('creditor', 'ultimate_debtor', 'ultimate_creditor')
+
+# Checked parties, by their canonical definition, built once per process
+_PARTIES = {}
+
+# Party definitions of the manifest being run, by name
+_DEFINITIONS = {}
+
+
+class ManifestError(Exception):
+    """
+    Raised when a manifest or one of its jobs is malformed.
+    """
+
+
+def warm_caches(parties=None):
+    """
+    Record the party definitions of the manifest being run, build and
+    check the shared parties and fill the caches used while generating
+    payments. Called in the parent before forking, and again as
+    the pool initializer where processes are not forked. Parties that
+    cannot be built are skipped here.
+    """
+    from unidecode import unidecode
+    from .iban import get_registry
+    get_registry().compile_all()
+    # Loads the transliteration tables of the most common Latin blocks
+    unidecode(u''.join(unichr(code) for code in range(0xa0, 0x250)))
+
+    _DEFINITIONS.clear()
+    _DEFINITIONS.update(parties or {})
+    for definition in _DEFINITIONS.values():
+        try:
+            shared_party(definition)
+        except Exception:  # pylint: disable=broad-except
+            # A malformed party only fails the jobs that use it, when they
+            # resolve it again.
+            pass
+
+
+def shared_party(definition):
+    """
+    Return the checked IdHolder for a party definition, building it the
+    first time. Parties are cached by their whole definition, so a name
+    defined differently by another manifest gets its own IdHolder.
+    """
+    key = json.dumps(canonical(definition))
+    party = _PARTIES.get(key)
+    if party is None:
+        party = IdHolder(**definition)
+        party.ensure_checked()
+        _PARTIES[key] = party
+    return party
+
+
+def resolve_party(value, parties):
+    "Turn a party name or dictionary into an IdHolder."
+    if isinstance(value, IdHolder):
+        return value
+    if isinstance(value, basestring):
+        if value in parties:
+            return shared_party(parties[value])
+        raise ManifestError('Unknown party %r' % value)
+    if isinstance(value, dict):
+        return IdHolder(**value)
+    raise ManifestError('Invalid party definition: %r' % (value,))
+
+
+def build_payment(job, parties=None):
+    """
+    Build the Payment described by a job of the manifest. Party names are
+    looked up in `parties`, by default those of the manifest being run.
+    """
+    if parties is None:
+        parties = _DEFINITIONS
+    kwargs = dict(job.get('payment', {}))
+    for attribute in PAYMENT_PARTIES:
+        if attribute in kwargs:
+            kwargs[attribute] = resolve_party(kwargs[attribute], parties)
+    if isinstance(kwargs.get('execution_date'), basestring):
+        kwargs['execution_date'] = datetime.strptime(
+            kwargs['execution_date'], '%Y-%m-%d').date()
+    payment = Payment(**kwargs)
+    for item in job.get('transactions', ()):
+        item = dict(item)
+        for attribute in TRANSACTION_PARTIES:
+            if attribute in item:
+                item[attribute] = resolve_party(item[attribute], parties)
+        payment.add_transaction(**item)
+    return payment
+
+
+class JobResult(object):
+    """
+    The outcome of a single job: its name and output file, the number of
+    transactions, the elapsed time and, for failed jobs, the error.
+    """
+    def __init__(self, name, output=None, transactions=0, size=0,
+                 seconds=0.0, error=None, details=None, data=None):
+        self.name = name
+        self.output = output
+        self.transactions = transactions
+        self.size = size
+        self.seconds = seconds
+        self.error = error
+        self.details = details
+        self.data = data
+
+    @property
+    def ok(self):
+        "Whether the job succeeded."
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return '<JobResult %s: %d transactions in %.3f s>' % (
+                self.name, self.transactions, self.seconds)
+        return '<JobResult %s: failed (%s)>' % (self.name, self.error)
+
+
+class BatchReport(object):
+    """
+    The results of all the jobs of a batch, in manifest order.
+    """
+    def __init__(self, results, seconds):
+        self.results = results
+        self.seconds = seconds
+
+    @property
+    def succeeded(self):
+        "The results of the successful jobs."
+        return [result for result in self.results if result.ok]
+
+    @property
+    def failed(self):
+        "The results of the failed jobs."
+        return [result for result in self.results if not result.ok]
+
+    def summary(self):
+        "Return a human-readable summary of the batch."
+        job_seconds = sum(result.seconds for result in self.results)
+        lines = ['%d jobs, %d failed; %.3f s wall time, %.3f s job time' % (
+            len(self.results), len(self.failed), self.seconds, job_seconds)]
+        for result in self.failed:
+            lines.append('  %s: %s' % (result.name, result.error))
+        return '\n'.join(lines)
+
+
+def run_job(args):
+    """
+    Generate the output of a single job and return its JobResult. Errors are
+    captured in the result rather than raised.
+    """
+    index, job, output_dir = args
+    name = job.get('name', 'job-%d' % (index + 1))
+    output = job.get('output')
+    if output is not None and output_dir is not None:
+        output = os.path.join(output_dir, output)
+    start = time.time()
+    try:
+        payment = build_payment(job)
+        if job.get('format', 'xml') == 'cbi':
+            data = payment.cbi_text().encode('latin-1')
+        else:
+            data = payment.xml_text(encoding='UTF-8', xml_declaration=True)
+        if output is not None:
+            with open(output, 'wb') as out:
+                out.write(data)
+        return JobResult(
+            name, output, len(payment.transactions), len(data),
+            time.time() - start, data=None if output is not None else data)
+    except Exception as exc:  # pylint: disable=broad-except
+        return JobResult(name, output, seconds=time.time() - start,
+                         error='%s: %s' % (exc.__class__.__name__, exc),
+                         details=traceback.format_exc())
+
+
+def load_manifest(manifest):
+    "Return the manifest dictionary, reading it from a file if needed."
+    if isinstance(manifest, basestring):
+        with open(manifest) as source:
+            manifest = json.load(source)
+    if not isinstance(manifest, dict) or 'jobs' not in manifest:
+        raise ManifestError('The manifest must have a "jobs" list')
+    return manifest
+
+
+def run_batch(manifest, jobs=None, output_dir=None):
+    """
+    Run all the jobs of a manifest and return a BatchReport.
+
+    `jobs` is the number of worker processes (default: one per CPU); with
+    `jobs=1` everything runs in the current process. Output file names are
+    relative to `output_dir`, if given. Jobs without an `output` keep the
+    generated bytes in the `data` attribute of their result.
+    """
+    manifest = load_manifest(manifest)
+    parties = manifest.get('parties', {})
+    tasks = [(index, job, output_dir)
+             for index, job in enumerate(manifest['jobs'])]
+    if jobs is None:
+        from multiprocessing import cpu_count
+        jobs = cpu_count()
+
+    start = time.time()
+    warm_caches(parties)
+    if jobs <= 1 or len(tasks) <= 1:
+        results = [run_job(task) for task in tasks]
+    else:
+        from multiprocessing import Pool
+        pool = Pool(min(jobs, len(tasks)), warm_caches, (parties,))
+        try:
+            results = pool.map(run_job, tasks, chunksize=1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    return BatchReport(results, time.time() - start)
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+"""
+Content-addressed caching of generated payment files.
+
+A payment with a pinned `req_id` and `creation_time` always produces the
+same output, so the output can be stored under a hash of the payment's
+inputs and served again without rebuilding it. Any object with `get(key)`
+and `put(key, data)` methods can be used as a cache; `OutputCache` stores
+the files in a local directory, evicting the least recently used ones when
+a size limit is exceeded.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import hashlib
+import json
+import os
+import tempfile
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from six import integer_types, string_types
+
+from .storage import EeidIndex, TransactionStore
+from .util import AttributeCarrier
+
+# Attributes that point back to the containing objects
+BACK_REFERENCES = ('payment', 'register_eeid_function')
+
+# Attributes that only affect where the transactions are kept
+STORAGE_ATTRIBUTES = ('storage', 'memory_budget')
+
+# Part of every key; changed whenever the same inputs may give a different
+# output, together with the versions of the package and of lxml
+CACHE_FORMAT = 1
+
+
+def canonical(value):
+    """
+    Convert a value to a structure of lists, strings and numbers that only
+    depends on its content, for hashing.
+    """
+    if value is None or isinstance(value, (bool, string_types) +
+                                   integer_types):
+        return value
+    if isinstance(value, (Decimal, float)):
+        return [value.__class__.__name__, repr(value)]
+    if isinstance(value, (date, datetime, time)):
+        return [value.__class__.__name__, value.isoformat()]
+    if isinstance(value, (list, tuple, TransactionStore)):
+        return [canonical(item) for item in value]
+    if isinstance(value, (set, frozenset, EeidIndex)):
+        return sorted(canonical(item) for item in value)
+    if isinstance(value, dict):
+        return [[canonical(key), canonical(value[key])]
+                for key in sorted(value)]
+    if isinstance(value, AttributeCarrier):
+        items = [[name, canonical(item)]
+                 for name, item in sorted(value.__dict__.items())
+                 if not name.startswith('_') and
+                 name not in BACK_REFERENCES + STORAGE_ATTRIBUTES]
+        return [value.__class__.__name__, items]
+    # Other helpers that affect the output (e.g. normalizers, directories)
+    # describe their configuration with cache_key(); the rest (e.g. indexes
+    # and collectors) only matter by their type.
+    if hasattr(value, 'cache_key'):
+        return [value.__class__.__name__, canonical(value.cache_key())]
+    return [value.__class__.__name__]
+
+
+def format_salt():
+    "Return the versions that are part of every content hash."
+    from lxml import etree
+    from . import __version__
+    return [CACHE_FORMAT, __version__, list(etree.LXML_VERSION)]
+
+
+def content_hash(value):
+    """
+    Return the SHA-256 hex digest of the canonical form of a value, salted
+    with the cache format and the versions of the code producing the output.
+    """
+    text = json.dumps([format_salt(), canonical(value)],
+                      separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class OutputCache(object):
+    """
+    A directory of cached output files, named after their keys. When the
+    total size exceeds `max_bytes`, the least recently used files are
+    removed.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.size = sum([size for _, _, size in self.entries()])
+
+    def path(self, key):
+        "Return the file name for a key."
+        return os.path.join(self.directory, key)
+
+    def entries(self):
+        "Return the (access time, path, size) triples of the cached files."
+        result = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            result.append((stat.st_mtime, path, stat.st_size))
+        return result
+
+    def get(self, key):
+        "Return the cached bytes for a key, or None."
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as cached:
+                data = cached.read()
+        except (IOError, OSError):
+            return None
+        # The modification time records the last use, for the eviction.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        "Store the bytes for a key, then evict old files if needed."
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(handle, 'wb') as tmp:
+            tmp.write(data)
+        path = self.path(key)
+        if os.path.exists(path):
+            self.size -= os.path.getsize(path)
+        os.rename(tmp_path, path)
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        "Remove the least recently used files until the cache fits."
+        entries = sorted(self.entries())
+        self.size = sum([size for _, _, size in entries])
+        for _, path, size in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
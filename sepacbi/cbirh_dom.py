@@ -0,0 +1,97 @@
+
+from .cbibon_dom import CBIRecord
+
+# Records of the CBI RH statement flow (rendicontazione movimenti)
+
+
+class RHRecord(CBIRecord):
+    @classmethod
+    def define_fields(cls):
+        f = cls.builders()
+        f.an(1, 'filler', 1)
+        f.an(2, 'record_type', 2, default=u'RH')
+        f.an(4, 'sender', 5)
+        f.nu(9, 'recipient', 5)
+        f.dt(14, 'creation', 6)
+        f.an(20, 'name', 20)
+        f.an(40, 'available', 6)
+        f.an(46, 'filler2', 75)
+
+# Record 61: opening balance
+
+
+class OpeningBalance(CBIRecord):
+    @classmethod
+    def define_fields(cls):
+        f = cls.builders()
+        f.an(1, 'filler', 1)
+        f.an(2, 'record_type', 2, default=u'61')
+        f.nu(4, 'prog_number', 7)
+        f.an(11, 'filler2', 13)
+        f.nu(24, 'sender_abi', 5)
+        f.an(29, 'reason', 5)
+        f.an(34, 'description', 16)
+        f.an(50, 'account_type', 2)
+        f.an(52, 'cin', 1)
+        f.nu(53, 'abi', 5)
+        f.nu(58, 'cab', 5)
+        f.an(63, 'account', 12)
+        f.an(75, 'filler3', 2)
+        f.dt(77, 'accounting_date', 6)
+        f.an(83, 'sign', 1)
+        f.cur(84, 'balance', 15)
+        f.an(99, 'currency', 3)
+        f.an(102, 'filler4', 19)
+
+# Record 62: movement
+
+
+class Movement(CBIRecord):
+    @classmethod
+    def define_fields(cls):
+        f = cls.builders()
+        f.an(1, 'filler', 1)
+        f.an(2, 'record_type', 2, default=u'62')
+        f.nu(4, 'prog_number', 7)
+        f.nu(11, 'movement_number', 3)
+        f.dt(14, 'value_date', 6)
+        f.dt(20, 'accounting_date', 6)
+        f.an(26, 'sign', 1)
+        f.cur(27, 'amount', 15)
+        f.an(42, 'abi_reason', 2)
+        f.an(44, 'internal_reason', 2)
+        f.an(46, 'cheque_number', 16)
+        f.an(62, 'bank_reference', 16)
+        f.an(78, 'customer_reference_type', 9)
+        f.an(87, 'description', 34)
+
+# Record 63: additional information on a movement
+
+
+class MovementInfo(CBIRecord):
+    @classmethod
+    def define_fields(cls):
+        f = cls.builders()
+        f.an(1, 'filler', 1)
+        f.an(2, 'record_type', 2, default=u'63')
+        f.nu(4, 'prog_number', 7)
+        f.nu(11, 'movement_number', 3)
+        f.an(14, 'description', 107)
+
+# Record 64: closing balance
+
+
+class ClosingBalance(CBIRecord):
+    @classmethod
+    def define_fields(cls):
+        f = cls.builders()
+        f.an(1, 'filler', 1)
+        f.an(2, 'record_type', 2, default=u'64')
+        f.nu(4, 'prog_number', 7)
+        f.an(11, 'currency', 3)
+        f.dt(14, 'accounting_date', 6)
+        f.an(20, 'sign', 1)
+        f.cur(21, 'balance', 15)
+        f.an(36, 'available_sign', 1)
+        f.cur(37, 'available', 15)
+        f.an(52, 'filler2', 69)
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+"""
+This module renders CBI text records directly into bytes, either into a
+preallocated buffer or into a memory-mapped output file.
+
+Every record has a fixed width, so the size of the output is known before
+anything is written and each record is encoded in place, without building
+the whole text as a string first.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import mmap
+from itertools import islice
+
+from six import string_types
+
+# Number of records encoded at once by `write_records_stream()`
+STREAM_CHUNK_RECORDS = 512
+
+
+def output_size(count, record_length=120, line_terminator=b'\n'):
+    "Return the size in bytes of a file of `count` records."
+    return count * (record_length + len(line_terminator))
+
+
+def write_line_into(buffer, line, offset, encoding='ascii'):
+    """
+    Encode a formatted record into a writable buffer at the given offset.
+    Return the offset just past the record.
+    """
+    raw = line.encode(encoding)
+    if len(raw) != len(line):
+        raise Exception('Record %r does not fit a single-byte encoding'
+                        % line)
+    end = offset + len(raw)
+    buffer[offset:end] = raw
+    return end
+
+
+def render_into(buffer, records, offset=0, encoding='ascii',
+                line_terminator=b'\n'):
+    """
+    Write the records (record objects, or lines formatted by
+    `format_many()`), each followed by the line terminator, into a writable
+    buffer starting at `offset`. Return the offset past the last record.
+    """
+    term_length = len(line_terminator)
+    for record in records:
+        if isinstance(record, string_types):
+            offset = write_line_into(buffer, record, offset, encoding)
+        else:
+            offset = record.write_into(buffer, offset, encoding)
+        buffer[offset:offset + term_length] = line_terminator
+        offset += term_length
+    return offset
+
+
+def render_records(records, count, record_length=120, encoding='ascii',
+                   line_terminator=b'\n'):
+    """
+    Render `count` records into a new bytearray allocated once with the
+    final size.
+    """
+    buffer = bytearray(output_size(count, record_length, line_terminator))
+    end = render_into(buffer, records, 0, encoding, line_terminator)
+    if end != len(buffer):
+        raise Exception('Expected %d bytes of records, got %d'
+                        % (len(buffer), end))
+    return buffer
+
+
+def write_records_file(path, records, count, record_length=120,
+                       encoding='ascii', line_terminator=b'\n'):
+    """
+    Write `count` records to a file through a memory map of its final size.
+    Return the size of the file.
+    """
+    size = output_size(count, record_length, line_terminator)
+    with open(path, 'w+b') as out:
+        out.truncate(size)
+        if size == 0:
+            return 0
+        mapped = mmap.mmap(out.fileno(), size)
+        try:
+            end = render_into(mapped, records, 0, encoding, line_terminator)
+            mapped.flush()
+        finally:
+            mapped.close()
+    if end != size:
+        raise Exception('Expected %d bytes of records, got %d' % (size, end))
+    return size
+
+
+def write_records_stream(fileobj, records, record_length=120,
+                         encoding='ascii', line_terminator=b'\n',
+                         chunk_records=STREAM_CHUNK_RECORDS):
+    """
+    Write records to a binary file object (e.g. a compressed stream), a
+    chunk at a time, through a single reusable buffer. Return the number of
+    bytes written.
+    """
+    buffer = bytearray(output_size(chunk_records, record_length,
+                                   line_terminator))
+    records = iter(records)
+    total = 0
+    while True:
+        end = render_into(buffer, islice(records, chunk_records), 0,
+                          encoding, line_terminator)
+        if end == 0:
+            return total
+        fileobj.write(buffer if end == len(buffer) else buffer[:end])
+        total += end
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+"""
+Normalization of free text to the character set accepted in SEPA messages:
+the basic Latin letters and digits, the space and / - ? : ( ) . , ' +
+
+The conversions are computed once into a translation table, so that texts
+are converted by `unicode.translate` rather than character by character.
+Characters that are not in the table (e.g. from non-Latin scripts) are
+looked up on first use and then added to it.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import hashlib
+import json
+import re
+import string
+
+from six import unichr
+from unidecode import unidecode
+
+SEPA_CHARACTERS = string.ascii_letters + string.digits + u"/-?:().,'+ "
+
+DISALLOWED_RE = re.compile(u"[^A-Za-z0-9/\\-?:().,'+ ]")
+
+# Code points converted in advance: Latin-1 and Latin Extended-A and -B
+TABLE_RANGE = range(0x80, 0x250)
+
+# Conversions that differ from the plain transliteration
+SPECIAL_CASES = {
+    u'&': u'+',
+    u'_': u'-',
+    u'"': u"'",
+    u'\u2018': u"'",
+    u'\u2019': u"'",
+    u'\u201c': u"'",
+    u'\u201d': u"'",
+    u'\u2013': u'-',
+    u'\u2014': u'-',
+    u'\u20ac': u'EUR',
+    u'\xb0': u'.',
+    u'\t': u' ',
+    u'\n': u' ',
+    u'\r': u'',
+}
+
+
+class SEPANormalizer(object):
+    """
+    Converts texts to the SEPA character set. Characters without a
+    transliteration are replaced by `replacement`.
+
+    The normalizer keeps count of what it replaced: `replacements` maps
+    (character, replacement) pairs and `fields` maps the field names passed
+    to `normalize()` to the number of texts that were changed.
+    """
+
+    def __init__(self, replacement=u'.'):
+        self.replacement = replacement
+        self.table = {}
+        self.replacements = {}
+        self.fields = {}
+        for code in list(range(0x20, 0x80)) + list(TABLE_RANGE):
+            self.add(unichr(code))
+        for char in SPECIAL_CASES:
+            self.add(char)
+        # Identifies the conversions, which depend on unidecode's version
+        self.table_digest = hashlib.sha256(json.dumps(
+            sorted(self.table.items())).encode('utf-8')).hexdigest()
+
+    def cache_key(self):
+        "Return the configuration that affects the output, for caching."
+        return [self.replacement, self.table_digest]
+
+    def convert(self, char):
+        "Return the conversion of a single character."
+        if char in SPECIAL_CASES:
+            return SPECIAL_CASES[char]
+        converted = DISALLOWED_RE.sub(u'', unidecode(char))
+        if not converted.strip():
+            return self.replacement
+        return converted
+
+    def add(self, char):
+        "Add a character to the translation table, unless it is allowed."
+        if char not in SEPA_CHARACTERS:
+            self.table[ord(char)] = self.convert(char)
+
+    def normalize(self, text, field=None, max_length=None):
+        """
+        Return the text converted to the SEPA character set, and truncated
+        to `max_length` characters if needed.
+        """
+        if text is None:
+            return None
+        text = u'%s' % text
+        found = DISALLOWED_RE.findall(text)
+        if found:
+            for char in set(found):
+                if ord(char) not in self.table:
+                    self.table[ord(char)] = self.convert(char)
+                key = (char, self.table[ord(char)])
+                self.replacements[key] = self.replacements.get(key, 0) + \
+                    found.count(char)
+            if field is not None:
+                self.fields[field] = self.fields.get(field, 0) + 1
+            text = text.translate(self.table)
+        if max_length is not None:
+            text = text[:max_length]
+        return text
+
+    def report(self):
+        "Return a human-readable summary of the replacements."
+        total = sum(self.replacements.values())
+        lines = ['%d characters replaced in %d texts' % (
+            total, sum(self.fields.values()))]
+        for (char, converted), count in sorted(
+                self.replacements.items(),
+                key=lambda item: (-item[1], item[0])):
+            lines.append('  %r -> %r: %d' % (char, converted, count))
+        return '\n'.join(lines)
+
+
+def normalized(normalizer, text, field=None, max_length=None):
+    "Return the text through a normalizer, or unchanged without one."
+    if not normalizer:
+        return text
+    return normalizer.normalize(text, field, max_length)
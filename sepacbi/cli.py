@@ -0,0 +1,469 @@
+#!/usr/bin/python
+
+"""
+Command-line converter from CSV or JSON Lines transaction lists to CBI XML
+requests or CBI BON text files.
+
+The input is read as a stream. With `--max-transactions` or `--max-bytes`,
+it is cut into chunks that become separate output files, so that memory
+usage is bounded by the chunk size rather than by the size of the input.
+Otherwise the transactions are kept in a disk-backed store and streamed into
+a single output file.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from datetime import datetime
+
+from six import string_types
+
+from .columns import TRANSACTION_FIELDS, CREDITOR_FIELDS, ALL_FIELDS, \
+    TRUE_VALUES
+from .entity import IdHolder
+from .payment import Payment
+from .pipeline import write_cbi_pipelined, write_xml_pipelined
+
+
+class RowError(Exception):
+    """
+    Raised when an input row cannot be turned into a transaction.
+    """
+
+
+def parse_mapping(items):
+    """
+    Convert a list of FIELD=COLUMN strings into a {field: column} dictionary.
+    Fields that are not mapped are read from the column with the same name.
+    """
+    mapping = dict((field, field) for field in ALL_FIELDS)
+    for item in items or ():
+        field, sep, column = item.partition('=')
+        if not sep or field not in mapping:
+            raise argparse.ArgumentTypeError(
+                'Invalid mapping %r; fields are: %s' % (
+                    item, ', '.join(ALL_FIELDS)))
+        mapping[field] = column
+    return mapping
+
+
+def read_rows(source, input_format, delimiter=','):
+    "Yield the input rows as dictionaries, one at a time."
+    if input_format == 'jsonl':
+        for line in source:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    else:
+        for row in csv.DictReader(source, delimiter=delimiter):
+            yield row
+
+
+def row_size(row):
+    "Return the size in bytes of the values of an input row, UTF-8 encoded."
+    return sum(len(u'%s' % value) if isinstance(value, (int, float))
+               else len(value.encode('utf-8'))
+               for value in row.values() if isinstance(
+                   value, string_types + (int, float)))
+
+
+def iter_chunks(rows, size, max_bytes=0):
+    """
+    Group the rows into lists of at most `size` items and `max_bytes` bytes
+    of input values (no limit for zero), numbering each row starting from 1.
+    A row larger than `max_bytes` gets a chunk of its own.
+    """
+    chunk = []
+    chunk_bytes = 0
+    for number, row in enumerate(rows, 1):
+        if max_bytes:
+            length = row_size(row)
+            if chunk and chunk_bytes + length > max_bytes:
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk_bytes += length
+        chunk.append((number, row))
+        if size and len(chunk) >= size:
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+    if chunk:
+        yield chunk
+
+
+def row_to_transaction(row, mapping, decimal_comma=False):
+    "Return the keyword arguments for `add_transaction()` for an input row."
+    kwargs = {}
+    for field in TRANSACTION_FIELDS:
+        value = row.get(mapping[field])
+        if value not in (None, ''):
+            kwargs[field] = value
+    if decimal_comma and isinstance(kwargs.get('amount'), string_types):
+        kwargs['amount'] = kwargs['amount'].replace('.', '').replace(',', '.')
+
+    creditor = {}
+    for field, attribute in CREDITOR_FIELDS.items():
+        value = row.get(mapping[field])
+        if value not in (None, ''):
+            creditor[attribute] = value
+    if 'private' in creditor and not isinstance(creditor['private'], bool):
+        creditor['private'] = \
+            str(creditor['private']).strip().lower() in TRUE_VALUES
+    kwargs['creditor'] = IdHolder(**creditor)
+    return kwargs
+
+
+def new_payment(config, seq, **kwargs):
+    "Return the empty Payment for the output file number `seq`."
+    kwargs.update(config['payment'])
+    kwargs['debtor'] = IdHolder(**config['debtor'])
+    if config['split']:
+        kwargs['req_id'] = '%s-%04d' % (config['req_id'], seq)
+    else:
+        kwargs['req_id'] = config['req_id']
+    return Payment(**kwargs)
+
+
+def add_rows(config, payment, rows):
+    "Add the transactions of numbered rows to a payment."
+    for number, row in rows:
+        try:
+            payment.add_transaction(**row_to_transaction(
+                row, config['mapping'], config['decimal_comma']))
+            # The IBAN is otherwise only validated during serialization,
+            # where the row number is no longer known.
+            payment.transactions[-1].account.ensure_checked()
+        except Exception as exc:
+            raise RowError('Row %d: %s: %s' % (
+                number, exc.__class__.__name__, exc))
+
+
+def build_payment(config, chunk, seq):
+    "Build the Payment for a chunk of numbered rows."
+    payment = new_payment(config, seq)
+    add_rows(config, payment, chunk)
+    return payment
+
+
+def render_chunk(config, chunk, seq):
+    """
+    Build and serialize the payment for a chunk. Return the output bytes and
+    the number of transactions. This runs in the worker processes.
+    """
+    payment = build_payment(config, chunk, seq)
+    try:
+        if config['format'] == 'cbi':
+            data = payment.cbi_text().encode('latin-1')
+        else:
+            data = payment.xml_text(encoding='UTF-8', xml_declaration=True)
+    except Exception as exc:
+        raise RowError('Rows %d-%d: %s: %s' % (
+            chunk[0][0], chunk[-1][0], exc.__class__.__name__, exc))
+    return data, len(payment.transactions)
+
+
+def output_path(base, seq, split):
+    "Return the output file name for a chunk."
+    if not split:
+        return base
+    root, ext = os.path.splitext(base)
+    return '%s-%04d%s' % (root, seq, ext)
+
+
+def peak_memory():
+    "Return the peak resident set size in bytes, or None if unknown."
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+class Stats(object):
+    "Counters for the `--stats` report."
+
+    def __init__(self):
+        self.start = time.time()
+        self.transactions = 0
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, size, transactions):
+        "Account for an output file."
+        self.transactions += transactions
+        self.files += 1
+        self.bytes += size
+
+    def report(self, stream):
+        "Write the report."
+        elapsed = max(time.time() - self.start, 1e-9)
+        stream.write('transactions: %d\n' % self.transactions)
+        stream.write('files: %d\n' % self.files)
+        stream.write('bytes: %d\n' % self.bytes)
+        stream.write('elapsed: %.3f s\n' % elapsed)
+        stream.write('throughput: %.1f transactions/s, %.1f KiB/s\n' % (
+            self.transactions / elapsed, self.bytes / elapsed / 1024))
+        peak = peak_memory()
+        if peak is not None:
+            stream.write('peak memory: %.1f MiB\n' % (peak / 1048576.0))
+
+
+def render_all(config, chunks, jobs):
+    """
+    Yield (seq, data, transactions) for each chunk, in order. With more than
+    one job, chunks are rendered in a process pool; at most two chunks per
+    job are in flight, so the input is not read ahead without bounds.
+    """
+    if jobs <= 1:
+        for seq, chunk in enumerate(chunks, 1):
+            data, count = render_chunk(config, chunk, seq)
+            yield seq, data, count
+        return
+
+    from multiprocessing import Pool
+    pool = Pool(jobs)
+    try:
+        pending = deque()
+        for seq, chunk in enumerate(chunks, 1):
+            pending.append((seq, pool.apply_async(
+                render_chunk, (config, chunk, seq))))
+            if len(pending) >= 2 * jobs:
+                seq, result = pending.popleft()
+                data, count = result.get()
+                yield seq, data, count
+        while pending:
+            seq, result = pending.popleft()
+            data, count = result.get()
+            yield seq, data, count
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class CountingWriter(object):
+    "A binary file object wrapper that counts the bytes written."
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+
+    def write(self, data):
+        "Write and count a block of data."
+        self.fileobj.write(data)
+        self.size += len(data)
+
+
+def write_single(config, rows, fileobj, jobs):
+    """
+    Stream all the numbered rows into a single output file, keeping the
+    transactions in a temporary disk-backed store. With more than one job,
+    the output is built, serialized and written on separate threads. Return
+    the number of bytes written and the number of transactions, or None if
+    there are no rows.
+    """
+    payment = new_payment(config, 1, storage=True)
+    try:
+        add_rows(config, payment, rows)
+        if len(payment.transactions) == 0:
+            return None
+        out = CountingWriter(fileobj)
+        try:
+            if config['format'] == 'cbi':
+                if jobs > 1:
+                    write_cbi_pipelined(payment, out, encoding='latin-1')
+                else:
+                    payment.write_cbi(out, encoding='latin-1')
+            elif jobs > 1:
+                write_xml_pipelined(payment, out, encoding='UTF-8',
+                                    xml_declaration=True)
+            else:
+                payment.write_xml(out, encoding='UTF-8',
+                                  xml_declaration=True)
+        except Exception as exc:
+            raise RowError('Rows 1-%d: %s: %s' % (
+                len(payment.transactions), exc.__class__.__name__, exc))
+        return out.size, len(payment.transactions)
+    finally:
+        payment.transactions.close()
+
+
+def write_output(config, rows, output, jobs):
+    """
+    Write all the numbered rows to the output file (standard output for
+    '-') with `write_single()`. An output file is removed if nothing or
+    only part of it could be written.
+    """
+    if output == '-':
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        result = write_single(config, rows, stdout, jobs)
+        stdout.flush()
+        return result
+    result = None
+    try:
+        with open(output, 'wb') as out:
+            result = write_single(config, rows, out, jobs)
+    finally:
+        if result is None and os.path.exists(output):
+            os.remove(output)
+    return result
+
+
+def get_parser():
+    "Return the command-line parser."
+    parser = argparse.ArgumentParser(
+        prog='sepacbi',
+        description='Convert a CSV or JSON Lines list of transactions to a '
+        'CBI XML payment request or a CBI BON text file.')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='input file (default: standard input)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file (default: standard output)')
+    parser.add_argument('-f', '--format', choices=('xml', 'cbi'),
+                        default='xml', help='output format')
+    parser.add_argument('--input-format', choices=('csv', 'jsonl'),
+                        help='input format (default: from the file name, '
+                        'else csv)')
+    parser.add_argument('--delimiter', default=',',
+                        help='CSV field delimiter')
+    parser.add_argument('--encoding', default='utf-8',
+                        help='input encoding')
+    parser.add_argument('--decimal-comma', action='store_true',
+                        help='amounts are written as 1.234,56')
+    parser.add_argument('-m', '--map', action='append', metavar='FIELD=COL',
+                        help='read a transaction field from a differently '
+                        'named column; fields: ' + ', '.join(ALL_FIELDS))
+
+    debtor = parser.add_argument_group('debtor')
+    debtor.add_argument('--account', required=True, help='debtor IBAN')
+    debtor.add_argument('--debtor-name', required=True)
+    debtor.add_argument('--debtor-cf', help='debtor tax code')
+    debtor.add_argument('--debtor-cuc', help='debtor CUC')
+    debtor.add_argument('--sia-code', help='debtor SIA code (CBI text only)')
+    debtor.add_argument('--abi', help='debtor bank ABI code')
+
+    payment = parser.add_argument_group('payment')
+    payment.add_argument('--req-id', help='request ID (default: generated)')
+    payment.add_argument('--execution-date', metavar='YYYY-MM-DD')
+    payment.add_argument('--high-priority', action='store_true')
+
+    run = parser.add_argument_group('execution')
+    run.add_argument('--max-transactions', type=int, default=0, metavar='N',
+                     help='split the output into files of at most N '
+                     'transactions, numbered after the output name')
+    run.add_argument('--max-bytes', type=int, default=0, metavar='N',
+                     help='split the output into files built from at most '
+                     'N bytes of input values each, numbered after the '
+                     'output name')
+    run.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                     help='number of worker processes; for a single output '
+                     'file, more than one runs the building, serialization '
+                     'and writing on separate threads')
+    run.add_argument('--stats', action='store_true',
+                     help='report throughput and memory on standard error')
+    return parser
+
+
+def make_config(args):
+    "Collect the settings needed by the workers into a picklable dict."
+    debtor = {'name': args.debtor_name}
+    for attribute in ('cf', 'cuc'):
+        value = getattr(args, 'debtor_' + attribute)
+        if value:
+            debtor[attribute] = value
+    if args.sia_code:
+        debtor['sia_code'] = args.sia_code
+
+    payment = {'account': args.account}
+    if args.abi:
+        payment['abi'] = args.abi
+    if args.execution_date:
+        payment['execution_date'] = datetime.strptime(
+            args.execution_date, '%Y-%m-%d').date()
+    if args.high_priority:
+        payment['high_priority'] = True
+
+    req_id = args.req_id
+    if req_id is None:
+        req_id = Payment.ID_PREFIX + datetime.now().strftime('%Y%m%d-%H%M%S')
+
+    return {
+        'debtor': debtor,
+        'payment': payment,
+        'req_id': req_id,
+        'split': args.max_transactions > 0 or args.max_bytes > 0,
+        'mapping': parse_mapping(args.map),
+        'decimal_comma': args.decimal_comma,
+        'format': args.format,
+    }
+
+
+def main(argv=None):
+    "Entry point of the `sepacbi` command."
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    try:
+        config = make_config(args)
+    except (argparse.ArgumentTypeError, ValueError) as exc:
+        parser.error(str(exc))
+    if config['split'] and args.output == '-':
+        parser.error('--max-transactions and --max-bytes need an '
+                     '--output file name')
+
+    input_format = args.input_format
+    if input_format is None:
+        input_format = 'jsonl' if args.input.endswith(
+            ('.jsonl', '.ndjson')) else 'csv'
+
+    if args.input == '-':
+        stdin = getattr(sys.stdin, 'buffer', None)
+        if stdin is None:
+            # Python 2: sys.stdin is a byte stream without a buffer.
+            stdin = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+        source = io.TextIOWrapper(stdin, encoding=args.encoding, newline='')
+    else:
+        source = io.open(args.input, encoding=args.encoding, newline='')
+
+    stats = Stats()
+    try:
+        rows = read_rows(source, input_format, args.delimiter)
+        if config['split']:
+            chunks = iter_chunks(rows, args.max_transactions, args.max_bytes)
+            for seq, data, count in render_all(config, chunks, args.jobs):
+                path = output_path(args.output, seq, config['split'])
+                with open(path, 'wb') as out:
+                    out.write(data)
+                stats.add(len(data), count)
+        else:
+            result = write_output(config, enumerate(rows, 1), args.output,
+                                  args.jobs)
+            if result is not None:
+                stats.add(*result)
+    except (RowError, ValueError) as exc:
+        sys.stderr.write('sepacbi: %s\n' % exc)
+        return 1
+    finally:
+        source.close()
+
+    if stats.files == 0:
+        sys.stderr.write('sepacbi: no transactions in the input\n')
+        return 1
+    if args.stats:
+        stats.report(sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
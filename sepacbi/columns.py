@@ -0,0 +1,349 @@
+#!/usr/bin/python
+
+"""
+Column-wise ingestion of transactions from pandas DataFrames, NumPy
+structured arrays or dictionaries of lists.
+
+The columns are normalized and validated as a whole before any transaction
+is added: IBANs are cleaned and checked once per distinct value, amounts are
+quantized once per distinct value, and every problem of every row is
+reported at once. Accounts and creditors that appear in many rows are
+shared by the transactions instead of being built again for each row.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+from decimal import Decimal, InvalidOperation
+
+from six import string_types
+
+from .account import Account
+from .entity import IdHolder
+from .validation import ValidationIssue, ValidationReport, \
+    tax_code_issues
+
+# Transaction fields that can be read from the input, with the keyword
+# argument of `Payment.add_transaction()` they are passed to. Creditor
+# fields are used to build the `IdHolder` of the creditor.
+TRANSACTION_FIELDS = ('amount', 'account', 'bic', 'rmtinfo', 'eeid',
+                      'tx_id', 'category', 'purpose', 'cbi_purpose')
+CREDITOR_FIELDS = {
+    'creditor_name': 'name',
+    'creditor_cf': 'cf',
+    'creditor_code': 'code',
+    'creditor_country': 'country',
+    'creditor_private': 'private',
+}
+ALL_FIELDS = TRANSACTION_FIELDS + tuple(sorted(CREDITOR_FIELDS))
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 's', 'si')
+
+CENT = Decimal('.01')
+
+
+class ColumnError(Exception):
+    """
+    Raised when the input columns are missing or have different lengths.
+    """
+
+
+class InvalidRowsError(ValueError):
+    """
+    Raised when some rows of the input are not valid. The `report`
+    attribute is a `ValidationReport` listing all of them.
+    """
+    def __init__(self, report):
+        super(InvalidRowsError, self).__init__(report.summary())
+        self.report = report
+
+
+def is_missing(value):
+    "Tell whether a cell is empty (None, an empty string or NaN)."
+    # pylint: disable=comparison-with-itself
+    return value is None or value == '' or value != value
+
+
+def column_values(data, name):
+    "Return a column of a DataFrame, structured array or dict as a list."
+    column = data[name]
+    if hasattr(column, 'tolist'):
+        column = column.tolist()
+    values = list(column)
+    return [value.decode('utf-8') if isinstance(value, bytes) else value
+            for value in values]
+
+
+def column_names(data):
+    "Return the names of the columns of the input."
+    dtype = getattr(data, 'dtype', None)
+    if dtype is not None and dtype.names is not None:
+        return list(dtype.names)
+    if hasattr(data, 'columns'):
+        return list(data.columns)
+    return list(data.keys())
+
+
+def read_columns(data, columns=None):
+    """
+    Return a {field: list of values} dictionary for the fields present in
+    the input. `columns` maps field names to differently named columns.
+    """
+    mapping = dict((field, field) for field in ALL_FIELDS)
+    for field, column in (columns or {}).items():
+        if field not in mapping:
+            raise ColumnError('Unknown field %r; fields are: %s' % (
+                field, ', '.join(ALL_FIELDS)))
+        mapping[field] = column
+    available = set(column_names(data))
+    result = {}
+    for field, column in mapping.items():
+        if column in available:
+            result[field] = column_values(data, column)
+    for field in ('amount', 'account'):
+        if field not in result:
+            raise ColumnError('Missing column %r' % mapping[field])
+    lengths = set(len(values) for values in result.values())
+    if len(lengths) > 1:
+        raise ColumnError('The columns have different lengths')
+    return result
+
+
+def distinct_map(values, function):
+    """
+    Apply a function to each distinct value of a column. Return a {value:
+    (result, error)} dictionary, where `error` is the exception raised, if
+    any.
+    """
+    results = {}
+    for value in set(values):
+        try:
+            results[value] = (function(value), None)
+        except Exception as exc:  # pylint: disable=broad-except
+            results[value] = (None, exc)
+    return results
+
+
+def quantize_amount(value):
+    "Convert an amount to a Decimal with two decimal places."
+    if isinstance(value, Decimal):
+        amount = value
+    else:
+        amount = Decimal(str(value))
+    if not amount.is_finite():
+        raise InvalidOperation('%s is not a valid amount' % value)
+    return amount.quantize(CENT)
+
+
+def checked_account(iban):
+    "Return a validated Account for an IBAN."
+    account = Account(iban=iban)
+    account.ensure_checked()
+    return account
+
+
+def normalize_columns(table, payment=None):
+    """
+    Validate and normalize the columns in place. Return the list of
+    ValidationIssues; rows are numbered from 1.
+    """
+    issues = []
+    count = len(table['amount'])
+
+    def report(row, target, error, message):
+        issues.append(ValidationIssue(row + 1, target, error, message))
+
+    amounts = table['amount']
+    quantized = distinct_map([value for value in amounts
+                              if not is_missing(value)], quantize_amount)
+    for row, value in enumerate(amounts):
+        if is_missing(value):
+            report(row, 'transaction', 'ValidationError', 'Missing amount')
+            continue
+        amounts[row], error = quantized[value]
+        if error is not None:
+            report(row, 'transaction', error.__class__.__name__,
+                   'Invalid amount %r' % (value,))
+
+    ibans = table['account']
+    accounts = distinct_map([value.upper().replace(' ', '')
+                             for value in ibans
+                             if isinstance(value, string_types)],
+                            checked_account)
+    for row, value in enumerate(ibans):
+        if is_missing(value):
+            report(row, 'account', 'ValidationError', 'Missing account')
+            continue
+        if not isinstance(value, string_types):
+            ibans[row] = None
+            report(row, 'account', 'ValidationError',
+                   'Invalid IBAN %r' % (value,))
+            continue
+        ibans[row], error = accounts[value.upper().replace(' ', '')]
+        if error is not None:
+            report(row, 'account', error.__class__.__name__, str(error))
+
+    rmtinfo = table.get('rmtinfo', [None] * count)
+    for row, value in enumerate(rmtinfo):
+        if is_missing(value):
+            report(row, 'transaction', 'ValidationError',
+                   'Either rmtinfo or docs must be supplied')
+        elif len(value) > 140:
+            report(row, 'transaction', 'ValidationError',
+                   'rmtinfo must be at most 140 characters long')
+
+    creditors = distinct_map([creditor_key(table, row)
+                              for row in range(count)], checked_creditor)
+    table['creditor'] = []
+    for row in range(count):
+        creditor, error = creditors[creditor_key(table, row)]
+        table['creditor'].append(creditor)
+        if error is not None:
+            report(row, 'creditor', error.__class__.__name__, str(error))
+
+    if getattr(payment, 'check_tax_codes', False):
+        # Rows are numbered from 1 in the report
+        issues += tax_code_issues(list(range(1, count + 1)),
+                                  table['creditor'], 'creditor')
+
+    seen = set(payment.eeid_set) if payment is not None else set()
+    for row, value in enumerate(table.get('eeid', ())):
+        if is_missing(value):
+            continue
+        if value in seen:
+            report(row, 'transaction', 'InvalidEndToEndIDError',
+                   'Duplicate end-to-end ID: %r' % value)
+        seen.add(value)
+
+    if payment is not None:
+        issues += directory_issues(table, payment, count)
+    return issues
+
+
+def directory_issues(table, payment, count):
+    """
+    Fill in the missing BICs and check the ABI/CAB codes with the payment's
+    directories, in bulk.
+    """
+    accounts = table['account']
+    valid = [row for row, account in enumerate(accounts)
+             if isinstance(account, Account)]
+    bic_directory = getattr(payment, 'bic_directory', None)
+    if bic_directory is not None:
+        bics = table.setdefault('bic', [None] * count)
+        missing = [row for row in valid if accounts[row].is_foreign() and
+                   is_missing(bics[row])]
+        found = bic_directory.bics_for_ibans(
+            [accounts[row].iban for row in missing])
+        for row, bic in zip(missing, found):
+            bics[row] = bic
+
+    issues = []
+    abi_directory = getattr(payment, 'abi_directory', None)
+    if abi_directory is not None:
+        for position, iban in abi_directory.unknown_ibans(
+                [accounts[row].iban for row in valid]):
+            issues.append(ValidationIssue(
+                valid[position] + 1, 'account', 'UnknownBankCodeError',
+                'Unknown ABI/CAB codes in %s' % iban))
+    return issues
+
+
+def creditor_key(table, row):
+    "Return the creditor fields of a row, as a hashable key."
+    key = []
+    for field in sorted(CREDITOR_FIELDS):
+        value = table[field][row] if field in table else None
+        key.append(None if is_missing(value) else value)
+    return tuple(key)
+
+
+def checked_creditor(key):
+    "Build and check the IdHolder for a creditor key."
+    kwargs = {}
+    for field, value in zip(sorted(CREDITOR_FIELDS), key):
+        if value is not None:
+            kwargs[CREDITOR_FIELDS[field]] = value
+    if 'private' in kwargs and not isinstance(kwargs['private'], bool):
+        kwargs['private'] = \
+            str(kwargs['private']).strip().lower() in TRUE_VALUES
+    creditor = IdHolder(**kwargs)
+    creditor.ensure_checked()
+    return creditor
+
+
+def iter_transactions(table):
+    """
+    Yield the keyword arguments for `Payment.add_transaction()` for each
+    row of normalized columns.
+    """
+    fields = [field for field in TRANSACTION_FIELDS if field in table]
+    creditors = table['creditor']
+    for row in range(len(creditors)):
+        kwargs = {'creditor': creditors[row]}
+        for field in fields:
+            value = table[field][row]
+            if not is_missing(value):
+                kwargs[field] = value
+        yield kwargs
+
+
+def build_transactions(payment, table):
+    """
+    Build and check the transactions of normalized columns, and check them
+    for duplicates, without adding them to the payment. Return the list of
+    transactions and the list of ValidationIssues.
+    """
+    issues = []
+    transactions = []
+    start = len(payment.transactions) + 1
+    for row, kwargs in enumerate(iter_transactions(table)):
+        txr = None
+        try:
+            txr = payment.build_transaction(start + row, **kwargs)
+            txr.ensure_checked()
+            transactions.append(txr)
+        except Exception as exc:  # pylint: disable=broad-except
+            issues.append(ValidationIssue(row + 1, 'transaction',
+                                          exc.__class__.__name__, str(exc)))
+            if getattr(txr, 'eeid_registered', False):
+                payment.eeid_set.discard(txr.eeid)
+
+    duplicate_check = payment.get_duplicate_check()
+    if duplicate_check is not None and not issues:
+        trial = duplicate_check.trial(payment, transactions)
+        if duplicate_check.policy == 'raise':
+            for seq, eeid, matches in trial.duplicates:
+                issues.append(ValidationIssue(
+                    seq - start + 1, 'transaction', 'DuplicatePaymentError',
+                    'Probable duplicate of %s' % ', '.join(
+                        '%s/%s' % (match.msg_id, match.eeid)
+                        for match in matches)))
+        if not issues:
+            duplicate_check.accept(trial, transactions)
+
+    if issues:
+        # The end-to-end IDs of the rows that are not added are released.
+        for txr in transactions:
+            payment.eeid_set.discard(txr.eeid)
+    return transactions, issues
+
+
+def add_columns(payment, data, columns=None):
+    """
+    Add a transaction to the payment for each row of the input. Nothing is
+    added if any row is invalid; InvalidRowsError reports all of them.
+    Return the number of added transactions.
+    """
+    table = read_columns(data, columns)
+    count = len(table['amount'])
+    issues = normalize_columns(table, payment)
+    if issues:
+        raise InvalidRowsError(ValidationReport(issues, count))
+    # Every transaction is checked before any is added.
+    transactions, issues = build_transactions(payment, table)
+    if issues:
+        raise InvalidRowsError(ValidationReport(issues, count))
+    for txr in transactions:
+        payment.transactions.append(txr)
+    return len(transactions)
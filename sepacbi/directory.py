@@ -0,0 +1,356 @@
+#!/usr/bin/python
+
+"""
+This module provides compact, memory-mapped lookup tables built from local
+directory files, such as the BIC directory.
+
+The tables are stored as sorted fixed-width records and searched with
+`bisect`, so that opening one costs nothing and lookups never load the
+whole directory into Python objects.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import bisect
+import csv
+import hashlib
+import io
+import mmap
+import os
+import struct
+import tempfile
+
+from .bank import BIC_RE, UnknownBankCodeError
+
+INDEX_MAGIC = b'SCBIDX01'
+INDEX_HEADER = struct.Struct('<8sIII')
+
+
+class IndexFormatError(Exception):
+    "Raised when an index file is damaged or was not built by this module."
+
+
+class KeyView(object):
+    """
+    Sequence of the keys of a `SortedIndex`, as expected by `bisect`.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.count
+
+    def __getitem__(self, position):
+        index = self.index
+        start = index.data_offset + position * index.record_length
+        return index.data[start:start + index.key_length]
+
+
+class SortedIndex(object):
+    """
+    A read-only mapping from fixed-width ASCII keys to fixed-width ASCII
+    values, backed by a memory-mapped file of sorted records.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as index_file:
+            self.data = mmap.mmap(index_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        if len(self.data) < INDEX_HEADER.size:
+            raise IndexFormatError('%s is too short' % path)
+        magic, self.key_length, self.value_length, self.count = \
+            INDEX_HEADER.unpack_from(self.data)
+        if magic != INDEX_MAGIC:
+            raise IndexFormatError('%s is not an index file' % path)
+        self.record_length = self.key_length + self.value_length
+        self.data_offset = INDEX_HEADER.size
+        if len(self.data) != self.data_offset + \
+                self.count * self.record_length:
+            raise IndexFormatError('%s is truncated' % path)
+        self.keys = KeyView(self)
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, key):
+        return self.position(key) is not None
+
+    def close(self):
+        "Release the memory map."
+        self.data.close()
+
+    def cache_key(self):
+        """
+        Return the digest of the contents of the index, for caching. It is
+        computed once, on first use.
+        """
+        digest = getattr(self, 'digest', None)
+        if digest is None:
+            hasher = hashlib.sha256()
+            for start in range(0, len(self.data), 1048576):
+                hasher.update(self.data[start:start + 1048576])
+            digest = self.digest = hasher.hexdigest()
+        return digest
+
+    def encode_key(self, key):
+        "Pad a key to the record width; return None if it cannot fit."
+        if isinstance(key, bytes):
+            raw = key
+        else:
+            try:
+                raw = key.encode('ascii')
+            except UnicodeError:
+                return None
+        if len(raw) > self.key_length:
+            return None
+        return raw.ljust(self.key_length)
+
+    def position(self, key):
+        "Return the record number of a key, or None if it is not present."
+        raw = self.encode_key(key)
+        if raw is None:
+            return None
+        position = bisect.bisect_left(self.keys, raw)
+        if position < self.count and self.keys[position] == raw:
+            return position
+        return None
+
+    def value_at(self, position):
+        "Return the value stored in a record."
+        start = self.data_offset + position * self.record_length + \
+            self.key_length
+        raw = self.data[start:start + self.value_length]
+        return raw.decode('ascii').rstrip()
+
+    def get(self, key, default=None):
+        "Return the value for a key, or `default` if it is not present."
+        position = self.position(key)
+        if position is None:
+            return default
+        return self.value_at(position)
+
+    def has_prefix(self, prefix):
+        "Tell whether any key starts with the given prefix."
+        raw = prefix.encode('ascii') if not isinstance(prefix, bytes) \
+            else prefix
+        position = bisect.bisect_left(self.keys, raw)
+        return position < self.count and \
+            self.keys[position].startswith(raw)
+
+    def positions(self, keys):
+        """
+        Return a {key: record number} dictionary for the keys, among many,
+        that are present. Keys are visited in sorted order, each search starting where
+        the previous one ended, so that consecutive lookups touch
+        neighbouring pages of the map.
+        """
+        result = {}
+        low = 0
+        for raw, key in sorted((self.encode_key(key), key)
+                               for key in set(keys)
+                               if self.encode_key(key) is not None):
+            low = bisect.bisect_left(self.keys, raw, low)
+            if low < self.count and self.keys[low] == raw:
+                result[key] = low
+        return result
+
+    def get_many(self, keys):
+        """
+        Look up many keys at once; the result follows the order of the input
+        and has None for the missing keys.
+        """
+        keys = list(keys)
+        found = self.positions(keys)
+        values = dict((key, self.value_at(position))
+                      for key, position in found.items())
+        return [values.get(key) for key in keys]
+
+    @classmethod
+    def build(cls, path, items, key_length=None, value_length=None):
+        """
+        Write an index file from an iterable of (key, value) pairs. When the
+        same key appears more than once, the first value wins. The file is
+        replaced atomically.
+        """
+        table = {}
+        for key, value in items:
+            key = key.encode('ascii') if not isinstance(key, bytes) else key
+            value = value.encode('ascii') \
+                if not isinstance(value, bytes) else value
+            table.setdefault(key, value)
+        if key_length is None:
+            key_length = max([len(key) for key in table] or [0])
+        if value_length is None:
+            value_length = max([len(value) for value in table.values()]
+                               or [0])
+
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'wb') as out:
+            out.write(INDEX_HEADER.pack(INDEX_MAGIC, key_length,
+                                        value_length, len(table)))
+            for key in sorted(table, key=lambda k: k.ljust(key_length)):
+                value = table[key]
+                if len(key) > key_length or len(value) > value_length:
+                    raise IndexFormatError('Record too long: %r' % key)
+                out.write(key.ljust(key_length))
+                out.write(value.ljust(value_length))
+        os.rename(tmp_path, path)
+        return cls(path)
+
+
+def read_directory_rows(path, columns, encoding='utf-8'):
+    """
+    Yield the selected columns of a CSV directory file as tuples of stripped
+    strings. The file must have a header line naming the columns.
+    """
+    with io.open(path, encoding=encoding, newline='') as source:
+        sample = source.read(4096)
+        source.seek(0)
+        delimiter = ';' if sample.count(';') > sample.count(',') else ','
+        reader = csv.reader(source, delimiter=delimiter)
+        header = [name.strip().lower() for name in next(reader)]
+        try:
+            indexes = [header.index(column) for column in columns]
+        except ValueError:
+            raise IndexFormatError('%s must have the columns %s' % (
+                path, ', '.join(columns)))
+        for row in reader:
+            if len(row) > max(indexes):
+                yield tuple(row[idx].strip() for idx in indexes)
+
+
+class BICDirectory(SortedIndex):
+    """
+    Maps the country and the bank identifier of an IBAN to the BIC of the
+    bank. The source file is a CSV with `country`, `bank_code` and `bic`
+    columns.
+    """
+
+    @classmethod
+    def build_from_csv(cls, source_path, path, encoding='utf-8'):
+        "Build the index file for a CSV directory."
+        def items():
+            for country, bank_code, bic in read_directory_rows(
+                    source_path, ('country', 'bank_code', 'bic'), encoding):
+                bic = bic.upper()
+                if BIC_RE.match(bic) is None:
+                    continue
+                yield country.upper() + bank_code.upper(), bic
+        return cls.build(path, items(), value_length=11)
+
+    @staticmethod
+    def iban_key(iban):
+        "Return the lookup key for an IBAN, or None if it has no bank code."
+        from .iban import get_registry
+        rule = get_registry().get(iban[:2])
+        if rule is None:
+            return None
+        bank_code = rule.bank_code(iban)
+        if not bank_code:
+            return None
+        return iban[:2] + bank_code
+
+    def bic_for_iban(self, iban):
+        "Return the BIC for an IBAN, or None if it is not in the directory."
+        key = self.iban_key(iban)
+        if key is None:
+            return None
+        return self.get(key)
+
+    def bics_for_ibans(self, ibans):
+        "Return the list of the BICs (or None) for a sequence of IBANs."
+        return self.get_many([self.iban_key(iban) or '' for iban in ibans])
+
+
+class ABICABDirectory(SortedIndex):
+    """
+    The directory of the Italian bank (ABI) and branch (CAB) codes. The source
+    file is a CSV with `abi` and `cab` columns, and optionally a `name`
+    column.
+    """
+
+    # Number of IBANs looked up together by `unknown_ibans()`
+    CHUNK_SIZE = 65536
+
+    @classmethod
+    def build_from_csv(cls, source_path, path, encoding='utf-8',
+                       with_names=False):
+        "Build the index file for a CSV directory."
+        columns = ('abi', 'cab')
+        if with_names:
+            columns += ('name',)
+
+        def items():
+            for row in read_directory_rows(source_path, columns, encoding):
+                abi, cab = row[0].zfill(5), row[1].zfill(5)
+                if not (abi + cab).isdigit():
+                    continue
+                name = row[2] if with_names else ''
+                yield abi + cab, name.encode('ascii', 'replace')
+        return cls.build(path, items(), key_length=10,
+                         value_length=None if with_names else 0)
+
+    def has_abi(self, abi):
+        "Tell whether a bank code is in the directory."
+        return self.has_prefix(abi)
+
+    def has_branch(self, abi, cab):
+        "Tell whether a bank and branch code pair is in the directory."
+        return self.position(abi + cab) is not None
+
+    def branch_name(self, abi, cab):
+        "Return the name of a branch, if the directory has names."
+        return self.get(abi + cab)
+
+    def check(self, abi, cab=None):
+        """
+        Raise UnknownBankCodeError if the bank code (or the bank and branch
+        code pair) is not in the directory.
+        """
+        if cab is None:
+            if not self.has_abi(abi):
+                raise UnknownBankCodeError('Unknown ABI code %r' % abi)
+        elif not self.has_branch(abi, cab):
+            raise UnknownBankCodeError(
+                'Unknown ABI/CAB codes %r/%r' % (abi, cab))
+
+    def check_iban(self, iban):
+        "Check the ABI and CAB codes of an Italian or San Marino IBAN."
+        self.check(iban[5:10], iban[10:15])
+
+    def unknown_ibans(self, ibans):
+        """
+        Check the ABI and CAB codes of a stream of IBANs. Yield the
+        (position, IBAN) pairs of those with unknown codes, in input order.
+        IBANs from other countries are skipped.
+
+        The input is consumed in chunks, so arbitrarily long streams can be
+        checked in bounded memory.
+        """
+        chunk = []
+        for position, iban in enumerate(ibans):
+            chunk.append((position, iban))
+            if len(chunk) >= self.CHUNK_SIZE:
+                for item in self._unknown_in_chunk(chunk):
+                    yield item
+                chunk = []
+        for item in self._unknown_in_chunk(chunk):
+            yield item
+
+    def _unknown_in_chunk(self, chunk):
+        "Check a list of (position, IBAN) pairs."
+        keys = [iban[5:15] for _, iban in chunk
+                if iban[:2] in ('IT', 'SM')]
+        found = self.positions(keys)
+        for position, iban in chunk:
+            if iban[:2] in ('IT', 'SM') and iban[5:15] not in found:
+                yield position, iban
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+
+"""
+Detection of probable duplicate transfers across payment files.
+
+The same invoice may be paid twice under different end-to-end IDs when it
+reaches the debtor through two channels. A transaction's fingerprint is a
+hash of the creditor IBAN, the amount and the remittance information
+(normalized free text, or the numbers of the documents), so that such
+transfers share it.
+
+`DuplicateIndex` is an SQLite file of the fingerprints of the issued
+transactions; it is filled automatically when a payment with a
+`duplicate_index` attribute is written (or marked as issued with
+`Payment.mark_issued()`), and checked by
+`Payment.add_transaction()` against the transfers issued in the last
+`days` days.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import hashlib
+import re
+import sqlite3
+from collections import namedtuple
+from datetime import timedelta
+from decimal import Decimal
+from warnings import warn
+
+from .truncation import MODES, caller_stacklevel
+
+# Number of fingerprints looked up in the index with a single query
+QUERY_CHUNK = 500
+
+# Default window of the issued transactions checked, in days
+DEFAULT_DAYS = 90
+
+NON_ALPHANUMERIC_RE = re.compile(r'[^0-9A-Z]+')
+
+DuplicateMatch = namedtuple('DuplicateMatch', (
+    'fingerprint', 'msg_id', 'eeid', 'created'))
+DuplicateMatch.__doc__ = """
+A previously issued (or, with `msg_id` equal to the current request ID,
+previously added) transaction with the same fingerprint.
+"""
+
+
+class DuplicatePaymentError(Exception):
+    """
+    Raised when a transaction is a probable duplicate of an issued one and
+    the payment's duplicate policy is 'raise'.
+    """
+
+
+def normalize_reference(text):
+    "Reduce a remittance text to its upper-case letters and digits."
+    return NON_ALPHANUMERIC_RE.sub('', u'%s' % text.upper())
+
+
+def document_reference(doc):
+    "Return the part of the fingerprint for a Document."
+    number = getattr(doc, 'number', None)
+    if number is None:
+        return normalize_reference(getattr(doc, 'text', u''))
+    return u'%s%s' % (doc.tag, normalize_reference(u'%s' % number))
+
+
+def fingerprint(txr):
+    """
+    Return the fingerprint of a transaction, or of a dictionary of
+    `add_transaction()` arguments.
+    """
+    get = txr.get if isinstance(txr, dict) else \
+        lambda name: getattr(txr, name, None)
+    account = get('account')
+    iban = getattr(account, 'iban', account) or u''
+    amount = Decimal(str(get('amount'))).quantize(Decimal('.01'))
+    if get('docs') is not None:
+        reference = u' '.join(sorted(document_reference(doc)
+                                     for doc in get('docs')))
+    else:
+        reference = normalize_reference(get('rmtinfo') or u'')
+    text = u'|'.join([iban.upper().replace(' ', ''), str(amount), reference])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+class DuplicateIndex(object):
+    """
+    An on-disk index of the fingerprints of the issued transactions. Lookups
+    go through an SQLite index on the fingerprint, so their cost does not
+    grow with the number of transactions in the window. Transfers issued
+    more than `days` days before the payment being checked are ignored.
+    """
+
+    def __init__(self, path, days=DEFAULT_DAYS):
+        self.path = path
+        self.days = days
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                fingerprint TEXT NOT NULL,
+                msg_id TEXT NOT NULL,
+                eeid TEXT NOT NULL,
+                created TEXT NOT NULL,
+                PRIMARY KEY (msg_id, eeid)
+            );
+            CREATE INDEX IF NOT EXISTS fingerprints_fingerprint
+                ON fingerprints (fingerprint, created);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+
+    def close(self):
+        "Close the database."
+        self.connection.close()
+
+    def since(self, when):
+        "Return the oldest creation time in the window ending at `when`."
+        return (when - timedelta(days=self.days)).isoformat()
+
+    def record_payment(self, payment):
+        """
+        Record the fingerprints of all the transactions of a payment.
+        Generating the same request again replaces its previous records.
+        """
+        created = payment.get_creation_time().isoformat()
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM fingerprints WHERE msg_id = ?', (payment.req_id,))
+            self.connection.executemany(
+                'INSERT INTO fingerprints VALUES (?, ?, ?, ?)',
+                ((fingerprint(txr), payment.req_id, txr.eeid, created)
+                 for txr in payment.transactions))
+
+    def find(self, value, when, exclude=None):
+        """
+        Return the DuplicateMatches for a fingerprint among the transactions
+        issued in the window ending at `when`, except those of request
+        `exclude`.
+        """
+        return [DuplicateMatch(*row) for row in self.connection.execute(
+            'SELECT fingerprint, msg_id, eeid, created FROM fingerprints '
+            'WHERE fingerprint = ? AND created >= ? AND msg_id != ? '
+            'ORDER BY created', (value, self.since(when), exclude or ''))]
+
+    def find_many(self, values, when, exclude=None):
+        """
+        Look up a list of fingerprints at once. Return a dictionary from the
+        fingerprints that have matches to their lists of DuplicateMatches.
+        """
+        values = sorted(set(values))
+        found = {}
+        for start in range(0, len(values), QUERY_CHUNK):
+            chunk = values[start:start + QUERY_CHUNK]
+            query = 'SELECT fingerprint, msg_id, eeid, created ' \
+                'FROM fingerprints WHERE fingerprint IN (%s) ' \
+                'AND created >= ? AND msg_id != ? ORDER BY created' % \
+                ', '.join('?' * len(chunk))
+            for row in self.connection.execute(
+                    query, chunk + [self.since(when), exclude or '']):
+                found.setdefault(row[0], []).append(DuplicateMatch(*row))
+        return found
+
+
+class DuplicateCheck(object):
+    """
+    The duplicate detection state of a payment: the fingerprints of its own
+    transactions, and the probable duplicates found so far as
+    (transaction sequence number, end-to-end ID, DuplicateMatches) triples.
+    `policy` is 'warn', 'collect' or 'raise', as for the truncations.
+    """
+
+    def __init__(self, index, policy='warn'):
+        if policy not in MODES:
+            raise ValueError('Invalid duplicate policy: %r' % policy)
+        self.index = index
+        self.policy = policy
+        self.seen = {}
+        self.duplicates = []
+
+    def flag(self, txr, matches):
+        "Apply the policy to a probable duplicate."
+        message = 'Transaction %s (%s) is a probable duplicate of %s' % (
+            txr.payment_seq, txr.eeid, ', '.join(
+                '%s/%s' % (match.msg_id, match.eeid) for match in matches))
+        if self.policy == 'raise':
+            raise DuplicatePaymentError(message)
+        self.duplicates.append((txr.payment_seq, txr.eeid, matches))
+        if self.policy == 'warn':
+            warn(message, stacklevel=caller_stacklevel())
+
+    def matches(self, payment, txr, value):
+        "Return the matches of a fingerprint within the payment."
+        if value not in self.seen:
+            return []
+        msg_id = getattr(payment, 'req_id', '')
+        created = payment.get_creation_time().isoformat()
+        return [DuplicateMatch(value, msg_id, eeid, created)
+                for eeid in self.seen[value]]
+
+    def check(self, payment, txr):
+        """
+        Check a new transaction of a payment against the index and the
+        payment's previous transactions.
+        """
+        value = fingerprint(txr)
+        matches = self.index.find(value, payment.get_creation_time(),
+                                  getattr(payment, 'req_id', None)) + \
+            self.matches(payment, txr, value)
+        if matches:
+            self.flag(txr, matches)
+        self.seen.setdefault(value, []).append(txr.eeid)
+
+    def trial(self, payment, transactions):
+        """
+        Check a list of new transactions of a payment with a single pass
+        over the index, without changing this check. Return a
+        'collect' DuplicateCheck holding the outcome, to be kept with
+        `accept()`.
+        """
+        trial = DuplicateCheck(self.index, 'collect')
+        trial.seen = dict((value, list(eeids))
+                          for value, eeids in self.seen.items())
+        trial.check_many(payment, transactions)
+        return trial
+
+    def accept(self, trial, transactions):
+        """
+        Keep the outcome of a `trial()` of the given transactions, applying
+        the policy to the duplicates it found.
+        """
+        by_seq = dict((txr.payment_seq, txr) for txr in transactions)
+        self.seen = trial.seen
+        for seq, _, matches in trial.duplicates:
+            self.flag(by_seq[seq], matches)
+
+    def check_many(self, payment, transactions):
+        """
+        Check a list of transactions of a payment with a single pass over
+        the index.
+        """
+        values = [fingerprint(txr) for txr in transactions]
+        found = self.index.find_many(values, payment.get_creation_time(),
+                                     getattr(payment, 'req_id', None))
+        for txr, value in zip(transactions, values):
+            matches = found.get(value, []) + self.matches(payment, txr, value)
+            if matches:
+                self.flag(txr, matches)
+            self.seen.setdefault(value, []).append(txr.eeid)
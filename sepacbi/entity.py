@@ -7,7 +7,9 @@ Bank accounts.
 __copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
 __license__ = '3-clause BSD'
 
-from .util import AttributeCarrier
+from .util import AttributeCarrier, check
+from .charset import normalized
+from .taxcode import validate_tax_code
 from lxml import etree
 
 
@@ -46,11 +48,12 @@ class Address(AttributeCarrier):
                 raise AddressFormatError('Line must have length '
                                          'between 1 and 70 characters')
 
-    def emit_tag(self):
+    def emit_tag(self, normalizer=None):
         "Emit the postal address with each of its lines."
         root = etree.Element('PstlAdr')
         for line in self.lines:
-            etree.SubElement(root, 'AdrLine').text = line
+            etree.SubElement(root, 'AdrLine').text = normalized(
+                normalizer, line, 'address', 70)
         return root
 
 
@@ -85,21 +88,32 @@ class IdHolder(AttributeCarrier):
         if hasattr(self, 'name'):
             self.max_length('name', 70)
         if hasattr(self, 'cf'):
-            assert not hasattr(self, 'code')
+            check(not hasattr(self, 'code'),
+                  'Cannot have both the cf and code attributes')
             self.max_length('cf', 16)
         if hasattr(self, 'cuc'):
             self.max_length('cuc', 35)
         if hasattr(self, 'address'):
             if isinstance(self.address, (list, tuple)):
                 self.address = Address(*self.address)
-            assert isinstance(self.address, Address)
+            check(isinstance(self.address, Address),
+                  'Address must be an Address instance or a list of lines')
         if hasattr(self, 'country'):
             self.length('country', 2)
 
-    def emit_tag(self, tag=None, as_initiator=False):
+    def check_tax_code(self):
+        """
+        Validate the check character of the Italian tax code, if any.
+        Entities of other countries are not checked.
+        """
+        if hasattr(self, 'cf') and getattr(self, 'country', 'IT') == 'IT':
+            validate_tax_code(u'%s' % self.cf)
+
+    def emit_tag(self, tag=None, as_initiator=False, normalizer=None):
         """
         Emit a subtree for an entity, using the supplied tag for the root
         element. If the identity is the Initiator's, emit the CUC as well.
+        The name and address are converted with the `normalizer`, if any.
         """
         if as_initiator:
             tag = 'InitgPty'
@@ -108,11 +122,11 @@ class IdHolder(AttributeCarrier):
         # Name
         if hasattr(self, 'name'):
             name = etree.SubElement(root, 'Nm')
-            name.text = self.name
+            name.text = normalized(normalizer, self.name, 'name', 70)
 
         # Address
         if hasattr(self, 'address') and not as_initiator:
-            root.append(self.address.__tag__())
+            root.append(self.address.__tag__(normalizer=normalizer))
 
         # ID
         idtag = etree.SubElement(root, 'Id')
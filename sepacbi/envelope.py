@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+"""
+Streaming of many payments into a single enveloped request document.
+
+A `CBIBdyPaymentRequest` document holds one `CBIEnvelPaymentRequest` for
+each payment. `EnvelopeWriter` writes the document to a binary file object
+one payment at a time, so that the payments can be built (e.g. by a
+generator) and released in turn::
+
+    with EnvelopeWriter(fileobj) as writer:
+        for payment in payments:
+            writer.write_payment(payment)
+
+The `envelope` attribute of the payments is not used.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+from lxml import etree
+
+from .payment import NoTransactionsError, request_root
+
+ENVELOPE_TAG = 'CBIEnvelPaymentRequest'
+
+
+class EnvelopeWriter(object):
+    """
+    Writes payments to a binary file object as a single
+    `CBIBdyPaymentRequest` document. `close()` (or the end of the `with`
+    block) finishes the document.
+    """
+
+    def __init__(self, fileobj, encoding=None, xml_declaration=False):
+        self.fileobj = fileobj
+        self.encoding = encoding
+        self.payments = 0
+        self.transactions = 0
+        root = request_root('CBIBdyPaymentRequest')
+        etree.SubElement(root, ENVELOPE_TAG)
+        self.head, _, self.tail = etree.tostring(
+            root, encoding=encoding, xml_declaration=xml_declaration
+        ).partition(('<%s/>' % ENVELOPE_TAG).encode('ascii'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        # Leave the document unfinished if writing failed.
+        if exc_type is None:
+            self.close()
+
+    def write_payment(self, payment):
+        """
+        Write a payment as the next `CBIEnvelPaymentRequest` of the
+        document. The payment can be released afterwards.
+        """
+        envelope = etree.Element(ENVELOPE_TAG)
+        request = etree.SubElement(envelope, 'CBIPaymentRequest')
+        # Each payment is checked before any of its output is written, so
+        # that an invalid one does not leave a truncated document.
+        payment.ensure_checked()
+        if len(payment.transactions) == 0:
+            raise NoTransactionsError
+        if self.payments == 0:
+            self.fileobj.write(self.head)
+        payment.write_xml_tree(self.fileobj, envelope, request,
+                               self.encoding)
+        payment.mark_issued()
+        self.payments += 1
+        self.transactions += len(payment.transactions)
+
+    def close(self):
+        "Finish the document."
+        if self.payments == 0:
+            raise NoTransactionsError('The envelope holds no payments')
+        self.fileobj.write(self.tail)
+
+
+def write_envelope(payments, fileobj, encoding=None, xml_declaration=False):
+    """
+    Write an iterable of payments to a binary file object as a single
+    `CBIBdyPaymentRequest` document. Return the number of payments.
+    """
+    writer = EnvelopeWriter(fileobj, encoding, xml_declaration)
+    for payment in payments:
+        writer.write_payment(payment)
+    writer.close()
+    return writer.payments
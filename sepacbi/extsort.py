@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+"""
+External merge sort and grouping of transaction streams.
+
+Items (the keyword arguments of `Payment.add_transaction()`, or Transaction
+objects) are sorted in runs of bounded size; each sorted run is pickled to a
+temporary file, and the runs are then merged lazily. Memory usage depends
+on the run size, not on the size of the input.
+
+`grouped_payments()` uses the sorted stream to build a Payment for each
+group, e.g. one per execution date and category.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import heapq
+import json
+import tempfile
+from datetime import date, datetime, time
+from decimal import Decimal
+from itertools import chain, groupby
+
+from six import integer_types, string_types
+from six.moves import cPickle as pickle
+
+from .cache import canonical
+from .payment import Payment
+
+# Number of items sorted in memory before they are written to a run
+DEFAULT_RUN_SIZE = 50000
+
+# Largest number of runs merged at once; more runs are merged in passes
+MERGE_FAN_IN = 64
+
+
+def sort_value(value):
+    """
+    Return a value that can be compared with those returned for any other
+    value: None comes first, then numbers, strings and dates; other objects
+    (e.g. parties and accounts) are compared by their content.
+    """
+    if value is None:
+        return (0,)
+    if isinstance(value, (Decimal, float) + integer_types) and \
+            not isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, string_types):
+        return (2, value)
+    if isinstance(value, (date, datetime, time)):
+        return (3, value.isoformat())
+    return (4, json.dumps(canonical(value), separators=(',', ':')))
+
+
+def lookup(item, path):
+    """
+    Return the attribute at a dotted path (e.g. 'creditor.name') of a
+    transaction or of a dictionary of transaction arguments, or None.
+    """
+    for name in path:
+        if item is None:
+            return None
+        if isinstance(item, dict):
+            item = item.get(name)
+        else:
+            item = getattr(item, name, None)
+    return item
+
+
+def key_function(key):
+    """
+    Return a key function for a callable, an attribute name or a sequence of
+    attribute names.
+    """
+    if callable(key):
+        return key
+    if isinstance(key, string_types):
+        key = (key,)
+    paths = [name.split('.') for name in key]
+
+    def extract(item):
+        "Return the sort values of the attributes of an item."
+        return tuple(sort_value(lookup(item, path)) for path in paths)
+    return extract
+
+
+def write_run(entries, directory=None):
+    "Pickle a sorted list of entries to a temporary file."
+    run = tempfile.TemporaryFile(prefix='sepacbi-run-', dir=directory)
+    for entry in entries:
+        pickle.dump(entry, run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def read_run(run):
+    "Yield the entries of a run, closing (and removing) it at the end."
+    try:
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+    finally:
+        run.close()
+
+
+class ExternalSorter(object):
+    """
+    Sorts items by `key` (see `key_function()`), keeping at most `run_size`
+    of them in memory. Items with equal keys keep their order. Add the items
+    with `add()`, then iterate over the sorter once.
+    """
+
+    def __init__(self, key, run_size=DEFAULT_RUN_SIZE, directory=None):
+        self.key = key_function(key)
+        self.run_size = run_size
+        self.directory = directory
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, item):
+        "Add an item, writing a sorted run when the buffer is full."
+        # The sequence number keeps the sort stable and the items uncompared.
+        self.buffer.append((self.key(item), self.count, item))
+        self.count += 1
+        if len(self.buffer) >= self.run_size:
+            self.spill()
+
+    def extend(self, items):
+        "Add all the items of an iterable."
+        for item in items:
+            self.add(item)
+
+    def spill(self):
+        "Sort the buffer and write it to a run."
+        if self.buffer:
+            self.buffer.sort()
+            self.runs.append(write_run(self.buffer, self.directory))
+            self.buffer = []
+
+    def entries(self):
+        "Yield the (key, sequence number, item) entries in order."
+        if not self.runs:
+            self.buffer.sort()
+            entries, self.buffer = self.buffer, []
+            for entry in entries:
+                yield entry
+            return
+        self.spill()
+        runs, self.runs = self.runs, []
+        while len(runs) > MERGE_FAN_IN:
+            merged = write_run(heapq.merge(*[
+                read_run(run) for run in runs[:MERGE_FAN_IN]]),
+                self.directory)
+            runs = runs[MERGE_FAN_IN:] + [merged]
+        for entry in heapq.merge(*[read_run(run) for run in runs]):
+            yield entry
+
+    def __iter__(self):
+        for _, _, item in self.entries():
+            yield item
+
+    def groups(self, size=None):
+        """
+        Yield a (key, items) pair for each group of items whose keys have
+        the same first `size` values (the whole key if None). `items` is an
+        iterator, to be consumed before moving to the next group.
+        """
+        def group_key(entry):
+            "Return the grouping part of an entry's key."
+            return entry[0][:size] if size is not None else entry[0]
+        for key, entries in groupby(self.entries(), group_key):
+            yield key, (item for _, _, item in entries)
+
+
+def external_sort(items, key, run_size=DEFAULT_RUN_SIZE, directory=None):
+    """
+    Yield the items of an iterable sorted by `key`: a callable, an attribute
+    name or a sequence of attribute names (dotted paths, e.g.
+    'creditor.name', are allowed). At most `run_size` items are kept in
+    memory; sorted runs are written to temporary files in `directory`.
+    """
+    sorter = ExternalSorter(key, run_size, directory)
+    sorter.extend(items)
+    return iter(sorter)
+
+
+def grouped_payments(rows, group_by, order_by=(), run_size=DEFAULT_RUN_SIZE,
+                     directory=None, **kwargs):
+    """
+    Build a Payment for each group of rows (dictionaries of
+    `add_transaction()` arguments) with the same values of the `group_by`
+    attribute names, adding the transactions sorted by the `order_by` names.
+    The payments are built with the keyword arguments, one at a time, and
+    yielded as (group values, payment) pairs in the order of the groups.
+
+    Grouping names that are Payment attributes (e.g. 'execution_date') are
+    moved from the rows to the payment. The request IDs are numbered after
+    `req_id`, or after a generated one.
+    """
+    if isinstance(group_by, string_types):
+        group_by = (group_by,)
+    if isinstance(order_by, string_types):
+        order_by = (order_by,)
+    group_by = tuple(group_by)
+    payment_fields = [name for name in group_by
+                      if name in Payment.allowed_args]
+    base_id = kwargs.pop('req_id', None)
+
+    sorter = ExternalSorter(group_by + tuple(order_by), run_size, directory)
+    sorter.extend(rows)
+    seq = 0
+    for _, items in sorter.groups(len(group_by)):
+        seq += 1
+        first = next(items)
+        values = tuple(lookup(first, name.split('.')) for name in group_by)
+        payment_kwargs = dict(kwargs)
+        for name in payment_fields:
+            if first.get(name) is not None:
+                payment_kwargs[name] = first[name]
+        payment = Payment(**payment_kwargs)
+        if base_id is None:
+            payment.gen_id()
+            base_id = payment.req_id
+        payment.req_id = '%s-%04d' % (base_id, seq)
+        for row in chain([first], items):
+            row = dict((name, value) for name, value in row.items()
+                       if name not in payment_fields)
+            payment.add_transaction(**row)
+        yield values, payment
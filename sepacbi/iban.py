@@ -7,11 +7,9 @@ This module deals with IBAN codes and formal validity checks.
 __copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
 __license__ = '3-clause BSD'
 
+import os
 import re
-from .iban_structures import IBAN_STRUCTURES
-
-# Identifies a single element of the IBAN structure
-STR_ITEM_RE = re.compile(r'^(\d+)(!?)([nac])')
+from .iban_registry import IBANRegistry, STR_ITEM_RE, structure_to_pattern
 
 
 class InvalidIBANError(Exception):
@@ -23,49 +21,62 @@ def structure_to_re(structure):
     """
     Convert a SWIFT IBAN structure description to a regex that matches it.
     """
-    # First part of the regex
-    regex = ['^', structure[:2]]
-    # Skip the first two characters
-    idx = 2
-    while idx < len(structure):
-        # Get the next segment
-        pattern = STR_ITEM_RE.search(structure[idx:])
-        idx += len(pattern.group(0))
-
-        # The part length
-        length = int(pattern.group(1))
-
-        # Whether it is fixed or a maximum length
-        fixed = pattern.group(2) != ''
-
-        # 'n' is a digit; 'a' an uppercase character;
-        # 'c' an alphanumeric character
-        item_type = pattern.group(3)
-
-        # compose the next regex segment
-        if item_type == 'n':
-            sub_re = r'\d'
-        elif item_type == 'a':
-            sub_re = r'[A-Z]'
-        elif item_type == 'c':
-            sub_re = r'[\dA-Za-z]'
-        else:
-            raise Exception('Invalid structure: %s' % structure)
+    return re.compile(structure_to_pattern(structure)[0])
+
+
+class CountryRegexMap(object):
+    """
+    Read-only mapping from country codes to the compiled structure regexes
+    of the registry in use. Regexes are compiled on first access.
+    """
+    def __contains__(self, country):
+        return country in get_registry()
+
+    def __getitem__(self, country):
+        return get_registry()[country].regex
+
+    def __iter__(self):
+        return iter(get_registry().countries())
+
+    def __len__(self):
+        return len(get_registry())
+
 
-        if fixed:
-            sub_re += r'{%s}' % length
+# The registry in use; loaded on first use by `get_registry()`.
+_REGISTRY = [None]
+
+# Environment variable naming a registry cache file to use instead of the
+# built-in structures.
+CACHE_ENV_VAR = 'SEPACBI_IBAN_CACHE'
+
+
+def get_registry():
+    """
+    Return the IBAN registry in use. Unless one has been installed, this is
+    the cache named by the SEPACBI_IBAN_CACHE environment variable, or else
+    the built-in structures.
+    """
+    if _REGISTRY[0] is None:
+        cache_path = os.environ.get(CACHE_ENV_VAR)
+        if cache_path:
+            _REGISTRY[0] = IBANRegistry.load_cache(cache_path)
         else:
-            sub_re += r'{,%s}' % length
-        regex.append(sub_re)
-    regex.append('$')
-    regex = ''.join(regex)
-    # Return the finished and compiled regex
-    return re.compile(regex)
+            _REGISTRY[0] = IBANRegistry.builtin()
+    return _REGISTRY[0]
+
+
+def install_registry(registry):
+    """
+    Use the given registry (or the path of a registry cache file) for all
+    subsequent validations. Passing None restores the default.
+    """
+    if registry is not None and not isinstance(registry, IBANRegistry):
+        registry = IBANRegistry.load_cache(registry)
+    _REGISTRY[0] = registry
 
 
-# Fill a dictionary with the compiled regular expressions
-COUNTRY_RE = dict([(x[:2], structure_to_re(x))
-                   for x in IBAN_STRUCTURES])
+# Kept for compatibility with code looking up the regexes directly
+COUNTRY_RE = CountryRegexMap()
 
 
 def validate_check_digits(iban):
@@ -83,11 +94,12 @@ def validate(iban):
 
     # Do we know the country?
     country = iban[:2]
-    if country not in COUNTRY_RE:
+    rule = get_registry().get(country)
+    if rule is None:
         raise InvalidIBANError('Invalid country code')
 
     # Is the formal structure valid?
-    if not COUNTRY_RE[country].match(iban):
+    if not rule.match(iban):
         raise InvalidIBANError('Invalid IBAN structure for country %s'
                                % country)
 
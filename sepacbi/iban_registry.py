@@ -0,0 +1,394 @@
+#!/usr/bin/python
+
+"""
+This module loads the per-country IBAN rules from a local copy of the SWIFT
+IBAN registry and keeps them in a precompiled, versioned cache file.
+
+The rules shipped in `iban_structures` are used when no registry is loaded.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import csv
+import io
+import json
+import os
+import re
+import tempfile
+
+# Version of the cache file layout; bumped whenever it changes.
+CACHE_VERSION = 1
+CACHE_FORMAT = 'sepacbi-iban-registry'
+
+# Identifies a single element of the IBAN structure
+STR_ITEM_RE = re.compile(r'^(\d+)(!?)([nac])')
+
+# Identifies a whole IBAN structure description in free text
+STRUCTURE_RE = re.compile(r'\b[A-Z]{2}2!n(?:\d+!?[nac])+')
+
+# A position range inside the BBAN, as written in the registry ("1-5")
+POSITION_RE = re.compile(r'^\s*(\d+)\s*-\s*(\d+)\s*$')
+
+# Bank and branch identifier positions (1-based, inclusive, relative to the
+# BBAN) for the most common countries, used with the built-in structures.
+BANK_ID_POSITIONS = {
+    'AT': ((1, 5), None),
+    'BE': ((1, 3), None),
+    'CH': ((1, 5), None),
+    'DE': ((1, 8), None),
+    'ES': ((1, 4), (5, 8)),
+    'FR': ((1, 5), (6, 10)),
+    'GB': ((1, 4), (5, 10)),
+    'IE': ((1, 4), (5, 10)),
+    'IT': ((2, 6), (7, 11)),
+    'LU': ((1, 3), None),
+    'NL': ((1, 4), None),
+    'PT': ((1, 4), (5, 8)),
+    'SM': ((2, 6), (7, 11)),
+}
+
+# Row labels of the SWIFT registry (TXT and CSV editions), lowercased
+LABEL_COUNTRY = 'iban prefix country code (iso 3166)'
+LABEL_STRUCTURE = 'iban structure'
+LABEL_LENGTH = 'iban length'
+LABEL_BANK_ID = 'bank identifier position within the bban'
+LABEL_BRANCH_ID = 'branch identifier position within the bban'
+
+# Column names accepted in a flat CSV file (one country per row)
+COLUMN_ALIASES = {
+    'country': ('country', 'country_code', LABEL_COUNTRY),
+    'structure': ('iban_structure', 'structure', LABEL_STRUCTURE),
+    'length': ('iban_length', 'length', LABEL_LENGTH),
+    'bank_id': ('bank_id_position', 'bank_id', LABEL_BANK_ID),
+    'branch_id': ('branch_id_position', 'branch_id', LABEL_BRANCH_ID),
+}
+
+
+class RegistryFormatError(Exception):
+    "Raised when a registry file cannot be understood."
+
+
+class RegistryCacheError(Exception):
+    "Raised when a cache file is missing, damaged or of another version."
+
+
+def structure_to_pattern(structure):
+    """
+    Convert a SWIFT IBAN structure description to the source of a regex that
+    matches it. Return a pair with the pattern and the maximum IBAN length.
+    """
+    regex = ['^', structure[:2]]
+    total = 2
+    idx = 2
+    while idx < len(structure):
+        pattern = STR_ITEM_RE.search(structure[idx:])
+        if pattern is None:
+            raise RegistryFormatError('Invalid structure: %s' % structure)
+        idx += len(pattern.group(0))
+        length = int(pattern.group(1))
+        fixed = pattern.group(2) != ''
+        item_type = pattern.group(3)
+
+        # 'n' is a digit; 'a' an uppercase character;
+        # 'c' an alphanumeric character
+        if item_type == 'n':
+            sub_re = r'\d'
+        elif item_type == 'a':
+            sub_re = r'[A-Z]'
+        else:
+            sub_re = r'[\dA-Za-z]'
+
+        if fixed:
+            sub_re += r'{%s}' % length
+        else:
+            sub_re += r'{,%s}' % length
+        regex.append(sub_re)
+        total += length
+    regex.append('$')
+    return ''.join(regex), total
+
+
+def parse_position(text):
+    """
+    Convert a registry position range ("1-5") to a 0-based, half-open pair of
+    offsets into the IBAN. Return None if the range is not available.
+    """
+    if not text:
+        return None
+    if isinstance(text, (list, tuple)):
+        start, end = text
+    else:
+        match = POSITION_RE.match(text)
+        if match is None:
+            return None
+        start, end = int(match.group(1)), int(match.group(2))
+    # The BBAN begins after the country code and the check digits.
+    return (start + 3, end + 4)
+
+
+class IBANRule(object):
+    """
+    The validation rule for a single country: total length, character classes
+    and the offsets of the bank and branch identifiers.
+
+    The regex is compiled on first use, so loading a registry is cheap even
+    in processes that only ever see a handful of countries.
+    """
+    __slots__ = ('country', 'structure', 'pattern', 'length', 'bank_id',
+                 'branch_id', '_regex')
+
+    def __init__(self, country, structure, pattern=None, length=None,
+                 bank_id=None, branch_id=None):
+        self.country = country
+        self.structure = structure
+        if pattern is None:
+            pattern, max_length = structure_to_pattern(structure)
+            if length is None:
+                length = max_length
+        self.pattern = pattern
+        self.length = length
+        self.bank_id = tuple(bank_id) if bank_id else None
+        self.branch_id = tuple(branch_id) if branch_id else None
+        self._regex = None
+
+    @property
+    def regex(self):
+        "The compiled regex for the structure."
+        if self._regex is None:
+            self._regex = re.compile(self.pattern)
+        return self._regex
+
+    def match(self, iban):
+        "Tell whether the IBAN matches the length and the structure."
+        if self.length is not None and len(iban) != self.length:
+            return False
+        return self.regex.match(iban) is not None
+
+    def bank_code(self, iban):
+        "Return the bank identifier within the IBAN, or None if unknown."
+        if self.bank_id is None:
+            return None
+        return iban[self.bank_id[0]:self.bank_id[1]]
+
+    def branch_code(self, iban):
+        "Return the branch identifier within the IBAN, or None if unknown."
+        if self.branch_id is None:
+            return None
+        return iban[self.branch_id[0]:self.branch_id[1]]
+
+    def dump(self):
+        "Return a list suitable for the cache file."
+        return [self.country, self.structure, self.pattern, self.length,
+                self.bank_id, self.branch_id]
+
+
+class IBANRegistry(object):
+    """
+    A collection of IBAN rules indexed by country code.
+    """
+
+    def __init__(self, rules=(), release=None):
+        self.release = release
+        self.rules = dict((rule.country, rule) for rule in rules)
+
+    def __contains__(self, country):
+        return country in self.rules
+
+    def __getitem__(self, country):
+        return self.rules[country]
+
+    def __len__(self):
+        return len(self.rules)
+
+    def get(self, country, default=None):
+        "Return the rule for a country, or `default` if it is unknown."
+        return self.rules.get(country, default)
+
+    def countries(self):
+        "Return the sorted list of the known country codes."
+        return sorted(self.rules)
+
+    def compile_all(self):
+        "Compile all the regexes now, e.g. before forking worker processes."
+        for rule in self.rules.values():
+            rule.regex  # pylint: disable=pointless-statement
+        return self
+
+    @classmethod
+    def from_structures(cls, structures, release=None, positions=None):
+        """
+        Build a registry from a sequence of SWIFT structure descriptions,
+        optionally with a {country: (bank_range, branch_range)} dictionary.
+        """
+        if positions is None:
+            positions = {}
+        rules = []
+        for structure in structures:
+            country = structure[:2]
+            bank_id, branch_id = positions.get(country, (None, None))
+            rules.append(IBANRule(country, structure,
+                                  bank_id=parse_position(bank_id),
+                                  branch_id=parse_position(branch_id)))
+        return cls(rules, release)
+
+    @classmethod
+    def builtin(cls):
+        "Return the registry for the structures shipped with the module."
+        from . import iban_structures
+        return cls.from_structures(
+            iban_structures.IBAN_STRUCTURES,
+            iban_structures.__registry_release__,
+            BANK_ID_POSITIONS)
+
+    def save_cache(self, path):
+        """
+        Write the registry to a cache file. The file is replaced atomically,
+        so that processes reading it never see a partial file.
+        """
+        data = {
+            'format': CACHE_FORMAT,
+            'version': CACHE_VERSION,
+            'release': self.release,
+            'rules': [self.rules[country].dump()
+                      for country in self.countries()],
+        }
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'w') as tmp:
+            json.dump(data, tmp, separators=(',', ':'))
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load_cache(cls, path):
+        "Read a registry from a cache file written by `save_cache()`."
+        try:
+            with open(path) as cache:
+                data = json.load(cache)
+        except (IOError, OSError, ValueError) as exc:
+            raise RegistryCacheError('Cannot read %s: %s' % (path, exc))
+        if not isinstance(data, dict) or \
+                data.get('format') != CACHE_FORMAT:
+            raise RegistryCacheError('%s is not an IBAN registry cache' % path)
+        if data.get('version') != CACHE_VERSION:
+            raise RegistryCacheError(
+                'Cache %s has version %r; expected %r' % (
+                    path, data.get('version'), CACHE_VERSION))
+        rules = [IBANRule(*item) for item in data['rules']]
+        return cls(rules, data.get('release'))
+
+
+def _normalize_label(text):
+    "Lowercase a label and collapse its whitespace."
+    return ' '.join(text.strip().lower().split())
+
+
+def _find_column(header, field):
+    "Return the index of the header column matching a field, or None."
+    for alias in COLUMN_ALIASES[field]:
+        if alias in header:
+            return header.index(alias)
+    return None
+
+
+def _rules_by_row(rows):
+    """
+    Build rules from a registry where each row is a data element and each
+    column is a country, as in the SWIFT TXT and CSV editions.
+    """
+    table = {}
+    for row in rows:
+        if row:
+            label = _normalize_label(row[0])
+            if label not in table:
+                table[label] = [cell.strip() for cell in row[1:]]
+    structures = table[LABEL_STRUCTURE]
+    lengths = table.get(LABEL_LENGTH, [])
+    bank_ids = table.get(LABEL_BANK_ID, [])
+    branch_ids = table.get(LABEL_BRANCH_ID, [])
+    rules = []
+    for col, structure in enumerate(structures):
+        match = STRUCTURE_RE.search(structure.replace(' ', ''))
+        if match is None:
+            continue
+        structure = match.group(0)
+        length = None
+        if col < len(lengths) and lengths[col].isdigit():
+            length = int(lengths[col])
+        rules.append(IBANRule(
+            structure[:2], structure, length=length,
+            bank_id=parse_position(bank_ids[col] if col < len(bank_ids)
+                                   else None),
+            branch_id=parse_position(branch_ids[col]
+                                     if col < len(branch_ids) else None)))
+    return rules
+
+
+def _rules_by_column(header, rows):
+    """
+    Build rules from a flat table with a header line and one country per row.
+    """
+    cols = dict((field, _find_column(header, field))
+                for field in COLUMN_ALIASES)
+    rules = []
+    for row in rows:
+        if len(row) <= cols['structure']:
+            continue
+        structure = row[cols['structure']].replace(' ', '')
+        if not STRUCTURE_RE.match(structure):
+            raise RegistryFormatError('Invalid structure: %r' % structure)
+        values = {}
+        for field in ('length', 'bank_id', 'branch_id'):
+            idx = cols[field]
+            values[field] = row[idx].strip() if idx is not None and \
+                idx < len(row) else ''
+        length = int(values['length']) if values['length'].isdigit() \
+            else None
+        rules.append(IBANRule(
+            structure[:2], structure, length=length,
+            bank_id=parse_position(values['bank_id']),
+            branch_id=parse_position(values['branch_id'])))
+    return rules
+
+
+def parse_registry(text, release=None):
+    """
+    Parse the textual content of a registry file. Three layouts are
+    understood:
+
+     * the SWIFT registry (tab- or comma-separated), with one row per data
+       element and one column per country;
+     * a flat CSV file with a header line and one country per row;
+     * any other text (e.g. the output of `pdftotext`), in which the IBAN
+       structure descriptions are looked for.
+    """
+    sample = text[:4096]
+    delimiter = '\t' if sample.count('\t') > sample.count(',') else ','
+    rows = list(csv.reader(io.StringIO(text), delimiter=delimiter))
+    labels = [_normalize_label(row[0]) for row in rows if row]
+
+    if LABEL_STRUCTURE in labels:
+        rules = _rules_by_row(rows)
+    elif rows and _find_column([_normalize_label(cell) for cell in rows[0]],
+                               'structure') is not None:
+        header = [_normalize_label(cell) for cell in rows[0]]
+        rules = _rules_by_column(header, rows[1:])
+    else:
+        rules = [IBANRule(structure[:2], structure)
+                 for structure in STRUCTURE_RE.findall(text)]
+
+    if len(rules) == 0:
+        raise RegistryFormatError('No IBAN structures found')
+    return IBANRegistry(rules, release)
+
+
+def load_registry(path, release=None, encoding='latin-1'):
+    """
+    Load a local copy of the SWIFT IBAN registry (TXT or CSV).
+    The SWIFT files are not UTF-8, hence the default encoding.
+    """
+    with io.open(path, encoding=encoding, newline='') as registry:
+        text = registry.read()
+    if release is None:
+        release = os.path.basename(path)
+    return parse_registry(text, release)
@@ -0,0 +1,402 @@
+#!/usr/bin/python
+
+"""
+Output sinks that compress or archive payment files while they are being
+serialized, so that no uncompressed copy is ever written.
+
+A `GzipSink` holds a single payment; a `ZipSink` holds any number of them,
+one archive member per payment; a `DirectorySink` writes plain files. All of
+them share the `write_payment()` method::
+
+    with ZipSink('payments.zip') as sink:
+        for payment in payments:
+            sink.write_payment(payment)
+
+A `HashingSink` wraps another sink and computes the digest of each payment
+while it is written, and of the file written to the target, together with a
+small JSON manifest.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import gzip
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import zipfile
+from collections import namedtuple
+from contextlib import contextmanager
+
+from .cbibon_dom import PCRecord
+from .cbiwriter import write_records_stream
+
+# Extensions of the members, by output format
+EXTENSIONS = {'xml': '.xml', 'cbi': '.txt'}
+
+# Suffixes of the manifest and of its signature
+MANIFEST_SUFFIX = '.manifest.json'
+SIGNATURE_SUFFIX = '.sig'
+
+# ZipFile can open members for writing from Python 3.6, and takes a
+# compression level from Python 3.7.
+ZIP_OPEN_WRITE = sys.version_info >= (3, 6)
+ZIP_COMPRESSLEVEL = sys.version_info >= (3, 7)
+
+
+class OutputError(Exception):
+    """
+    Raised when a payment cannot be written to a sink.
+    """
+
+
+def write_payment(payment, fileobj, output_format='xml', **kwargs):
+    """
+    Serialize a payment into a binary file object, in XML or CBI text format.
+    The keyword arguments are passed to `Payment.write_xml()` or
+    `Payment.write_cbi()`. The payment is not marked as issued.
+    """
+    if output_format == 'xml':
+        payment.write_xml(fileobj, mark_issued=False, **kwargs)
+    elif output_format == 'cbi':
+        payment.write_cbi(fileobj, mark_issued=False, **kwargs)
+    else:
+        raise OutputError('Unknown output format %r' % output_format)
+
+
+class HashingWriter(object):
+    """
+    A binary file object wrapper that computes the digest and the size of
+    everything written through it.
+    """
+
+    def __init__(self, fileobj, algorithm='sha256'):
+        self.fileobj = fileobj
+        self.hash = hashlib.new(algorithm)
+        self.size = 0
+
+    def write(self, data):
+        "Write data to the wrapped file object, adding it to the digest."
+        self.hash.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        "Return the digest of the data written so far."
+        return self.hash.hexdigest()
+
+
+class Manifest(namedtuple('Manifest', (
+        'name', 'msg_id', 'transactions', 'control_sum', 'format',
+        'records', 'size', 'algorithm', 'digest', 'file_size',
+        'file_digest'))):
+    """
+    The description of a payment file: its request ID (`MsgId`), number of
+    transactions (`NbOfTxs`) and total amount (`CtrlSum`), the number of
+    records (CBI lines, or XML transactions), the size in bytes and the
+    digest of the serialized payment, and those of the file written to the
+    target (e.g. after gzip compression). `file_size` and `file_digest` are
+    None when the payment is not a file of its own, as in a zip archive.
+    """
+    __slots__ = ()
+
+    def as_json(self):
+        "Return the manifest as UTF-8 encoded JSON."
+        fields = self._asdict()
+        fields['control_sum'] = str(self.control_sum)
+        return json.dumps(fields, indent=2, sort_keys=True).encode('utf-8')
+
+
+def hash_payment(payment, fileobj, output_format='xml', name=None,
+                 algorithm='sha256', **kwargs):
+    """
+    Serialize a payment into a binary file object like `write_payment()`,
+    computing its digest on the way. Return a Manifest, describing the file
+    object as the file.
+    """
+    writer = HashingWriter(fileobj, algorithm)
+    if output_format == 'cbi':
+        rendered = [0]
+
+        def lines():
+            "Yield the CBI records, counting them."
+            for line in payment.iter_cbi_lines():
+                rendered[0] += 1
+                yield line
+        write_records_stream(writer, lines(), PCRecord.length,
+                             kwargs.get('encoding', 'ascii'),
+                             kwargs.get('line_terminator', b'\n'))
+        records = rendered[0]
+    else:
+        write_payment(payment, writer, output_format, **kwargs)
+        records = len(payment.transactions)
+    return Manifest(name, payment.req_id, len(payment.transactions),
+                    payment.amount_sum(), output_format, records,
+                    writer.size, algorithm, writer.hexdigest(), writer.size,
+                    writer.hexdigest())
+
+
+def member_name(payment, output_format='xml'):
+    "Return the default file name for a payment: its ID and an extension."
+    payment.ensure_checked()
+    return payment.req_id + EXTENSIONS.get(output_format, '')
+
+
+class Sink(object):
+    """
+    Base class of the sinks. Subclasses implement `open_member()`, which
+    returns a context manager yielding a writable binary file object.
+    """
+    names = None
+
+    # Whether the output can hold a single member
+    single_member = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open_member(self, name):
+        "Open a new member of the output for writing."
+        raise NotImplementedError
+
+    def close(self):
+        "Finish the output."
+
+    def companion_sink(self):
+        """
+        Return the sink for the files that accompany the members, such as
+        manifests: the sink itself, unless it holds a single member.
+        """
+        return self
+
+    def write_member(self, name, serialize):
+        """
+        Create a new member of the output and call `serialize()` with its
+        file object. Return the member name.
+        """
+        if self.names is None:
+            self.names = []
+        if name in self.names:
+            raise OutputError('Duplicate member name %r' % name)
+        with self.open_member(name) as out:
+            serialize(out)
+        self.names.append(name)
+        return name
+
+    def member_digest(self, name, serialize, algorithm='sha256'):
+        """
+        Create a new member like `write_member()`. Return the size and the
+        digest of the file written to the target for it, or (None, None) if
+        the member is not a file of its own.
+        """
+        writers = []
+
+        def hashed(out):
+            "Serialize the member, hashing the file."
+            writers.append(HashingWriter(out, algorithm))
+            serialize(writers[0])
+        self.write_member(name, hashed)
+        return writers[0].size, writers[0].hexdigest()
+
+    def write_payment(self, payment, name=None, output_format='xml',
+                      **kwargs):
+        """
+        Serialize a payment into a new member of the output, named after the
+        payment's ID unless `name` is given, and mark the payment as issued
+        once the member is complete. Return the member name.
+        """
+        if name is None:
+            name = member_name(payment, output_format)
+        self.write_member(name, lambda out: write_payment(
+            payment, out, output_format, **kwargs))
+        payment.mark_issued()
+        return name
+
+
+class DirectorySink(Sink):
+    "Writes each payment as a plain file in a directory."
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open_member(self, name):
+        return open(os.path.join(self.directory, name), 'wb')
+
+
+class GzipSink(Sink):
+    "Writes a single payment to a gzip-compressed file or file object."
+    single_member = True
+
+    def __init__(self, target, compresslevel=6):
+        self.target = target
+        self.compresslevel = compresslevel
+        self.algorithm = None
+        self.hashing = None
+
+    @contextmanager
+    def open_member(self, name):
+        if self.names:
+            raise OutputError('A gzip file can only hold a single payment')
+        if hasattr(self.target, 'write'):
+            fileobj = None
+            target = self.target
+        else:
+            # The header holds the file name, as gzip.open() would write it.
+            fileobj = target = open(self.target, 'wb')
+            name = self.target
+        if self.algorithm is not None:
+            target = self.hashing = HashingWriter(target, self.algorithm)
+        out = gzip.GzipFile(filename=name, mode='wb',
+                            compresslevel=self.compresslevel, fileobj=target)
+        try:
+            yield out
+        finally:
+            out.close()
+            if fileobj is not None:
+                fileobj.close()
+
+    def companion_sink(self):
+        """
+        Return a DirectorySink for the directory of the gzip file, or None
+        if the target is a file object.
+        """
+        if hasattr(self.target, 'write'):
+            return None
+        return DirectorySink(os.path.dirname(os.path.abspath(self.target)))
+
+    def member_digest(self, name, serialize, algorithm='sha256'):
+        "Create the member, hashing the compressed file."
+        self.algorithm = algorithm
+        try:
+            self.write_member(name, serialize)
+        finally:
+            self.algorithm = None
+        return self.hashing.size, self.hashing.hexdigest()
+
+
+class ZipSink(Sink):
+    "Writes each payment as a deflated member of a zip archive."
+
+    def __init__(self, target, compresslevel=None):
+        kwargs = {}
+        if compresslevel is not None:
+            if not ZIP_COMPRESSLEVEL:
+                raise OutputError('The compression level of a zip archive '
+                                  'can only be set from Python 3.7')
+            kwargs['compresslevel'] = compresslevel
+        self.archive = zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED,
+                                       allowZip64=True, **kwargs)
+
+    def open_member(self, name):
+        if not ZIP_OPEN_WRITE:
+            return self.spooled_member(name)
+        # Members of unknown size may need the ZIP64 extensions.
+        return self.archive.open(name, 'w', force_zip64=True)
+
+    @contextmanager
+    def spooled_member(self, name):
+        """
+        Write a member to a temporary file and then add it to the archive,
+        where members cannot be opened for writing.
+        """
+        handle, path = tempfile.mkstemp(prefix='sepacbi-')
+        try:
+            with os.fdopen(handle, 'wb') as out:
+                yield out
+            self.archive.write(path, name)
+        finally:
+            os.remove(path)
+
+    def member_digest(self, name, serialize, algorithm='sha256'):
+        "Create the member; it is not a file of its own."
+        self.write_member(name, serialize)
+        return None, None
+
+    def close(self):
+        self.archive.close()
+
+
+class HashingSink(Sink):
+    """
+    Writes the payments to another sink, computing their digests while they
+    are serialized. Each Manifest holds both the digest of the serialized
+    payment and that of the file written by the wrapped sink, which differ
+    when the sink compresses it: the latter is the one of the file actually
+    submitted.
+
+    The Manifest of each payment is kept in `manifests`; unless `manifests`
+    is False, it is also written as JSON next to the payment file, to
+    `manifest_sink`: by default, the wrapped sink, or a DirectorySink for
+    the directory of a gzip file. `signer`, if given, is called with the
+    JSON manifest and returns a signature, written next to the manifest.
+    The payment is marked as issued once all of them have been written.
+    """
+
+    def __init__(self, sink, algorithm='sha256', manifests=True,
+                 manifest_sink=None, signer=None):
+        self.sink = sink
+        self.algorithm = algorithm
+        self.write_manifests = manifests
+        if manifests:
+            if manifest_sink is None:
+                manifest_sink = sink.companion_sink()
+            if manifest_sink is None or manifest_sink.single_member:
+                raise OutputError('The manifests need a manifest_sink that '
+                                  'can hold many members')
+        self.manifest_sink = manifest_sink
+        self.signer = signer
+        self.manifests = []
+
+    @property
+    def single_member(self):
+        "Whether the wrapped sink holds a single member."
+        return self.sink.single_member
+
+    def companion_sink(self):
+        return self.sink.companion_sink()
+
+    def write_member(self, name, serialize):
+        return self.sink.write_member(name, serialize)
+
+    def member_digest(self, name, serialize, algorithm='sha256'):
+        return self.sink.member_digest(name, serialize, algorithm)
+
+    def close(self):
+        self.sink.close()
+        if self.manifest_sink not in (None, self.sink):
+            self.manifest_sink.close()
+
+    def write_payment(self, payment, name=None, output_format='xml',
+                      **kwargs):
+        """
+        Serialize a payment like `Sink.write_payment()`, then write its
+        manifest and signature. Return the member name.
+        """
+        if name is None:
+            name = member_name(payment, output_format)
+        manifests = []
+        file_size, file_digest = self.sink.member_digest(
+            name, lambda out: manifests.append(hash_payment(
+                payment, out, output_format, name, self.algorithm, **kwargs)),
+            self.algorithm)
+        manifest = manifests[0]._replace(file_size=file_size,
+                                         file_digest=file_digest)
+        self.manifests.append(manifest)
+        if self.write_manifests:
+            data = manifest.as_json()
+            self.manifest_sink.write_member(name + MANIFEST_SUFFIX,
+                                            lambda out: out.write(data))
+            if self.signer is not None:
+                signature = self.signer(data)
+                self.manifest_sink.write_member(
+                    name + MANIFEST_SUFFIX + SIGNATURE_SUFFIX,
+                    lambda out: out.write(signature))
+        payment.mark_issued()
+        return name
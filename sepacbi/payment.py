@@ -8,15 +8,24 @@ __copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
 __license__ = '3-clause BSD'
 
 import sys
+from itertools import islice
 
 from lxml import etree
-from .util import AttributeCarrier, booltext
+from .util import AttributeCarrier, booltext, check
 from .entity import IdHolder
 from .account import Account
 from .bank import Bank
 from .transaction import Transaction
-from .cbibon_dom import PCRecord, EFRecord
-from datetime import date, datetime
+from .cbibon_dom import PCRecord, EFRecord, TransferInfo, PayerIBANInfo, \
+    PayeeIBANInfo, PayerInfo, PayeeInfo, PurposeInfo, StatusRequest
+from .cbiwriter import render_records, write_records_file, \
+    write_records_stream
+from .cache import content_hash
+from .charset import SEPANormalizer
+from .duplicates import DuplicateCheck, DuplicatePaymentError
+from .storage import TransactionStore, DEFAULT_MEMORY_BUDGET
+from .truncation import TruncationCollector, as_collector, collecting
+from datetime import datetime
 
 if sys.version_info[0] >= 3:
     # pylint: disable=redefined-builtin
@@ -24,6 +33,12 @@ if sys.version_info[0] >= 3:
     basestring = str
 
 
+PAYMENT_XMLNS = 'urn:CBI:xsd:CBIPaymentRequest.00.04.00'
+
+# Number of transactions whose CBI records are formatted together
+CBI_BATCH_SIZE = 1024
+
+
 class MissingABIError(Exception):
     """
     Raised when the debtor's ABI is not specified and cannot be inferred from
@@ -45,6 +60,28 @@ class InvalidEndToEndIDError(Exception):
     """
 
 
+class UnpinnedPaymentError(Exception):
+    """
+    Raised when a content hash is requested for a payment whose output is
+    not deterministic, i.e. without a `req_id` or a `creation_time`.
+    """
+
+
+def request_root(tag):
+    """
+    Return the root element of a request document (`CBIPaymentRequest` or
+    `CBIBdyPaymentRequest`), with its namespace and schema location.
+    """
+    xsi = 'http://www.w3.org/2001/XMLSchema-instance'
+    schema = tag + '.00.04.00'
+    xmlns = 'urn:CBI:xsd:' + schema
+    schema_location = xmlns + ' ' + schema + '.xsd'
+    return etree.Element(
+        '{%s}%s' % (xmlns, tag),
+        attrib={'{%s}schemaLocation' % xsi: schema_location},
+        nsmap={'xsi': xsi, None: xmlns})
+
+
 class Payment(AttributeCarrier):
     # pylint: disable=no-member
     # pylint: disable=attribute-defined-outside-init
@@ -57,7 +94,10 @@ class Payment(AttributeCarrier):
     allowed_args = (
         'req_id', 'batch', 'high_priority', 'execution_date',
         'debtor', 'account', 'abi', 'ultimate_debtor', 'charges_account',
-        'envelope', 'initiator')
+        'envelope', 'initiator', 'bic_directory', 'abi_directory',
+        'creation_time', 'issued_index', 'normalizer', 'truncations',
+        'storage', 'memory_budget', 'check_tax_codes', 'duplicate_index',
+        'duplicate_policy')
 
     ID_PREFIX = 'DistintaXml-'
 
@@ -66,6 +106,27 @@ class Payment(AttributeCarrier):
         self.transactions = []
         self.eeid_set = set()
         super(Payment, self).__init__(**kwargs)
+        if getattr(self, 'storage', None) is not None:
+            self.use_storage()
+
+    def use_storage(self):
+        """
+        Keep the transactions in a `sepacbi.storage.TransactionStore`, as
+        given by the `storage` attribute: a store, the path of its file or
+        True for a temporary file.
+        """
+        store = self.storage
+        if not isinstance(store, TransactionStore):
+            store = TransactionStore(
+                None if store is True else store,
+                getattr(self, 'memory_budget', DEFAULT_MEMORY_BUDGET))
+        store.attach(self)
+        for txr in self.transactions:
+            store.append(txr)
+        for eeid in self.eeid_set:
+            store.eeid_set.add(eeid)
+        self.transactions = store
+        self.eeid_set = store.eeid_set
 
     def add_eeid(self, txid):
         "Add a transaction's end-to-end ID to check for uniqueness."
@@ -73,34 +134,198 @@ class Payment(AttributeCarrier):
             raise InvalidEndToEndIDError('Duplicate end-to-end ID: %r' % txid)
         self.eeid_set.add(txid)
 
-    def add_transaction(self, **kwargs):
-        "Adds a transaction to the internal list. Does not return anything."
-        kwargs['payment_seq'] = len(self.transactions)+1
+    def build_transaction(self, payment_seq, **kwargs):
+        """
+        Return a new Transaction of the payment with the given sequence
+        number, not yet checked nor added.
+        """
+        kwargs['payment_seq'] = payment_seq
         if not hasattr(self, 'req_id'):
             self.gen_id()
         kwargs['payment_id'] = self.req_id
         kwargs['register_eeid_function'] = self.add_eeid
         kwargs['payment'] = self
-        txr = Transaction(**kwargs)
-        txr.perform_checks()
+        return Transaction(**kwargs)
+
+    def add_transaction(self, **kwargs):
+        "Adds a transaction to the internal list. Does not return anything."
+        txr = self.build_transaction(len(self.transactions)+1, **kwargs)
+        txr.ensure_checked()
+        duplicate_check = self.get_duplicate_check()
+        if duplicate_check is not None:
+            try:
+                duplicate_check.check(self, txr)
+            except DuplicatePaymentError:
+                # The rejected transaction must not keep its end-to-end ID.
+                self.eeid_set.discard(txr.eeid)
+                raise
         self.transactions.append(txr)
 
+    def get_duplicate_check(self):
+        """
+        Return the `sepacbi.duplicates.DuplicateCheck` of the payment, or
+        None if it has no `duplicate_index`.
+        """
+        if not hasattr(self, 'duplicate_index'):
+            return None
+        duplicate_check = self.__dict__.get('_duplicate_check')
+        if duplicate_check is None or \
+                duplicate_check.index is not self.duplicate_index:
+            duplicate_check = self._duplicate_check = DuplicateCheck(
+                self.duplicate_index,
+                getattr(self, 'duplicate_policy', 'warn'))
+        return duplicate_check
+
+    def get_duplicates(self):
+        """
+        Return the probable duplicates found while adding the transactions,
+        as (sequence number, end-to-end ID, list of
+        `sepacbi.duplicates.DuplicateMatch`) triples.
+        """
+        duplicate_check = self.get_duplicate_check()
+        return duplicate_check.duplicates \
+            if duplicate_check is not None else []
+
+    def find_duplicates(self, index=None):
+        """
+        Check all the transactions against a DuplicateIndex (by default, the
+        payment's) in a single pass, and return the probable duplicates as
+        `get_duplicates()` does.
+        """
+        if index is None:
+            index = getattr(self, 'duplicate_index', None)
+            if index is None:
+                raise ValueError('The payment has no duplicate_index: '
+                                 'pass the index to check against')
+        duplicate_check = DuplicateCheck(index, 'collect')
+        duplicate_check.check_many(self, list(self.transactions))
+        return duplicate_check.duplicates
+
+    def add_transactions_from_columns(self, data, columns=None):
+        """
+        Add a transaction for each row of a pandas DataFrame, a NumPy
+        structured array or a dictionary of lists. The columns are named
+        after the arguments of `add_transaction()`, plus `creditor_name`,
+        `creditor_cf`, `creditor_code`, `creditor_country` and
+        `creditor_private`; `columns` maps them to differently named
+        columns. All the rows are validated first: if any is invalid,
+        nothing is added and `sepacbi.columns.InvalidRowsError` lists every
+        problem. Return the number of added transactions.
+        """
+        from .columns import add_columns
+        return add_columns(self, data, columns)
+
+    @classmethod
+    def from_frame(cls, data, columns=None, **kwargs):
+        """
+        Build a payment with the keyword arguments, and add the transactions
+        of a DataFrame or other column set with
+        `add_transactions_from_columns()`.
+        """
+        payment = cls(**kwargs)
+        payment.add_transactions_from_columns(data, columns)
+        return payment
+
     def gen_id(self):
         """Generate a unique ID for the payment"""
-        self.req_id = '%s%s' % (self.ID_PREFIX, datetime.now().strftime(
-            '%Y%m%d-%H%M%S'))
+        self.req_id = '%s%s' % (self.ID_PREFIX, self.get_creation_time(
+            ).strftime('%Y%m%d-%H%M%S'))
+
+    def mark_issued(self):
+        """
+        Record the transactions in the issued transaction index and in the
+        duplicate index, if any. This is done by the methods that write the
+        output to a file object, once it has been written; call it after
+        sending the output of `xml_text()` or `cbi_text()`.
+        """
+        if hasattr(self, 'issued_index'):
+            self.issued_index.record_payment(self)
+        if hasattr(self, 'duplicate_index'):
+            self.duplicate_index.record_payment(self)
+
+    def get_truncations(self):
+        """
+        Return the TruncationCollector of the payment, creating it if the
+        `truncations` attribute is a mode name, or None.
+        """
+        truncations = getattr(self, 'truncations', None)
+        if truncations is not None and \
+                not isinstance(truncations, TruncationCollector):
+            truncations = self.truncations = as_collector(truncations)
+        return truncations
+
+    def truncation_collector(self):
+        "Use the payment's collector, if any."
+        collector = self.get_truncations()
+        if collector is None:
+            return super(Payment, self).truncation_collector()
+        return collector, None
+
+    def collecting(self):
+        """
+        Return a context in which the truncations of the parties' attributes
+        are recorded by the payment's collector.
+        """
+        return collecting(*self.truncation_collector())
+
+    def get_creation_time(self):
+        "Return the pinned creation time, or the current time."
+        if hasattr(self, 'creation_time'):
+            return self.creation_time
+        return datetime.now()
+
+    def content_hash(self, *extra):
+        """
+        Return a hex digest identifying the output of the payment: it only
+        changes when the payment, its transactions or the `extra` values
+        (e.g. the output format and options) change. The payment must have
+        a pinned `req_id` and `creation_time`.
+        """
+        if not hasattr(self, 'req_id') or not hasattr(self, 'creation_time'):
+            raise UnpinnedPaymentError(
+                'The payment needs a req_id and a creation_time to be hashed')
+        # Normalize the attributes first, so that the hash does not change
+        # once the output has been generated.
+        self.ensure_checked()
+        for attribute in ('debtor', 'initiator', 'ultimate_debtor'):
+            if hasattr(self, attribute):
+                getattr(self, attribute).ensure_checked()
+        for txr in self.transactions:
+            for attribute in ('creditor', 'ultimate_debtor',
+                              'ultimate_creditor'):
+                if hasattr(txr, attribute):
+                    getattr(txr, attribute).ensure_checked()
+        return content_hash([self, list(extra)])
+
+    def cached_output(self, cache, kind, render, *extra):
+        """
+        Return the output of `render()`, serving it from `cache` (an object
+        with `get(key)` and `put(key, data)` methods) when the payment has
+        not changed since it was stored.
+        """
+        if cache is None:
+            return render()
+        key = self.content_hash(kind, *extra)
+        data = cache.get(key)
+        if data is None:
+            data = render()
+            cache.put(key, data)
+        return data
 
     def perform_checks(self):
         "Checks the validity of all supplied attributes."
+        self.get_truncations()
         if not hasattr(self, 'req_id'):
             self.gen_id()
         self.max_length('req_id', 35)
 
-        assert isinstance(self.debtor, IdHolder)
+        check(isinstance(self.debtor, IdHolder),
+              'The debtor must be an IdHolder instance')
 
         if isinstance(self.account, basestring):
             self.account = Account(iban=self.account)
-        assert isinstance(self.account, Account)
+        check(isinstance(self.account, Account),
+              'The account must be an IBAN or an Account instance')
 
         if hasattr(self, 'abi'):
             abi = self.abi
@@ -114,18 +339,47 @@ class Payment(AttributeCarrier):
         self.cab = self.account.iban[10:15]
         self.cc = self.account.iban[15:27]
 
+        if hasattr(self, 'abi_directory'):
+            if self.account.is_foreign():
+                self.abi_directory.check(abi)
+            else:
+                self.abi_directory.check(abi, self.cab)
+
         if hasattr(self, 'ultimate_debtor'):
-            assert isinstance(self.ultimate_debtor, IdHolder)
+            check(isinstance(self.ultimate_debtor, IdHolder),
+                  'The ultimate debtor must be an IdHolder instance')
 
         if hasattr(self, 'charges_account'):
             if isinstance(self.charges_account, basestring):
                 self.charges_account = Account(iban=self.charges_account)
-            assert isinstance(self.charges_account, Account)
+            check(isinstance(self.charges_account, Account),
+                  'The charges account must be an IBAN or an Account '
+                  'instance')
+
+        if getattr(self, 'check_tax_codes', False):
+            for attribute in ('debtor', 'initiator', 'ultimate_debtor'):
+                if hasattr(self, attribute):
+                    getattr(self, attribute).check_tax_code()
+
+        if getattr(self, 'normalizer', None) is True:
+            self.normalizer = SEPANormalizer()
 
         # Todo: if there is an initiator, check that it has a CUC
         # Todo: if there is no initiator, check that the debtor has a CUC
 
+    def validate_all(self, jobs=None):
+        """
+        Check the payment and every transaction, party, account and BIC,
+        collecting all the problems instead of stopping at the first one.
+        With `jobs`, transactions are checked in a pool of that many
+        processes. Return a `sepacbi.validation.ValidationReport`.
+        """
+        from .validation import validate_payment
+        return validate_payment(self, jobs)
+
     def amount_sum(self):
+        if isinstance(self.transactions, TransactionStore):
+            return self.transactions.total
         return sum([tx.amount for tx in self.transactions])
 
     def get_initiator(self):
@@ -147,41 +401,36 @@ class Payment(AttributeCarrier):
         pick a different outer structure according to the value of the
         `envelope` attribute.
         """
-        xsi = 'http://www.w3.org/2001/XMLSchema-instance'
         if self.envelope:
             tag = 'CBIBdyPaymentRequest'
         else:
             tag = 'CBIPaymentRequest'
-        schema = tag + '.00.04.00'
-        xmlns = 'urn:CBI:xsd:' + schema
-        schema_location = xmlns + ' ' + schema + '.xsd'
-        root = etree.Element(
-            '{%s}%s' % (xmlns, tag),
-            attrib={'{%s}schemaLocation' % xsi: schema_location},
-            nsmap={'xsi': xsi, None: xmlns})
+        root = request_root(tag)
         outer = root
         if self.envelope:
             root = etree.SubElement(root, 'CBIEnvelPaymentRequest')
             root = etree.SubElement(root, 'CBIPaymentRequest')
         return outer, root
 
-    def emit_tag(self):
-        "Returns the whole XML structure for the payment."
-        # Outer XML structure
-        outer, root = self.get_xml_root()
-        xmlns = 'urn:CBI:xsd:CBIPaymentRequest.00.04.00'
-
-        # Header
-        header = etree.SubElement(root, 'GrpHdr', nsmap={None: xmlns})
+    def xml_header(self):
+        "Return the group header (GrpHdr) tag."
+        header = etree.Element('GrpHdr', nsmap={None: PAYMENT_XMLNS})
         etree.SubElement(header, 'MsgId').text = self.req_id
-        etree.SubElement(header, 'CreDtTm').text = datetime.now().isoformat()
+        etree.SubElement(header, 'CreDtTm').text = \
+            self.get_creation_time().isoformat()
         etree.SubElement(header, 'NbOfTxs').text = str(len(self.transactions))
         etree.SubElement(header, 'CtrlSum').text = str(self.amount_sum())
         initiator = self.get_initiator()
-        header.append(initiator.__tag__(as_initiator=True))
+        header.append(initiator.__tag__(
+            as_initiator=True, normalizer=getattr(self, 'normalizer', None)))
+        return header
 
-        # Payment info
-        info = etree.SubElement(root, 'PmtInf', nsmap={None: xmlns})
+    def xml_payment_info(self):
+        """
+        Return the payment information (PmtInf) tag, without the
+        transactions.
+        """
+        info = etree.Element('PmtInf', nsmap={None: PAYMENT_XMLNS})
 
         # TRF: no status requested
         etree.SubElement(info, 'PmtInfId').text = self.req_id
@@ -203,13 +452,15 @@ class Payment(AttributeCarrier):
             etree.SubElement(svclvl, 'Cd').text = 'SEPA'
 
         # Execution date: either today or specified date
-        execution_date = date.today()
+        execution_date = self.get_creation_time().date()
         if hasattr(self, 'execution_date'):
             execution_date = self.execution_date
         etree.SubElement(info, 'ReqdExctnDt').text = execution_date.isoformat()
 
+        normalizer = getattr(self, 'normalizer', None)
+
         # Debtor information
-        info.append(self.debtor.__tag__('Dbtr'))
+        info.append(self.debtor.__tag__('Dbtr', normalizer=normalizer))
 
         # Debtor account
         info.append(self.account.__tag__('DbtrAcct'))
@@ -219,40 +470,110 @@ class Payment(AttributeCarrier):
 
         # Ultimate debtor
         if hasattr(self, 'ultimate_debtor'):
-            info.append(self.ultimate_debtor.__tag__('UltmtDbtr'))
+            info.append(self.ultimate_debtor.__tag__(
+                'UltmtDbtr', normalizer=normalizer))
         etree.SubElement(info, 'ChrgBr').text = 'SLEV'
 
         # Charges account
         if hasattr(self, 'charges_account'):
             info.append(self.charges_account.__tag__('ChrgsAcct'))
 
-        # Transactions
-        if len(self.transactions) == 0:
-            raise NoTransactionsError
-        for txr in self.transactions:
-            info.append(txr.__tag__())
+        return info
+
+    def emit_tag(self):
+        "Returns the whole XML structure for the payment."
+        # Outer XML structure
+        outer, root = self.get_xml_root()
+
+        with self.collecting():
+            root.append(self.xml_header())
+            info = self.xml_payment_info()
+            root.append(info)
+
+            # Transactions
+            if len(self.transactions) == 0:
+                raise NoTransactionsError
+            for txr in self.transactions:
+                info.append(txr.__tag__())
 
         return outer
 
+    def write_xml(self, fileobj, encoding=None, xml_declaration=False,
+                  mark_issued=True):
+        """
+        Write the XML structure to a binary file object, serializing one
+        transaction at a time instead of building the whole tree. The output
+        is the same as that of `xml_text(encoding=encoding,
+        xml_declaration=xml_declaration)`. Unless `mark_issued` is False,
+        the payment is then marked as issued (see `mark_issued()`).
+        """
+        outer, root = self.get_xml_root()
+        self.write_xml_tree(fileobj, outer, root, encoding, xml_declaration)
+        if mark_issued:
+            self.mark_issued()
+
+    def write_xml_tree(self, fileobj, outer, root, encoding=None,
+                       xml_declaration=False):
+        """
+        Append the group header and the payment information to `root`, and
+        write the `outer` element to a binary file object, streaming the
+        transactions into the payment information.
+        """
+        head, tail = self.xml_head_tail(outer, root, encoding,
+                                        xml_declaration)
+        fileobj.write(head)
+        with self.collecting():
+            for txr in self.transactions:
+                fileobj.write(etree.tostring(
+                    txr.__tag__(), encoding=encoding, xml_declaration=False))
+        fileobj.write(tail)
+
+    def xml_head_tail(self, outer, root, encoding=None,
+                      xml_declaration=False):
+        """
+        Append the group header and the payment information to `root`, and
+        return the serialized `outer` element split in two where the
+        transactions belong.
+        """
+        self.ensure_checked()
+        self.report_truncations()
+        if len(self.transactions) == 0:
+            raise NoTransactionsError
+        with self.collecting():
+            root.append(self.xml_header())
+            root.append(self.xml_payment_info())
+        head, closing, tail = etree.tostring(
+            outer, encoding=encoding,
+            xml_declaration=xml_declaration).rpartition(b'</PmtInf>')
+        return head, closing + tail
+
     def xml(self):
         """
         Return the lxml tree.
         """
         return self.__tag__()
 
-    def xml_text(self, **kwargs):
+    def xml_text(self, cache=None, **kwargs):
         """
-        Return the XML structure as a string.
+        Return the XML structure as a string. With a `cache`, an unchanged
+        payment is not rendered again.
         """
-        return etree.tostring(self.xml(), **kwargs)
+        return self.cached_output(
+            cache, 'xml', lambda: etree.tostring(self.xml(), **kwargs),
+            sorted(kwargs.items()))
 
-    def cbi_text(self):
-        self.perform_checks()
+    def cbi_header_footer(self):
+        """
+        Return the header (PC) and footer (EF) records for a CBI text file.
+        The footer's record count is left for the caller to set.
+        """
+        self.ensure_checked()
+        self.report_truncations()
 
         if self.account.is_foreign():
             raise Exception('Cannot use foreign accounts with CBI text files')
 
-        today = date.today()
+        today = self.get_creation_time().date()
 
         header = PCRecord()
         footer = EFRecord()
@@ -274,15 +595,158 @@ class Payment(AttributeCarrier):
         footer.orders = len(self.transactions)
         footer.negative_amounts = 0
         footer.positive_amounts = self.amount_sum()
+        return header, footer
 
-        records = [header.format()]
-        for transaction, i in zip(self.transactions,
-                                  range(len(self.transactions))):
-            records += transaction.cbi_records(i+1)
-        footer.records = len(records)+1
-        records.append(footer.format())
+    def cbi_record_count(self):
+        "Return the number of records of the CBI text file."
+        return 2 + sum([txr.cbi_record_count() for txr in self.transactions])
+
+    def cbi_batch_lines(self, transactions, first_prog=1):
+        """
+        Return the formatted lines of the CBI records of a list of
+        transactions, numbered from `first_prog`. Each record type is
+        formatted for all the transactions at once, from columns, instead of
+        building a record object per transaction.
+        """
+        count = len(transactions)
+        for txr in transactions:
+            txr.report_truncations()
+            if txr.account.is_foreign():
+                raise Exception('Cannot use a foreign IBAN with CBI text '
+                                'files')
+        progs = list(range(first_prog, first_prog + count))
+
+        # Record 10
+        xinfo = {
+            'prog_number': progs,
+            'purpose': [txr.cbi_purpose_code() for txr in transactions],
+            'amount': [txr.amount for txr in transactions],
+            'ord_abi': [self.bank.abi] * count,
+            'ord_cab': [self.cab] * count,
+            'ord_account': [self.cc] * count,
+        }
+        if hasattr(self, 'execution_date'):
+            xinfo['execution_date'] = [self.execution_date] * count
+        if getattr(self, 'high_priority', False):
+            xinfo['prio'] = ['U'] * count
+        lines_10 = TransferInfo.format_many(xinfo)
+
+        # Records 16, 17, 20, 30
+        lines_16 = PayerIBANInfo.format_many({
+            'prog_number': progs, 'iban': [self.account.iban] * count})
+        lines_17 = PayeeIBANInfo.format_many({
+            'prog_number': progs,
+            'iban': [txr.account.iban for txr in transactions]})
+        lines_20 = PayerInfo.format_many({
+            'prog_number': progs, 'name': [self.debtor.name] * count,
+            'tax_code': [self.debtor.cf] * count})
+        lines_30 = PayeeInfo.format_many({
+            'prog_number': progs,
+            'name': [txr.creditor.name for txr in transactions],
+            'tax_code': [getattr(txr.creditor, 'cf', u'')
+                         for txr in transactions]})
+
+        # Records 50/60, flattened across the transactions
+        rmt_counts = []
+        rmt_columns = {'prog_number': [], 'record_type': [], 'desc': []}
+        for prog, txr in zip(progs, transactions):
+            segments = txr.rmt_cbi_segments()
+            rmt_counts.append(len(segments))
+            for record_type, line in segments:
+                rmt_columns['prog_number'].append(prog)
+                rmt_columns['record_type'].append(record_type)
+                rmt_columns['desc'].append(line)
+        lines_rmt = PurposeInfo.format_many(rmt_columns)
+
+        # Record 70
+        lines_70 = StatusRequest.format_many({'prog_number': progs})
+
+        lines = []
+        rmt_start = 0
+        for i in range(count):
+            lines += [lines_10[i], lines_16[i], lines_17[i], lines_20[i],
+                      lines_30[i]]
+            lines += lines_rmt[rmt_start:rmt_start + rmt_counts[i]]
+            rmt_start += rmt_counts[i]
+            lines.append(lines_70[i])
+        return lines
+
+    def cbi_line_batches(self, batch_size=CBI_BATCH_SIZE):
+        """
+        Yield the formatted lines of the CBI text file in lists: the header,
+        the records of each batch of `batch_size` transactions and the
+        footer. The transactions are read in a single pass.
+        """
+        header, footer = self.cbi_header_footer()
+        yield [header.format()]
+        records = 2
+        prog = 1
+        transactions = iter(self.transactions)
+        while True:
+            batch = list(islice(transactions, batch_size))
+            if not batch:
+                break
+            lines = self.cbi_batch_lines(batch, prog)
+            prog += len(batch)
+            records += len(lines)
+            yield lines
+        footer.records = records
+        yield [footer.format()]
+
+    def iter_cbi_lines(self, batch_size=CBI_BATCH_SIZE):
+        "Yield the formatted lines of the CBI text file one at a time."
+        for lines in self.cbi_line_batches(batch_size):
+            for line in lines:
+                yield line
+
+    def cbi_lines(self):
+        "Return the formatted lines of the CBI text file."
+        return list(self.iter_cbi_lines())
+
+    def cbi_text(self, cache=None):
+        """
+        Return the CBI text file as a string. With a `cache`, an unchanged
+        payment is not rendered again.
+        """
+        if cache is not None:
+            return self.cached_output(
+                cache, 'cbi', lambda: self.cbi_text().encode('latin-1')
+            ).decode('latin-1')
+        records = self.cbi_lines()
         records.append(u'')
         return '\n'.join(records)
 
+    def cbi_bytes(self, encoding='ascii', line_terminator=b'\n'):
+        """
+        Return the CBI text file as a bytearray allocated with its final
+        size. The records are encoded into it a batch at a time, without
+        building the whole text first.
+        """
+        return render_records(self.iter_cbi_lines(), self.cbi_record_count(),
+                              PCRecord.length, encoding, line_terminator)
 
-
+    def write_cbi(self, fileobj, encoding='ascii', line_terminator=b'\n',
+                  mark_issued=True):
+        """
+        Write the CBI text file to a binary file object, a block of records
+        at a time, then mark the payment as issued unless `mark_issued` is
+        False. Return the number of bytes written.
+        """
+        size = write_records_stream(fileobj, self.iter_cbi_lines(),
+                                    PCRecord.length, encoding,
+                                    line_terminator)
+        if mark_issued:
+            self.mark_issued()
+        return size
+
+    def write_cbi_file(self, path, encoding='ascii', line_terminator=b'\n'):
+        """
+        Write the CBI text file to `path` through a memory map of its final
+        size, encoding the records into it a batch at a time, then mark the
+        payment as issued. Return the size of the file.
+        """
+        size = write_records_file(path, self.iter_cbi_lines(),
+                                  self.cbi_record_count(), PCRecord.length,
+                                  encoding, line_terminator)
+        self.mark_issued()
+        return size
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+
+"""
+Pipelined generation of payment files.
+
+Building the transactions' tags or records, serializing them to bytes,
+compressing and writing run as stages on separate threads, connected by
+bounded queues: while a batch of transactions is being built, the previous
+ones are serialized, compressed and written. lxml serialization, zlib and
+file writes release the GIL, so I/O and compression overlap with the rest
+of the work. Memory usage is bounded by the queue size.
+
+Each run returns a PipelineReport with the throughput of each stage and the
+time it spent waiting for input (starved) or for room in its output queue
+(blocked), to find the slowest stage when tuning.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import sys
+import threading
+import time
+import zlib
+from itertools import islice
+
+import six
+from lxml import etree
+from six.moves.queue import Queue, Empty, Full
+
+from .cbibon_dom import PCRecord
+from .cbiwriter import render_records
+
+# Number of transactions handed from a stage to the next one at once
+DEFAULT_BATCH_SIZE = 256
+
+# Number of batches waiting between two stages
+DEFAULT_QUEUE_SIZE = 8
+
+# Seconds between the checks for a failure of another stage
+POLL_INTERVAL = 0.1
+
+# Marks the end of the items in a queue
+_END = object()
+
+
+class StageStats(object):
+    """
+    The counters of a stage: the number of batches and bytes it produced,
+    the time spent working (`busy`), waiting for input (`starved`) and
+    waiting for room in the next queue (`blocked`).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def __str__(self):
+        rate = self.bytes / self.busy / 1048576.0 if self.busy else 0.0
+        return '%-9s %6d batches %12d bytes  busy %7.3f s  starved %7.3f s' \
+            '  blocked %7.3f s  %8.1f MiB/s' % (
+                self.name, self.items, self.bytes, self.busy, self.starved,
+                self.blocked, rate)
+
+
+class PipelineReport(object):
+    "The StageStats of a pipeline run, and its total time."
+
+    def __init__(self, stages, seconds):
+        self.stages = stages
+        self.seconds = seconds
+
+    def __getitem__(self, name):
+        for stats in self.stages:
+            if stats.name == name:
+                return stats
+        raise KeyError(name)
+
+    def bottleneck(self):
+        "Return the name of the busiest stage."
+        return max(self.stages, key=lambda stats: stats.busy).name
+
+    def summary(self):
+        "Return a human-readable report."
+        return '\n'.join([str(stats) for stats in self.stages] + [
+            'total %.3f s; bottleneck: %s' % (self.seconds,
+                                              self.bottleneck())])
+
+
+class Pipeline(object):
+    """
+    A chain of stages, each running `function(item)` on the items produced
+    by the previous one, on its own thread. A stage's `finish()`, if any,
+    returns a last item once its input is over. If a stage fails, the others
+    stop and the exception is raised again by `run()`.
+    """
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.stages = []
+        self.failed = threading.Event()
+        self.errors = []
+
+    def add_stage(self, name, function, finish=None):
+        "Append a stage to the pipeline."
+        self.stages.append((StageStats(name), function, finish))
+
+    def put(self, queue, item, stats):
+        "Put an item into a queue, unless the pipeline has failed."
+        start = time.time()
+        while not self.failed.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                break
+            except Full:
+                pass
+        stats.blocked += time.time() - start
+
+    def drain(self, queue, stats):
+        "Yield the items of a queue until its end or a failure."
+        while True:
+            start = time.time()
+            item = _END
+            while not self.failed.is_set():
+                try:
+                    item = queue.get(timeout=POLL_INTERVAL)
+                    break
+                except Empty:
+                    pass
+            stats.starved += time.time() - start
+            if item is _END:
+                return
+            yield item
+
+    def run_stage(self, items, stats, function, finish, output):
+        "Run a stage over its input items. This runs on the stage's thread."
+        try:
+            for item in self.produce(items, stats, function, finish):
+                self.count(stats, item)
+                if output is not None:
+                    self.put(output, item, stats)
+                if self.failed.is_set():
+                    break
+        except Exception:  # pylint: disable=broad-except
+            self.errors.append(sys.exc_info())
+            self.failed.set()
+        finally:
+            if hasattr(items, 'close'):
+                # End a source generator on its own thread.
+                items.close()
+            if output is not None:
+                self.put(output, _END, stats)
+
+    @staticmethod
+    def count(stats, item):
+        "Count an item produced by a stage."
+        stats.items += 1
+        if isinstance(item, (bytes, bytearray)):
+            stats.bytes += len(item)
+
+    @staticmethod
+    def produce(items, stats, function, finish):
+        """
+        Yield the results of a stage, timing the work done: the production
+        of the items for the first stage, `function` for the others.
+        """
+        items = iter(items)
+        while True:
+            start = time.time()
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            if function is None:
+                stats.busy += time.time() - start
+                yield item
+                continue
+            start = time.time()
+            result = function(item)
+            stats.busy += time.time() - start
+            yield result
+        if finish is not None:
+            start = time.time()
+            item = finish()
+            stats.busy += time.time() - start
+            yield item
+
+    def run(self, source, name='build'):
+        """
+        Run the pipeline over the items of `source`, produced by a first
+        stage named `name`. Return a PipelineReport.
+        """
+        start = time.time()
+        source_stats = StageStats(name)
+        stages = [(source_stats, None, None)] + self.stages
+        queues = [Queue(self.queue_size) for _ in self.stages]
+        threads = []
+        items = source
+        for position, (stats, function, finish) in enumerate(stages):
+            output = queues[position] if position < len(queues) else None
+            threads.append(threading.Thread(
+                target=self.run_stage,
+                args=(items, stats, function, finish, output)))
+            if output is not None:
+                items = self.drain(output, stages[position + 1][0])
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            six.reraise(*self.errors[0])
+        return PipelineReport([stats for stats, _, _ in stages],
+                              time.time() - start)
+
+
+def batches(items, size):
+    "Yield lists of at most `size` items."
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def add_output_stages(pipeline, fileobj, compresslevel=None):
+    """
+    Add the compression stage (gzip format, if `compresslevel` is given) and
+    the writing stage to a pipeline.
+    """
+    if compresslevel is not None:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        pipeline.add_stage('compress', compressor.compress, compressor.flush)
+
+    def write(data):
+        "Write a block of data, and pass it on to be counted."
+        fileobj.write(data)
+        return data
+    pipeline.add_stage('write', write)
+
+
+def write_xml_pipelined(payment, fileobj, encoding=None,
+                        xml_declaration=False, compresslevel=None,
+                        batch_size=DEFAULT_BATCH_SIZE,
+                        queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    Write the XML structure of a payment to a binary file object, like
+    `Payment.write_xml()`, building, serializing, compressing (as gzip, if
+    `compresslevel` is given) and writing the transactions on separate
+    threads, then mark the payment as issued. Return a PipelineReport.
+    """
+    outer, root = payment.get_xml_root()
+    head, tail = payment.xml_head_tail(outer, root, encoding,
+                                       xml_declaration)
+
+    def build():
+        "Yield the head, then lists of transaction tags."
+        yield head
+        # The truncations are recorded on this thread.
+        with payment.collecting():
+            for batch in batches(payment.transactions, batch_size):
+                yield [txr.__tag__() for txr in batch]
+
+    def serialize(batch):
+        "Serialize a list of tags."
+        if isinstance(batch, bytes):
+            return batch
+        return b''.join([etree.tostring(tag, encoding=encoding,
+                                        xml_declaration=False)
+                         for tag in batch])
+
+    pipeline = Pipeline(queue_size)
+    pipeline.add_stage('serialize', serialize, lambda: tail)
+    add_output_stages(pipeline, fileobj, compresslevel)
+    report = pipeline.run(build())
+    payment.mark_issued()
+    return report
+
+
+def write_cbi_pipelined(payment, fileobj, encoding='ascii',
+                        line_terminator=b'\n', compresslevel=None,
+                        batch_size=DEFAULT_BATCH_SIZE,
+                        queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    Write the CBI text file of a payment to a binary file object, like
+    `Payment.write_cbi()`, with the records formatted, encoded, compressed
+    (as gzip, if `compresslevel` is given) and written on separate threads,
+    then mark the payment as issued. Return a PipelineReport.
+    """
+    def render(lines):
+        "Encode a list of formatted records."
+        return bytes(render_records(lines, len(lines), PCRecord.length,
+                                    encoding, line_terminator))
+
+    pipeline = Pipeline(queue_size)
+    pipeline.add_stage('serialize', render)
+    add_output_stages(pipeline, fileobj, compresslevel)
+    report = pipeline.run(payment.cbi_line_batches(batch_size))
+    payment.mark_issued()
+    return report
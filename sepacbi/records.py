@@ -1,6 +1,7 @@
 import copy
+from itertools import repeat
 from unidecode import unidecode
-from datetime import date
+from datetime import date, datetime
 from decimal import Decimal
 from six import add_metaclass
 
@@ -73,6 +74,28 @@ class BaseField(Ordered):
             raise Exception('Could not format properly value %r' % value)
         return s
 
+    def format_column(self, values):
+        """
+        Format a whole column of values. Each distinct value is formatted
+        only once, as columns (names, dates, ABI codes) repeat a lot.
+        """
+        cache = {}
+        result = []
+        for value in values:
+            try:
+                result.append(cache[value])
+            except KeyError:
+                text = cache[value] = self.format(value)
+                result.append(text)
+        return result
+
+    def parse(self, text):
+        """
+        Convert the text of the field, as read from a record, back into a
+        value.
+        """
+        return text.strip()
+
     @property
     def size(self):
         "Return the exported field size in characters."
@@ -123,6 +146,7 @@ class FieldContainerMixin(object):
     def set_defaults(cls):
         lofl = [f.get_default() for f in cls.fields]
         cls._defaults = [val for subl in lofl for val in subl]
+        cls.length = sum([len(val) for val in cls._defaults])
 
     @classmethod
     def define_fields(cls):
@@ -227,9 +251,114 @@ class BaseRecord(FieldContainerMixin):
     def format(self):
         return ''.join(self._values)
 
+    def write_into(self, buffer, offset, encoding='ascii'):
+        """
+        Encode the record into a writable buffer (bytearray, memoryview or
+        mmap) at the given offset, field by field. Return the offset just
+        past the record.
+
+        Only single-byte encodings keep the record width; a field that
+        encodes to a different number of bytes raises an exception.
+        """
+        for value in self._values:
+            raw = value.encode(encoding)
+            end = offset + len(raw)
+            if len(raw) != len(value):
+                raise Exception('Field %r does not fit a single-byte '
+                                'encoding' % value)
+            buffer[offset:end] = raw
+            offset = end
+        return offset
+
     def debug_format(self):
         return '%r' % self._values
 
+    @classmethod
+    def parse(cls, line):
+        """
+        Read the fields of a record from a line of text. Return a {field
+        name: value} dictionary; composite fields are not supported.
+        """
+        values = {}
+        offset = 0
+        for field in cls.fields:
+            if isinstance(field, CompositeField):
+                raise NotImplementedError(
+                    'Composite fields cannot be parsed')
+            values[field.name] = field.parse(line[offset:offset + field.size])
+            offset += field.size
+        return values
+
+    @classmethod
+    def format_many(cls, columns, count=None, out=None, line_terminator='\n',
+                    use_numpy=False):
+        """
+        Format many records of this type at once from column arrays, given
+        as a {field name: sequence of values} dictionary. Fields without a
+        column keep their default value in every record.
+
+        Each column is padded and filled as a whole, and the constant parts
+        of the record are joined only once. Return the list of formatted
+        lines; if `out` is given, write them to it (each followed by
+        `line_terminator`) and return their number instead. With
+        `use_numpy`, return a NumPy array of fixed-width strings.
+        """
+        names = set(field.name for field in cls.fields)
+        unknown = set(columns) - names
+        if unknown:
+            raise Exception('Unknown fields for %s: %s' % (
+                cls.__name__, ', '.join(sorted(unknown))))
+        lengths = set(len(column) for column in columns.values())
+        if count is not None:
+            lengths.add(count)
+        if len(lengths) != 1:
+            raise Exception('Columns must have the same length')
+        count = lengths.pop()
+
+        # Pieces are (constant string, None) or (None, formatted column)
+        pieces = []
+        constant = []
+        for field in cls.fields:
+            if field.name in columns:
+                if isinstance(field, CompositeField):
+                    raise NotImplementedError(
+                        'Composite fields cannot be formatted as columns')
+                if constant:
+                    pieces.append((''.join(constant), None))
+                    constant = []
+                pieces.append((None, field.format_column(
+                    columns[field.name])))
+            else:
+                constant += field.get_default()
+        if constant:
+            pieces.append((''.join(constant), None))
+
+        if use_numpy:
+            return cls._numpy_join(pieces, count)
+
+        iterables = [repeat(text, count) if text is not None else column
+                     for text, column in pieces]
+        lines = [''.join(parts) for parts in zip(*iterables)]
+        if out is None:
+            return lines
+        if lines:
+            out.write(line_terminator.join(lines) + line_terminator)
+        return count
+
+    @classmethod
+    def _numpy_join(cls, pieces, count):
+        "Join the pieces of `format_many()` as NumPy fixed-width strings."
+        import numpy
+        result = numpy.full(count, '', dtype='U%d' % cls.length)
+        for text, column in pieces:
+            if text is not None:
+                result = numpy.char.add(result, text)
+            else:
+                width = max([len(item) for item in column] or [1])
+                result = numpy.char.add(
+                    result, numpy.array(column, dtype='U%d' % width))
+        return result.astype('U%d' % cls.length)
+
 
 ##########################
 # Useful implementations #
@@ -253,6 +382,21 @@ class NumericField(BaseField):
             return u' '*self._flen
         return str(int(value)).zfill(self._flen)
 
+    def parse(self, text):
+        text = text.strip()
+        if not text:
+            return None
+        return int(text)
+
+    def format_column(self, values):
+        flen = self._flen
+        blank = u' '*flen
+        result = [blank if value is None else str(int(value)).zfill(flen)
+                  for value in values]
+        if result and max([len(item) for item in result]) != flen:
+            raise Exception('Could not format properly column %r' % self.name)
+        return result
+
     _default_value = None
 
 
@@ -298,6 +442,11 @@ class CBIDateField(BaseField):
         else:
             raise Exception('Invalid type for date: %r' % value)
 
+    def parse(self, text):
+        if not text.strip() or text == '000000':
+            return None
+        return datetime.strptime(text, '%d%m%y').date()
+
     _default_value = None
 
 class DecimalField(BaseField):
@@ -319,6 +468,15 @@ class DecimalField(BaseField):
             value = Decimal(0)
         return str((value * self.multiplier).to_integral()).zfill(self._flen)
 
+    def parse(self, text):
+        text = text.strip()
+        if not text:
+            return None
+        # Some records (e.g. CBI statements) write an explicit comma.
+        if ',' in text:
+            return Decimal(text.replace(',', '.'))
+        return Decimal(int(text)) / self.multiplier
+
     _default_value = None
 
 
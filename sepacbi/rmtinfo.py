@@ -10,7 +10,22 @@ __license__ = '3-clause BSD'
 
 
 from decimal import Decimal
-from .util import AttributeCarrier
+from .util import AttributeCarrier, check
+
+# Layout of the CBI remittance records (50/60)
+CBI_LINE_LENGTH = 90
+CBI_MAX_RECORDS = 5
+DOCS_PER_CBI_LINE = 3
+
+# Maximum length of the XML unstructured remittance information
+USTRD_MAX_LENGTH = 140
+
+
+class RemittanceInfoError(Exception):
+    """
+    Raised when the remittance information does not fit the space available
+    in the output format.
+    """
 
 
 class Document(AttributeCarrier):
@@ -36,17 +51,46 @@ class Document(AttributeCarrier):
         if date:
             self.date = date
 
+    def __setattr__(self, name, value):
+        "Forget the rendered strings whenever a public attribute changes."
+        if not name.startswith('_'):
+            self.__dict__.pop('_rendered', None)
+        super(Document, self).__setattr__(name, value)
+
+    def rendered(self, kind, render):
+        """
+        Return the string of the given kind, rendering it (and validating the
+        document) only the first time, or after an attribute has changed.
+        """
+        try:
+            return self.__dict__['_rendered'][kind]
+        except KeyError:
+            text = render()
+            # Rendering may normalize attributes, which clears the cache, so
+            # the cache is looked up again only now.
+            self.__dict__.setdefault('_rendered', {})[kind] = text
+            return text
+
     def perform_checks(self):
         "Check the document number and, optionally, the date and amount."
-        assert int(self.number) is not None
+        int(self.number)
         if hasattr(self, 'date'):
-            assert hasattr(self.date, 'strftime')
-            assert hasattr(self, 'amount')
+            check(hasattr(self.date, 'strftime'), 'Invalid document date')
+            check(hasattr(self, 'amount'),
+                  'A document with a date must have an amount')
         if hasattr(self, 'amount'):
             if not isinstance(self.amount, Decimal):
                 self.amount = Decimal(str(self.amount))
 
     def __str__(self):
+        return self.rendered('eact', self.render_eact)
+
+    def cbi(self):
+        "Return the fragment for the CBI remittance records."
+        return self.rendered('cbi', self.render_cbi)
+
+    def render_eact(self):
+        "Render the EACT remittance string."
         self.perform_checks()
         items = [str(self.number)]
         if hasattr(self, 'amount'):
@@ -55,7 +99,8 @@ class Document(AttributeCarrier):
             items += [self.date.strftime('%Y%m%d')]
         return self.tag + '/ '.join(items)
 
-    def cbi(self):
+    def render_cbi(self):
+        "Render the CBI fragment."
         # CBI-BON-001, record 50/60
         if hasattr(self, 'number') and hasattr(self, 'date'):
             return '%24s%s' % (self.number, self.date.strftime('%d%m%Y'))
@@ -89,12 +134,92 @@ class Text(Document):
         self.text = text
 
     def perform_checks(self):
-        assert hasattr(self, 'text')
+        check(hasattr(self, 'text'), 'Missing text')
 
-    def __str__(self):
+    def render_eact(self):
         # pylint: disable=no-member
         self.perform_checks()
         return self.tag + self.text
 
-    def cbi(self):
+    def render_cbi(self):
         return '%30s' % self.text
+
+
+class Remittance(object):
+    """
+    The remittance information of a transaction, either as free text or as
+    a list of documents, segmented for the XML `Ustrd` element and for the
+    CBI text records 50/60.
+
+    The amount of work is bounded up front: the number of CBI records is
+    computed, and checked against the limit, before any line is built.
+    """
+
+    def __init__(self, rmtinfo=None, docs=None):
+        if (rmtinfo is None) == (docs is None):
+            raise RemittanceInfoError(
+                'Exactly one of rmtinfo and docs must be supplied')
+        self.rmtinfo = rmtinfo
+        self.docs = docs
+
+    def text(self):
+        "Return the whole text of the remittance information."
+        if self.rmtinfo is not None:
+            return self.rmtinfo
+        return ''.join([str(doc) for doc in self.docs])
+
+    def ustrd(self):
+        """
+        Return the text for the XML unstructured remittance information,
+        raising RemittanceInfoError if it does not fit.
+        """
+        text = self.text()
+        if len(text) > USTRD_MAX_LENGTH:
+            raise RemittanceInfoError(
+                'Remittance information longer than %d characters'
+                % USTRD_MAX_LENGTH)
+        return text
+
+    def cbi_record_count(self):
+        "Return the number of CBI remittance records."
+        if self.rmtinfo is not None:
+            return max(1, -(-len(self.rmtinfo) // CBI_LINE_LENGTH))
+        return -(-len(self.docs) // DOCS_PER_CBI_LINE)
+
+    def cbi_record_type(self):
+        "Return the CBI record type: 50 if a single record suffices, else 60."
+        if self.rmtinfo is not None:
+            if len(self.rmtinfo) <= CBI_LINE_LENGTH:
+                return '50'
+            return '60'
+        if len(self.docs) <= DOCS_PER_CBI_LINE:
+            return '50'
+        return '60'
+
+    def iter_cbi_segments(self):
+        """
+        Yield the (record type, description) pairs of the CBI remittance
+        records, raising RemittanceInfoError before anything is produced if
+        they would be too many.
+        """
+        count = self.cbi_record_count()
+        if count > CBI_MAX_RECORDS:
+            raise RemittanceInfoError(
+                'Too many records (%d) for remittance info' % count)
+        record_type = self.cbi_record_type()
+        if self.rmtinfo is not None:
+            if len(self.rmtinfo) <= CBI_LINE_LENGTH:
+                yield record_type, self.rmtinfo
+                return
+            for start in range(0, len(self.rmtinfo), CBI_LINE_LENGTH):
+                yield record_type, \
+                    self.rmtinfo[start:start + CBI_LINE_LENGTH]
+        else:
+            fragments = [doc.cbi() for doc in self.docs]
+            for start in range(0, len(fragments), DOCS_PER_CBI_LINE):
+                yield record_type, \
+                    ''.join(fragments[start:start + DOCS_PER_CBI_LINE])
+
+    def cbi_segments(self):
+        "Return the list of the (record type, description) pairs."
+        return list(self.iter_cbi_segments())
@@ -0,0 +1,439 @@
+#!/usr/bin/python
+
+"""
+Reconciliation of account statements with the issued transfers.
+
+Statement entries are read as streams, from CBI RH text files
+(`parse_cbi_rh()`) or camt.053 XML files (`parse_camt053()`). The issued
+transactions (e.g. from `sepacbi.status.IssuedIndex.iter_created()`) are
+indexed in memory by end-to-end ID, request ID, amount and creditor IBAN;
+`match_statement()` then goes through the entries once, trying an exact
+strategy first and a tolerant one last.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import io
+import re
+import sys
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from lxml import etree
+
+from .cbirh_dom import OpeningBalance, Movement, MovementInfo
+from .status import child_text
+
+if sys.version_info[0] >= 3:
+    # pylint: disable=redefined-builtin
+    # pylint: disable=invalid-name
+    basestring = str
+
+StatementEntry = namedtuple('StatementEntry', (
+    'account', 'booking_date', 'value_date', 'debit', 'amount', 'reference',
+    'msg_id', 'eeid', 'iban', 'text'))
+StatementEntry.__doc__ = """
+A movement on an account statement. `msg_id`, `eeid` and `iban` (of the
+counterparty) are None when the statement does not provide them.
+"""
+
+TOKEN_RE = re.compile(r'[\s/]+')
+
+
+def iter_lines(source, encoding='latin-1'):
+    "Yield the lines of a file name or text file object."
+    if isinstance(source, basestring):
+        with io.open(source, encoding=encoding) as stream:
+            for line in stream:
+                yield line
+    else:
+        for line in source:
+            yield line
+
+
+def parse_cbi_rh(source, encoding='latin-1'):
+    """
+    Yield a StatementEntry for each movement (record 62, with its record 63
+    descriptions) of a CBI RH statement file.
+    """
+    account = None
+    movement = None
+    descriptions = []
+
+    def entry():
+        return StatementEntry(
+            account, movement['accounting_date'], movement['value_date'],
+            movement['sign'] == 'D', movement['amount'],
+            movement['bank_reference'] or None, None, None, None,
+            ' '.join([movement['description']] + descriptions).strip())
+
+    for line in iter_lines(source, encoding):
+        line = line.rstrip('\r\n').ljust(Movement.length)
+        record_type = line[1:3]
+        if record_type == '63':
+            descriptions.append(MovementInfo.parse(line)['description'])
+            continue
+        if movement is not None:
+            yield entry()
+            movement = None
+        if record_type == '61':
+            opening = OpeningBalance.parse(line)
+            account = '%05d%05d%s' % (opening['abi'] or 0,
+                                      opening['cab'] or 0,
+                                      opening['account'])
+        elif record_type == '62':
+            movement = Movement.parse(line)
+            descriptions = []
+    if movement is not None:
+        yield entry()
+
+
+def children(element, name):
+    "Return the children of an element with a local name."
+    return [child for child in element if isinstance(child.tag, str) and
+            etree.QName(child).localname == name]
+
+
+def parse_date(text):
+    "Convert an ISO date or datetime to a date."
+    if text is None:
+        return None
+    return datetime.strptime(text[:10], '%Y-%m-%d').date()
+
+
+def parse_camt053(source):
+    """
+    Yield a StatementEntry for each transaction of a camt.053 statement
+    read from a file name or file object. A batch-booked entry with several
+    transaction details yields one StatementEntry per transaction. Parsed
+    entries are discarded as soon as they have been read.
+    """
+    account = None
+    for _, element in etree.iterparse(source, events=('end',),
+                                      tag=('{*}Acct', '{*}Ntry')):
+        if etree.QName(element).localname == 'Acct':
+            account = child_text(element, 'Id', 'IBAN')
+            continue
+
+        debit = child_text(element, 'CdtDbtInd') == 'DBIT'
+        amount = Decimal(child_text(element, 'Amt'))
+        booking_date = parse_date(child_text(element, 'BookgDt', 'Dt') or
+                                  child_text(element, 'BookgDt', 'DtTm'))
+        value_date = parse_date(child_text(element, 'ValDt', 'Dt') or
+                                child_text(element, 'ValDt', 'DtTm'))
+        reference = child_text(element, 'AcctSvcrRef') or \
+            child_text(element, 'NtryRef')
+        details = []
+        for entry_details in children(element, 'NtryDtls'):
+            details += children(entry_details, 'TxDtls')
+        if not details:
+            yield StatementEntry(
+                account, booking_date, value_date, debit, amount, reference,
+                None, None, None, child_text(element, 'AddtlNtryInf'))
+        for detail in details:
+            eeid = child_text(detail, 'Refs', 'EndToEndId')
+            if eeid == 'NOTPROVIDED':
+                eeid = None
+            party = 'CdtrAcct' if debit else 'DbtrAcct'
+            tx_amount = child_text(detail, 'Amt') or \
+                child_text(detail, 'AmtDtls', 'TxAmt', 'Amt')
+            remittance = children(detail, 'RmtInf')
+            text = ' '.join(
+                item.text for info in remittance
+                for item in children(info, 'Ustrd') if item.text)
+            yield StatementEntry(
+                account, booking_date, value_date, debit,
+                Decimal(tx_amount) if tx_amount is not None else amount,
+                child_text(detail, 'Refs', 'AcctSvcrRef') or reference,
+                child_text(detail, 'Refs', 'MsgId'), eeid,
+                child_text(detail, 'RltdPties', party, 'Id', 'IBAN'),
+                text or None)
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+class Bucket(object):
+    """
+    The positions of the issued transactions under a key of an index,
+    oldest first. `start` skips the matched positions at the front;
+    `removed` counts the matched ones, to drop them once they are many.
+    """
+    __slots__ = ('positions', 'start', 'removed', 'ordered')
+
+    def __init__(self):
+        self.positions = []
+        self.start = 0
+        self.removed = 0
+        self.ordered = True
+
+
+class IssuedLookup(object):
+    """
+    In-memory indexes of the issued transactions (IssuedTransaction
+    instances) that have not been matched yet. Matched transactions are
+    skipped without rescanning them, and dropped from the indexes as they
+    accumulate; the unmatched total of each request is kept up to date.
+    """
+
+    def __init__(self, issued=()):
+        self.items = []
+        self.matched = set()
+        self.by_eeid = {}
+        self.by_msg_id = {}
+        self.by_amount_iban = {}
+        self.by_iban = {}
+        self.by_amount = {}
+        self.request_totals = {}
+        for item in issued:
+            self.add(item)
+
+    def keys(self, item):
+        "Return the (index, key) pairs of an issued transaction."
+        return ((self.by_eeid, item.eeid),
+                (self.by_msg_id, item.msg_id),
+                (self.by_amount_iban, (item.amount, item.iban)),
+                (self.by_iban, item.iban),
+                (self.by_amount, item.amount))
+
+    def add(self, item):
+        "Index an issued transaction."
+        position = len(self.items)
+        self.items.append(item)
+        for table, key in self.keys(item):
+            bucket = table.get(key)
+            if bucket is None:
+                bucket = table[key] = Bucket()
+            elif self.items[bucket.positions[-1]].created > item.created:
+                bucket.ordered = False
+            bucket.positions.append(position)
+        count, total = self.request_total(item.msg_id)
+        self.request_totals[item.msg_id] = (count + 1, total + item.amount)
+
+    def request_total(self, msg_id):
+        """
+        Return the number and the total amount of the unmatched
+        transactions of a request.
+        """
+        return self.request_totals.get(msg_id, (0, Decimal('0.00')))
+
+    def candidates(self, table, key):
+        "Yield the positions of the unmatched items under a key, oldest first."
+        bucket = table.get(key)
+        if bucket is None:
+            return
+        positions = bucket.positions
+        if not bucket.ordered:
+            positions.sort(key=lambda position: (
+                self.items[position].created, position))
+            bucket.start = 0
+            bucket.ordered = True
+        while bucket.start < len(positions) and \
+                positions[bucket.start] in self.matched:
+            bucket.start += 1
+        index = bucket.start
+        while index < len(positions):
+            if positions[index] not in self.matched:
+                yield positions[index]
+            index += 1
+
+    def match(self, position):
+        "Mark an issued transaction as matched."
+        self.matched.add(position)
+        item = self.items[position]
+        for table, key in self.keys(item):
+            bucket = table[key]
+            bucket.removed += 1
+            if bucket.removed * 2 > len(bucket.positions):
+                bucket.positions = [
+                    other for other in bucket.positions[bucket.start:]
+                    if other not in self.matched]
+                bucket.start = 0
+                bucket.removed = 0
+        count, total = self.request_totals[item.msg_id]
+        self.request_totals[item.msg_id] = (count - 1, total - item.amount)
+
+    def unmatched(self):
+        "Return the issued transactions that have not been matched."
+        return [item for position, item in enumerate(self.items)
+                if position not in self.matched]
+
+
+class StatementReconciliation(object):
+    """
+    The outcome of `match_statement()`:
+
+    - `matched`: (IssuedTransaction, StatementEntry, strategy) triples;
+    - `unmatched_entries`: debits that match no issued transaction;
+    - `unmatched_issued`: issued transactions not found on the statement;
+    - `ignored`: the number of credit entries, which were skipped.
+    """
+    def __init__(self):
+        self.matched = []
+        self.unmatched_entries = []
+        self.unmatched_issued = []
+        self.ignored = 0
+
+    def summary(self):
+        "Return a human-readable summary."
+        return '%d matched, %d unmatched entries, %d unmatched issued ' \
+            'transactions' % (len(self.matched), len(self.unmatched_entries),
+                              len(self.unmatched_issued))
+
+
+class Matcher(object):
+    """
+    Matches statement entries with an IssuedLookup. `tolerance` is the
+    largest accepted difference between the amounts (e.g. for bank fees) of
+    the tolerant strategy; `days` limits all the strategies but the
+    end-to-end ID one to transactions created at most that many days
+    before the booking date.
+    """
+
+    def __init__(self, lookup, tolerance=Decimal('0.00'), days=None):
+        self.lookup = lookup
+        self.tolerance = tolerance
+        self.days = days
+
+    def in_window(self, position, entry):
+        "Check the creation date of an issued transaction."
+        if self.days is None or entry.booking_date is None:
+            return True
+        created = parse_date(self.lookup.items[position].created)
+        return created <= entry.booking_date <= \
+            created + timedelta(days=self.days)
+
+    def oldest(self, positions, entry):
+        """
+        Return the first candidate in the date window, or None; the
+        candidates come oldest first.
+        """
+        for position in positions:
+            if self.in_window(position, entry):
+                return position
+        return None
+
+    def eeid_match(self, entry, key):
+        "Return the unmatched item with an end-to-end ID and the amount."
+        items = self.lookup.items
+        for position in self.lookup.candidates(self.lookup.by_eeid, key):
+            item = items[position]
+            if item.amount == entry.amount and \
+                    entry.msg_id in (None, item.msg_id):
+                return [position]
+        return None
+
+    def by_eeid(self, entry):
+        "Exact strategy: same end-to-end ID and amount."
+        if entry.eeid is None:
+            return None
+        return self.eeid_match(entry, entry.eeid)
+
+    def eeid_in_text(self, entry):
+        "An end-to-end ID among the words of the entry's description."
+        if entry.eeid is not None or not entry.text:
+            return None
+        for key in TOKEN_RE.split(entry.text):
+            positions = self.eeid_match(entry, key)
+            if positions:
+                return positions
+        return None
+
+    def request_match(self, entry, key):
+        "Return the unmatched part of a request, if its total matches."
+        count, total = self.lookup.request_total(key)
+        if count < 2 or total != entry.amount:
+            return None
+        positions = list(self.lookup.candidates(self.lookup.by_msg_id, key))
+        if self.in_window(positions[0], entry):
+            return positions
+        return None
+
+    def by_request(self, entry):
+        "Batch booking: the total of the unmatched part of a request."
+        if entry.msg_id is None:
+            return None
+        return self.request_match(entry, entry.msg_id)
+
+    def request_in_text(self, entry):
+        "Batch booking of a request named in the entry's description."
+        if entry.msg_id is not None or not entry.text:
+            return None
+        for key in TOKEN_RE.split(entry.text):
+            positions = self.request_match(entry, key)
+            if positions:
+                return positions
+        return None
+
+    def by_amount_iban(self, entry):
+        "Exact strategy: same amount and creditor IBAN."
+        if entry.iban is None:
+            return None
+        position = self.oldest(self.lookup.candidates(
+            self.lookup.by_amount_iban, (entry.amount, entry.iban)), entry)
+        return [position] if position is not None else None
+
+    def tolerant(self, entry):
+        """
+        Tolerant strategy: the same creditor IBAN and an amount within the
+        tolerance or, for statements without IBANs, the same amount.
+        """
+        if entry.iban is not None:
+            positions = (
+                position for position in self.lookup.candidates(
+                    self.lookup.by_iban, entry.iban)
+                if abs(self.lookup.items[position].amount -
+                       entry.amount) <= self.tolerance)
+        else:
+            positions = self.lookup.candidates(self.lookup.by_amount,
+                                               entry.amount)
+        position = self.oldest(positions, entry)
+        return [position] if position is not None else None
+
+    def match(self, entry):
+        """
+        Return the strategy name and the matched positions for an entry, or
+        (None, None). The exact keys are tried before the words of the
+        description.
+        """
+        for name, strategy in (('eeid', self.by_eeid),
+                               ('request', self.by_request),
+                               ('amount_iban', self.by_amount_iban),
+                               ('eeid', self.eeid_in_text),
+                               ('request', self.request_in_text),
+                               ('tolerant', self.tolerant)):
+            positions = strategy(entry)
+            if positions:
+                return name, positions
+        return None, None
+
+
+def match_statement(entries, issued, tolerance=Decimal('0.00'), days=None):
+    """
+    Match statement entries (StatementEntry instances, e.g. from
+    `parse_cbi_rh()` or `parse_camt053()`) with the issued transactions
+    (IssuedTransaction instances, or an IssuedLookup). Each issued
+    transaction is matched at most once. Return a StatementReconciliation.
+
+    Entries are consumed in a single pass; only the issued transactions are
+    kept in memory.
+    """
+    lookup = issued if isinstance(issued, IssuedLookup) \
+        else IssuedLookup(issued)
+    matcher = Matcher(lookup, tolerance, days)
+    result = StatementReconciliation()
+    for entry in entries:
+        if not entry.debit:
+            result.ignored += 1
+            continue
+        strategy, positions = matcher.match(entry)
+        if strategy is None:
+            result.unmatched_entries.append(entry)
+            continue
+        for position in positions:
+            lookup.match(position)
+            result.matched.append((lookup.items[position], entry, strategy))
+    result.unmatched_issued = lookup.unmatched()
+    return result
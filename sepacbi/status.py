@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+"""
+Reconciliation of CBI payment status reports with the issued transactions.
+
+`parse_status_report()` reads a status report (`CBIPaymentStatusReport`,
+or any pain.002-like message) as a stream, yielding the status of each
+transaction without keeping the whole document in memory.
+
+`IssuedIndex` is an SQLite file that records every generated transaction by
+request ID (`MsgId`) and end-to-end ID; it is filled automatically when a
+payment with an `issued_index` attribute is written to a file object, or
+when `Payment.mark_issued()` is called. `reconcile()` joins the statuses
+with the index.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import sqlite3
+from collections import namedtuple
+from decimal import Decimal
+
+from lxml import etree
+
+# Status codes meaning that the transaction was not accepted
+REJECTED_STATUSES = ('RJCT', 'CANC')
+
+# Number of request IDs looked up in the index with a single query
+QUERY_CHUNK = 500
+
+TransactionStatus = namedtuple('TransactionStatus', (
+    'msg_id', 'eeid', 'instr_id', 'status', 'reason', 'amount'))
+TransactionStatus.__doc__ = """
+The status of a transaction in a status report. For a status of the whole
+request (`GrpSts`), `eeid` and `instr_id` are None.
+"""
+
+IssuedTransaction = namedtuple('IssuedTransaction', (
+    'msg_id', 'eeid', 'seq', 'amount', 'iban', 'creditor', 'created'))
+IssuedTransaction.__doc__ = "A transaction recorded in an IssuedIndex."
+
+
+def iter_issued_transactions(payment):
+    "Yield the IssuedTransactions for the transactions of a payment."
+    created = payment.get_creation_time().isoformat()
+    for txr in payment.transactions:
+        yield IssuedTransaction(payment.req_id, txr.eeid, txr.payment_seq,
+                                txr.amount, txr.account.iban,
+                                getattr(txr.creditor, 'name', None), created)
+
+
+def issued_transactions(payment):
+    "Return the IssuedTransactions for the transactions of a payment."
+    return list(iter_issued_transactions(payment))
+
+
+def is_rejected(status):
+    "Tell whether a TransactionStatus means that the transfer failed."
+    return status.status in REJECTED_STATUSES
+
+
+def child_text(element, *path):
+    "Return the text of a descendant by local names, ignoring namespaces."
+    for name in path:
+        for child in element:
+            if isinstance(child.tag, str) and \
+                    etree.QName(child).localname == name:
+                element = child
+                break
+        else:
+            return None
+    return element.text.strip() if element.text else None
+
+
+def parse_status_report(source):
+    """
+    Yield a TransactionStatus for each transaction of a status report read
+    from a file name or file object, and one for the status of each whole
+    request, if present. Parsed elements are discarded as soon as they have
+    been read.
+    """
+    msg_id = None
+    for _, element in etree.iterparse(
+            source, events=('end',),
+            tag=('{*}OrgnlGrpInfAndSts', '{*}TxInfAndSts')):
+        if etree.QName(element).localname == 'OrgnlGrpInfAndSts':
+            msg_id = child_text(element, 'OrgnlMsgId')
+            status = child_text(element, 'GrpSts')
+            if status is not None:
+                yield TransactionStatus(
+                    msg_id, None, None, status,
+                    child_text(element, 'StsRsnInf', 'Rsn', 'Cd'), None)
+        else:
+            amount = child_text(element, 'OrgnlTxRef', 'Amt', 'InstdAmt')
+            yield TransactionStatus(
+                msg_id, child_text(element, 'OrgnlEndToEndId'),
+                child_text(element, 'OrgnlInstrId'),
+                child_text(element, 'TxSts'),
+                child_text(element, 'StsRsnInf', 'Rsn', 'Cd'),
+                Decimal(amount) if amount is not None else None)
+        # Release the parsed elements.
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+class IssuedIndex(object):
+    """
+    An on-disk index of the issued transactions, keyed by request ID and
+    end-to-end ID, with a secondary index on the end-to-end ID alone.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS issued (
+                msg_id TEXT NOT NULL,
+                eeid TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                amount TEXT NOT NULL,
+                iban TEXT NOT NULL,
+                creditor TEXT,
+                created TEXT NOT NULL,
+                PRIMARY KEY (msg_id, eeid)
+            );
+            CREATE INDEX IF NOT EXISTS issued_eeid ON issued (eeid);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM issued').fetchone()[0]
+
+    def close(self):
+        "Close the database."
+        self.connection.close()
+
+    def record_payment(self, payment):
+        """
+        Record all the transactions of a payment. Generating the same request
+        again replaces its previous records.
+        """
+        rows = (issued[:3] + (str(issued.amount),) + issued[4:]
+                for issued in iter_issued_transactions(payment))
+        with self.connection:
+            self.connection.execute('DELETE FROM issued WHERE msg_id = ?',
+                                    (payment.req_id,))
+            self.connection.executemany(
+                'INSERT INTO issued VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    @staticmethod
+    def _issued(row):
+        "Turn a database row into an IssuedTransaction."
+        row = list(row)
+        row[3] = Decimal(row[3])
+        return IssuedTransaction(*row)
+
+    def get(self, msg_id, eeid):
+        "Return the IssuedTransaction for a request and end-to-end ID."
+        row = self.connection.execute(
+            'SELECT * FROM issued WHERE msg_id = ? AND eeid = ?',
+            (msg_id, eeid)).fetchone()
+        return self._issued(row) if row is not None else None
+
+    def find_eeid(self, eeid):
+        "Return the list of the IssuedTransactions with an end-to-end ID."
+        return [self._issued(row) for row in self.connection.execute(
+            'SELECT * FROM issued WHERE eeid = ?', (eeid,))]
+
+    def iter_created(self, start=None, end=None):
+        """
+        Yield the IssuedTransactions created between two dates or datetimes
+        (both included, and both optional), oldest first.
+        """
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append('created >= ?')
+            params.append(start.isoformat())
+        if end is not None:
+            # Dates include the whole day.
+            conditions.append('created <= ?')
+            params.append(end.isoformat() + (
+                '' if hasattr(end, 'hour') else 'T99'))
+        query = 'SELECT * FROM issued'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        for row in self.connection.execute(query + ' ORDER BY created, seq',
+                                           params):
+            yield self._issued(row)
+
+    def iter_requests(self, msg_ids):
+        "Yield the IssuedTransactions of some requests."
+        msg_ids = sorted(msg_ids)
+        for start in range(0, len(msg_ids), QUERY_CHUNK):
+            chunk = msg_ids[start:start + QUERY_CHUNK]
+            query = 'SELECT * FROM issued WHERE msg_id IN (%s) ' \
+                'ORDER BY msg_id, seq' % ', '.join('?' * len(chunk))
+            for row in self.connection.execute(query, chunk):
+                yield self._issued(row)
+
+
+class Reconciliation(object):
+    """
+    The outcome of `reconcile()`:
+
+    - `matched`: (IssuedTransaction, TransactionStatus) pairs;
+    - `unknown`: statuses that do not match any issued transaction;
+    - `pending`: issued transactions of the reported requests that have no
+      status yet.
+    """
+    def __init__(self):
+        self.matched = []
+        self.unknown = []
+        self.pending = []
+
+    @property
+    def rejected(self):
+        "The matched pairs whose transfer failed."
+        return [(issued, status) for issued, status in self.matched
+                if is_rejected(status)]
+
+    def summary(self):
+        "Return a human-readable summary."
+        return '%d matched (%d rejected), %d unknown, %d pending' % (
+            len(self.matched), len(self.rejected), len(self.unknown),
+            len(self.pending))
+
+
+def reconcile(statuses, index):
+    """
+    Match an iterable of TransactionStatus (e.g. from one or more calls to
+    `parse_status_report()`) with an IssuedIndex and return a
+    Reconciliation.
+
+    The statuses are loaded into a hash table keyed by request and
+    end-to-end ID; the issued transactions of the reported requests are
+    then scanned once. The latest status of a transaction wins; a status of
+    a whole request applies to its transactions without a status of their
+    own.
+    """
+    by_key = {}
+    by_request = {}
+    for status in statuses:
+        if status.eeid is None:
+            by_request[status.msg_id] = status
+        else:
+            by_key[(status.msg_id, status.eeid)] = status
+    msg_ids = set(by_request) | set(msg_id for msg_id, _ in by_key)
+
+    result = Reconciliation()
+    seen = set()
+    for issued in index.iter_requests(msg_ids):
+        seen.add(issued.msg_id)
+        status = by_key.pop((issued.msg_id, issued.eeid), None)
+        if status is None:
+            status = by_request.get(issued.msg_id)
+        if status is None:
+            result.pending.append(issued)
+        else:
+            result.matched.append((issued, status))
+    result.unknown = list(by_key.values()) + [
+        status for msg_id, status in by_request.items() if msg_id not in seen]
+    return result
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+
+"""
+Disk-backed storage of the transactions of a payment.
+
+A payment created with a `storage` attribute keeps its transactions in a
+TransactionStore instead of a list: only the most recently added ones are
+kept in memory, the others are pickled into an SQLite file, together with
+the index of the end-to-end IDs. The store behaves as a read-only sequence,
+so that the XML and CBI output is generated by reading the transactions
+back in sequence order, one at a time.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import atexit
+import os
+import sqlite3
+import tempfile
+import weakref
+from decimal import Decimal
+
+from six.moves import cPickle as pickle
+
+from .transaction import Transaction
+from .truncation import collecting
+
+# Number of transactions kept in memory before they are written to disk
+DEFAULT_MEMORY_BUDGET = 10000
+
+# Attributes of a transaction holding its parties
+PARTIES = ('ultimate_debtor', 'creditor', 'ultimate_creditor')
+
+# Attributes that point back to the payment; restored when reading
+PAYMENT_REFERENCES = ('payment', 'register_eeid_function')
+
+
+def remove_store(connection, path=None):
+    "Close the database of a store, and remove its file if `path` is given."
+    connection.close()
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+
+class Finalizer(object):
+    """
+    A minimal `weakref.finalize` for Python 2: calls `function(*args)` once,
+    when called, when `owner` is garbage collected or at exit.
+    """
+    pending = set()
+
+    def __init__(self, owner, function, *args):
+        self.function = function
+        self.args = args
+        self.ref = weakref.ref(owner, lambda ref: self())
+        self.pending.add(self)
+
+    def __call__(self):
+        if self in self.pending:
+            self.pending.discard(self)
+            self.function(*self.args)
+
+    @classmethod
+    def call_pending(cls):
+        "Call the finalizers still pending."
+        for finalizer in list(cls.pending):
+            finalizer()
+
+if not hasattr(weakref, 'finalize'):
+    atexit.register(Finalizer.call_pending)
+
+finalize = getattr(weakref, 'finalize', Finalizer)
+
+
+class StoreNotEmptyError(Exception):
+    """
+    Raised when a TransactionStore is opened on a file that already holds
+    transactions.
+    """
+
+
+class EeidIndex(object):
+    """
+    The set of the end-to-end IDs of a TransactionStore, kept on disk. Only
+    membership tests, iteration, `add()` and `discard()` are supported.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __contains__(self, eeid):
+        return self.connection.execute(
+            'SELECT 1 FROM eeids WHERE eeid = ?', (eeid,)).fetchone() \
+            is not None
+
+    def __iter__(self):
+        for row in self.connection.execute('SELECT eeid FROM eeids'):
+            yield row[0]
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM eeids').fetchone()[0]
+
+    def add(self, eeid):
+        "Add an end-to-end ID to the index."
+        self.connection.execute('INSERT INTO eeids VALUES (?)', (eeid,))
+
+    def discard(self, eeid):
+        "Remove an end-to-end ID from the index, if present."
+        self.connection.execute('DELETE FROM eeids WHERE eeid = ?', (eeid,))
+
+
+class TransactionStore(object):
+    """
+    A sequence of transactions backed by an SQLite file at `path` (a
+    temporary file, removed by `close()` or once the store is no longer
+    used, if None). A file that already holds transactions is refused with
+    StoreNotEmptyError. At most `memory_budget` transactions are kept in memory; the store also keeps the count and the
+    running total of the amounts.
+
+    Transactions written to disk are read back as new objects each time:
+    changes made to them after they have been added are not kept.
+    """
+
+    def __init__(self, path=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.temporary = path is None
+        if self.temporary:
+            handle, path = tempfile.mkstemp(suffix='.sqlite',
+                                            prefix='sepacbi-')
+            os.close(handle)
+        self.path = path
+        self.memory_budget = memory_budget
+        self.payment = None
+        self.buffer = []
+        self.count = 0
+        self.total = Decimal('0.00')
+        # The store can be read on another thread, e.g. by a pipeline's
+        # build stage, as long as it is used by one thread at a time.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                seq INTEGER PRIMARY KEY,
+                data BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS eeids (eeid TEXT PRIMARY KEY);
+        """)
+        self.eeid_set = EeidIndex(self.connection)
+        if self.connection.execute(
+                'SELECT COUNT(*) FROM transactions').fetchone()[0] or \
+                len(self.eeid_set):
+            self.connection.close()
+            raise StoreNotEmptyError(
+                'The transaction store %r is not empty' % path)
+        # A temporary store is removed even if it is never closed.
+        self.finalizer = finalize(self, remove_store, self.connection,
+                                  path if self.temporary else None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self.flush()
+        for row in self.connection.execute(
+                'SELECT data FROM transactions ORDER BY seq'):
+            yield self.load(row[0])
+        for txr in self.buffer:
+            yield txr
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('Transaction index out of range')
+        stored = self.count - len(self.buffer)
+        if index >= stored:
+            return self.buffer[index - stored]
+        row = self.connection.execute(
+            'SELECT data FROM transactions WHERE seq = ?',
+            (index + 1,)).fetchone()
+        return self.load(row[0])
+
+    def attach(self, payment):
+        "Bind the store to the payment that owns its transactions."
+        self.payment = payment
+
+    def append(self, txr):
+        """
+        Add a checked transaction, writing to disk when the budget is full.
+        The parties of the transaction are checked first, since the copies
+        written to disk cannot be changed later.
+        """
+        with collecting(*txr.truncation_collector()):
+            for attribute in PARTIES:
+                if hasattr(txr, attribute):
+                    getattr(txr, attribute).ensure_checked()
+        self.buffer.append(txr)
+        self.count += 1
+        self.total += txr.amount
+        if len(self.buffer) >= self.memory_budget:
+            self.flush()
+
+    def flush(self):
+        "Write the transactions kept in memory to disk."
+        if self.buffer:
+            start = self.count - len(self.buffer)
+            self.connection.executemany(
+                'INSERT INTO transactions VALUES (?, ?)',
+                [(start + position + 1, self.dump(txr))
+                 for position, txr in enumerate(self.buffer)])
+            self.buffer = []
+        self.connection.commit()
+
+    @staticmethod
+    def dump(txr):
+        "Pickle a transaction without its references to the payment."
+        state = dict((name, value) for name, value in txr.__dict__.items()
+                     if name not in PAYMENT_REFERENCES)
+        return sqlite3.Binary(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+    def load(self, data):
+        "Rebuild a pickled transaction, bound to the payment."
+        txr = Transaction.__new__(Transaction)
+        # Setting __dict__ directly keeps the transaction marked as checked.
+        txr.__dict__.update(pickle.loads(bytes(data)))
+        if self.payment is not None:
+            txr.__dict__['payment'] = self.payment
+            txr.__dict__['register_eeid_function'] = self.payment.add_eeid
+        return txr
+
+    def close(self):
+        """
+        Close the database, removing it if it is temporary. This also
+        happens when the store is garbage collected, or at exit.
+        """
+        self.finalizer()
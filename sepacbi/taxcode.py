@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+"""
+This module checks Italian tax codes: the 16-character codice fiscale of
+natural persons and the 11-digit partita IVA (also used as the codice
+fiscale of companies), with or without the IT prefix.
+
+The outcome of each check is remembered, so that the codes repeated across
+the transactions of a batch are only checked once.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import re
+import string
+
+# Letters may replace the digits of a codice fiscale (omocodia).
+CF_RE = re.compile(r'^[A-Z]{6}[0-9LMNPQRSTUV]{2}[A-EHLMPR-T][0-9LMNPQRSTUV]{2}'
+                   r'[A-Z][0-9LMNPQRSTUV]{3}[A-Z]$')
+
+PIVA_RE = re.compile(r'^\d{11}$')
+
+# Values of the characters in odd positions (1st, 3rd...) of a codice fiscale
+CF_ODD_VALUES = dict(zip(
+    string.digits + string.ascii_uppercase,
+    [1, 0, 5, 7, 9, 13, 15, 17, 19, 21] +
+    [1, 0, 5, 7, 9, 13, 15, 17, 19, 21, 2, 4, 18, 20, 11, 3, 6, 8, 12, 14,
+     16, 10, 22, 25, 24, 23]))
+
+# Values of the characters in even positions
+CF_EVEN_VALUES = dict(zip(string.digits + string.ascii_uppercase,
+                          list(range(10)) + list(range(26))))
+
+# Number of checked codes remembered before the memo is emptied
+MEMO_SIZE = 100000
+
+_MEMO = {}
+
+
+class InvalidTaxCodeError(Exception):
+    """
+    Raised when a tax code does not pass the formal checks.
+    """
+
+
+def cf_check_character(code):
+    "Return the check character for the first 15 characters of a cf."
+    total = sum(CF_ODD_VALUES[char] for char in code[0:15:2]) + \
+        sum(CF_EVEN_VALUES[char] for char in code[1:15:2])
+    return string.ascii_uppercase[total % 26]
+
+
+def piva_check_digit(code):
+    "Return the check digit for the first 10 digits of a partita IVA."
+    total = 0
+    for position, char in enumerate(code[:10]):
+        value = int(char)
+        if position % 2:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return str((10 - total % 10) % 10)
+
+
+def check_tax_code(code):
+    """
+    Return the reason why a tax code is invalid, or None if it is valid.
+    """
+    code = code.upper().replace(' ', '')
+    if len(code) == 13 and code.startswith('IT'):
+        code = code[2:]
+    if len(code) == 16:
+        if not CF_RE.match(code):
+            return 'Invalid codice fiscale structure: %r' % code
+        if cf_check_character(code) != code[15]:
+            return 'Invalid codice fiscale check character: %r' % code
+        return None
+    if len(code) == 11:
+        if not PIVA_RE.match(code):
+            return 'Invalid partita IVA structure: %r' % code
+        if piva_check_digit(code) != code[10]:
+            return 'Invalid partita IVA check digit: %r' % code
+        return None
+    return 'Invalid tax code length: %r' % code
+
+
+def tax_code_error(code):
+    "Memoized version of `check_tax_code()`."
+    try:
+        return _MEMO[code]
+    except KeyError:
+        if len(_MEMO) >= MEMO_SIZE:
+            _MEMO.clear()
+        error = _MEMO[code] = check_tax_code(code)
+        return error
+
+
+def validate_tax_code(code):
+    "Raise InvalidTaxCodeError if a tax code is not valid."
+    error = tax_code_error(code)
+    if error is not None:
+        raise InvalidTaxCodeError(error)
+
+
+def invalid_tax_codes(codes):
+    """
+    Check a sequence of tax codes (None items are skipped), each distinct
+    code only once. Return the list of (position, code, reason) triples
+    for the invalid ones.
+    """
+    errors = dict((code, tax_code_error(code))
+                  for code in set(codes) if code is not None)
+    return [(position, code, errors[code])
+            for position, code in enumerate(codes)
+            if code is not None and errors[code] is not None]
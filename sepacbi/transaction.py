@@ -9,12 +9,16 @@ __license__ = '3-clause BSD'
 
 from lxml import etree
 from decimal import Decimal
-from .util import AttributeCarrier
-from .bank import Bank
+from .util import AttributeCarrier, check
+from .bank import Bank, validate_bic
 from .account import Account
+from .rmtinfo import Remittance, USTRD_MAX_LENGTH
+from .charset import normalized
+from .truncation import caller_stacklevel, collecting
 from .cbibon_dom import TransferInfo, PayerIBANInfo, PayeeIBANInfo, \
     PayerInfo, PayeeInfo, PayeeAddress, PurposeInfo, StatusRequest
 import sys
+from warnings import warn
 
 if sys.version_info[0] >= 3:
     # pylint: disable=redefined-builtin
@@ -62,6 +66,30 @@ class Transaction(AttributeCarrier):
         "Generate a unique ID for the `EndToEndId` element."
         self.eeid = '%s-%06d' % (self.payment_id, self.payment_seq)
 
+    def lookup_bic(self):
+        """
+        Fill in the `bic` attribute from the payment's BIC directory, if any.
+        Raise MissingBICError if the BIC cannot be found.
+        """
+        # pylint: disable=attribute-defined-outside-init
+        directory = getattr(getattr(self, 'payment', None), 'bic_directory',
+                            None)
+        bic = None
+        if directory is not None:
+            bic = directory.bic_for_iban(self.account.iban)
+        if bic is None:
+            raise MissingBICError
+        self.bic = bic
+
+    def truncation_collector(self):
+        "Use the payment's collector, if any, for this transaction's row."
+        payment = getattr(self, 'payment', None)
+        collector = payment.get_truncations() if payment is not None \
+            else None
+        if collector is None:
+            return super(Transaction, self).truncation_collector()
+        return collector, self.payment_seq
+
     def perform_checks(self):
         "Check lengths and types for the attributes."
         # pylint: disable=access-member-before-definition
@@ -89,24 +117,44 @@ class Transaction(AttributeCarrier):
             self.account = Account(iban=self.account)
         if self.account.is_foreign():
             if not hasattr(self, 'bic'):
-                raise MissingBICError
-            bic_length = len(self.bic)
-            assert bic_length in (8, 11)
+                self.lookup_bic()
+            validate_bic(self.bic)
+        else:
+            directory = getattr(getattr(self, 'payment', None),
+                                'abi_directory', None)
+            if directory is not None:
+                directory.check_iban(self.account.iban)
 
         if hasattr(self, 'rmtinfo'):
-            assert not hasattr(self, 'docs')
-            assert len(self.rmtinfo) <= 140
+            check(not hasattr(self, 'docs'),
+                  'Cannot have both the rmtinfo and docs attributes')
+            check(len(self.rmtinfo) <= 140,
+                  'rmtinfo must be at most 140 characters long')
 
         if hasattr(self, 'docs'):
             for item in self.docs:
-                assert hasattr(item, '__str__')
+                check(hasattr(item, '__str__'), 'Invalid document: %r' % item)
+
+        check(hasattr(self, 'docs') or hasattr(self, 'rmtinfo'),
+              'Either rmtinfo or docs must be supplied')
 
-        assert hasattr(self, 'docs') or hasattr(self, 'rmtinfo')
+        if getattr(getattr(self, 'payment', None), 'check_tax_codes', False):
+            for attribute in ('ultimate_debtor', 'creditor',
+                              'ultimate_creditor'):
+                if hasattr(self, attribute):
+                    getattr(self, attribute).check_tax_code()
 
     def emit_tag(self):
         """
-        Returns the XML tag for the transaction.
+        Returns the XML tag for the transaction. Truncations of the parties'
+        attributes are recorded for this transaction's row.
         """
+        collector, row = self.truncation_collector()
+        with collecting(collector, row):
+            return self.build_tag()
+
+    def build_tag(self):
+        "Build the XML tag for the transaction."
         root = etree.Element('CdtTrfTxInf')
         pmtid = etree.SubElement(root, 'PmtId')
         etree.SubElement(pmtid, 'InstrId').text = self.tx_id
@@ -117,45 +165,82 @@ class Transaction(AttributeCarrier):
         amt = etree.SubElement(root, 'Amt')
         etree.SubElement(
             amt, 'InstdAmt', attrib={'Ccy': 'EUR'}).text = str(self.amount)
+        normalizer = getattr(getattr(self, 'payment', None), 'normalizer',
+                             None)
         if hasattr(self, 'ultimate_debtor'):
-            root.append(self.ultimate_debtor.__tag__('UltmtDbtr'))
+            root.append(self.ultimate_debtor.__tag__(
+                'UltmtDbtr', normalizer=normalizer))
         if self.account.is_foreign():
             agt = etree.SubElement(root, 'CdtrAgt')
             agt.append(Bank(bic=self.bic).__tag__())
-        root.append(self.creditor.__tag__('Cdtr'))
+        root.append(self.creditor.__tag__('Cdtr', normalizer=normalizer))
         root.append(self.account.__tag__('CdtrAcct'))
         if hasattr(self, 'ultimate_creditor'):
-            root.append(self.ultimate_creditor.__tag__('UltmtCdtr'))
+            root.append(self.ultimate_creditor.__tag__(
+                'UltmtCdtr', normalizer=normalizer))
         rmtinf = etree.SubElement(root, 'RmtInf')
-        if hasattr(self, 'rmtinfo'):
-            etree.SubElement(rmtinf, 'Ustrd').text = self.rmtinfo
-        else:
-            etree.SubElement(rmtinf, 'Ustrd').text = ''.join(
-                [str(doc) for doc in self.docs])
+        etree.SubElement(rmtinf, 'Ustrd').text = normalized(
+            normalizer, self.ustrd(), 'rmtinfo', USTRD_MAX_LENGTH)
         return root
 
+    def ustrd(self):
+        """
+        Return the unstructured remittance information for the XML output.
+        Documents whose text is too long are truncated, and the truncation
+        is recorded like those of the attributes.
+        """
+        text = self.remittance().text()
+        if len(text) > USTRD_MAX_LENGTH:
+            collector, row = self.truncation_collector()
+            if collector is None:
+                warn('Remittance information too long; truncating',
+                     stacklevel=caller_stacklevel())
+            else:
+                collector.record(self, 'docs', text, USTRD_MAX_LENGTH, row)
+            text = text[:USTRD_MAX_LENGTH]
+        return text
+
     def cbi_records(self, prog=None):
-        if self.account.is_foreign():
-            raise Exception('Cannot use a foreign IBAN with CBI text files')
+        "Return the formatted CBI text records for the transaction."
+        return [record.format() for record in self.cbi_record_objects(prog)]
 
-        records = []
+    def remittance(self):
+        "Return the remittance information, ready to be segmented."
+        if hasattr(self, 'rmtinfo'):
+            return Remittance(rmtinfo=self.rmtinfo)
+        return Remittance(docs=self.docs)
 
-        xinfo = TransferInfo()
-        xinfo.prog_number = prog
-        if hasattr(self.payment, 'execution_date'):
-            xinfo.execution_date = self.payment.execution_date
+    def cbi_record_count(self):
+        "Return the number of CBI text records for the transaction."
+        # Records 10, 16, 17, 20, 30, the remittance records and 70
+        return 6 + self.remittance().cbi_record_count()
+
+    def cbi_purpose_code(self):
+        "Return the CBI purpose code for record 10."
         # TODO: allow generic codes for salaries, pensions
         if hasattr(self, 'cbi_purpose'):
-            xinfo.purpose = self.cbi_purpose
+            return self.cbi_purpose
         elif hasattr(self, 'category'):
             if self.category in CATEGORY_CBI_MAP:
-                xinfo.purpose = CATEGORY_CBI_MAP[self.category]
+                return CATEGORY_CBI_MAP[self.category]
             else:
                 raise Exception('Cannot map cateogry %r; please supply the '
                                 '\'cbi_purpose\' attribute' % self.category)
         else:
-            xinfo.purpose = '48000'
+            return '48000'
 
+    def cbi_record_objects(self, prog=None):
+        "Return the CBI text records for the transaction, not yet formatted."
+        if self.account.is_foreign():
+            raise Exception('Cannot use a foreign IBAN with CBI text files')
+
+        records = []
+
+        xinfo = TransferInfo()
+        xinfo.prog_number = prog
+        if hasattr(self.payment, 'execution_date'):
+            xinfo.execution_date = self.payment.execution_date
+        xinfo.purpose = self.cbi_purpose_code()
         xinfo.amount = self.amount
         xinfo.ord_abi = self.payment.bank.abi
         xinfo.ord_cab = self.payment.cab
@@ -163,38 +248,38 @@ class Transaction(AttributeCarrier):
         if hasattr(self.payment, 'high_priority'):
             if self.payment.high_priority:
                 xinfo.prio = 'U'
-        records.append(xinfo.format())
+        records.append(xinfo)
 
         ord_iban = PayerIBANInfo()
         ord_iban.prog_number = prog
         ord_iban.iban = self.payment.account.iban
-        records.append(ord_iban.format())
+        records.append(ord_iban)
 
         ben_iban = PayeeIBANInfo()
         ben_iban.prog_number = prog
         ben_iban.iban = self.account.iban
-        records.append(ben_iban.format())
+        records.append(ben_iban)
 
         ord_info = PayerInfo()
         ord_info.prog_number = prog
         ord_info.name = self.payment.debtor.name
         ord_info.tax_code = self.payment.debtor.cf
-        records.append(ord_info.format())
+        records.append(ord_info)
 
         ben_info = PayeeInfo()
         ben_info.prog_number = prog
         ben_info.name = self.creditor.name
         if hasattr(self.creditor, 'cf'):
             ben_info.tax_code = self.creditor.cf
-        records.append(ben_info.format())
+        records.append(ben_info)
 
         # Record 40 is not written
-        records += self.rmt_cbi_records(prog=prog)
+        records += self.rmt_cbi_record_objects(prog=prog)
 
         # The status request record is empty
         status_req = StatusRequest()
         status_req.prog_number = prog
-        records.append(status_req.format())
+        records.append(status_req)
 
         return records
 
@@ -207,43 +292,18 @@ class Transaction(AttributeCarrier):
         return record
 
     def rmt_cbi_records(self, prog):
-        records = []
-        if hasattr(self, 'rmtinfo'):
-            if len(self.rmtinfo) <= 90:
-                record = PurposeInfo()
-                record.prog_number = prog
-                record.desc = self.rmtinfo
-                records += [record.format()]
-            else:
-                start = 0
-                while start < len(self.rmtinfo):
-                    records += [self.rmtinfo_record('60', prog,
-                        self.rmtinfo[start:start+90]).format()]
-                start += 90
-        else:
-            record_type = '60'
-            if len(self.docs) <= 3:
-                record_type = '50'
-            i = 0
-            line = ''
-            while i < len(self.docs):
-                line += self.docs[i].cbi()
-                if i % 3 == 2:
-                    records.append(self.rmtinfo_record(record_type, prog, line
-                        ).format())
-                    line = ''
-                i += 1
-            if line != '':
-                records.append(self.rmtinfo_record(record_type, prog, line
-                    ).format())
-            if len(records) > 5:
-                raise Exception('Too many documents for remittance info')
-        return records
-
-
-            
-
-
-
+        "Return the formatted CBI remittance records (50/60)."
+        return [record.format()
+                for record in self.rmt_cbi_record_objects(prog)]
 
+    def rmt_cbi_record_objects(self, prog):
+        "Return the CBI remittance records (50/60), not yet formatted."
+        return [self.rmtinfo_record(record_type, prog, line)
+                for record_type, line in self.rmt_cbi_segments()]
 
+    def rmt_cbi_segments(self):
+        """
+        Return the (record type, description) pairs of the CBI remittance
+        records.
+        """
+        return self.remittance().cbi_segments()
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+"""
+Collection of the truncations made while checking the attributes of a
+payment.
+
+Without a collector, each truncated attribute emits a warning. A payment
+with a `truncations` attribute (a TruncationCollector, or one of the mode
+names) records them instead, with counts per attribute and per transaction
+and a few examples. The truncations are kept by the objects and recorded
+each time they are rendered, so that parties, which may be shared among
+payments and are only checked once, appear in the collector of every
+payment they are rendered into; they find it through `collecting()`.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from warnings import warn
+
+MODES = ('warn', 'collect', 'raise')
+
+_context = threading.local()
+
+
+class TruncationError(Exception):
+    """
+    Raised when an attribute is too long and the collector does not allow
+    truncating it.
+    """
+
+
+class TruncationCollector(object):
+    """
+    Records the truncated attributes. `mode` is one of:
+
+    - 'warn': count the truncations, and warn once per class and attribute;
+    - 'collect': only count them;
+    - 'raise': raise TruncationError at the first one.
+
+    `counts` maps (class name, attribute) pairs to the number of
+    truncations, `rows` maps the transaction sequence numbers to theirs and
+    `examples` keeps up to `max_examples` (row, original value) pairs for
+    each attribute.
+    """
+
+    def __init__(self, mode='warn', max_examples=3):
+        if mode not in MODES:
+            raise ValueError('Invalid truncation mode: %r' % mode)
+        self.mode = mode
+        self.max_examples = max_examples
+        self.counts = {}
+        self.rows = {}
+        self.examples = {}
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def record(self, obj, attribute_name, value, length, row=None):
+        "Record the truncation of an attribute of `obj` to `length`."
+        key = (obj.__class__.__name__, attribute_name)
+        if self.mode == 'raise':
+            raise TruncationError(
+                'Attribute %r of %s is longer than %d characters%s' % (
+                    attribute_name, key[0], length,
+                    ' (transaction %s)' % row if row is not None else ''))
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if row is not None:
+            self.rows[row] = self.rows.get(row, 0) + 1
+        if count < self.max_examples:
+            self.examples.setdefault(key, []).append((row, value))
+        if count == 0 and self.mode == 'warn':
+            warn('Attribute %r of %s too long; truncating (further '
+                 'truncations are only counted)' % (attribute_name, key[0]),
+                 stacklevel=caller_stacklevel())
+
+    def report(self):
+        "Return a human-readable summary of the truncations."
+        lines = ['%d attributes truncated in %d transactions' % (
+            len(self), len(self.rows))]
+        for key in sorted(self.counts):
+            lines.append('  %s.%s: %d' % (key[0], key[1], self.counts[key]))
+            for row, value in self.examples.get(key, ()):
+                lines.append('    %s%r' % (
+                    '#%s: ' % row if row is not None else '', value))
+        return '\n'.join(lines)
+
+
+def caller_stacklevel():
+    """
+    Return the `stacklevel` for a warning issued by the caller, pointing at
+    the innermost frame outside of this package.
+    """
+    package = os.path.dirname(os.path.abspath(__file__))
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    level = 1
+    while frame is not None and os.path.abspath(
+            frame.f_code.co_filename).startswith(package + os.sep):
+        frame = frame.f_back
+        level += 1
+    return level
+
+
+def as_collector(value):
+    "Return a TruncationCollector for a collector or a mode name."
+    if isinstance(value, TruncationCollector):
+        return value
+    return TruncationCollector(value)
+
+
+@contextmanager
+def collecting(collector, row=None):
+    """
+    Make `collector` record the truncations of the attributes checked
+    within the context, attributing them to transaction `row`. A None
+    collector restores the default warnings.
+    """
+    stack = _context.__dict__.setdefault('stack', [])
+    stack.append((collector, row))
+    try:
+        yield collector
+    finally:
+        stack.pop()
+
+
+def active_collector():
+    "Return the (collector, row) pair of the innermost `collecting()`."
+    stack = getattr(_context, 'stack', None)
+    if not stack:
+        return None, None
+    return stack[-1]
@@ -11,6 +11,8 @@ __license__ = '3-clause BSD'
 from warnings import warn
 import sys
 
+from .truncation import active_collector, caller_stacklevel
+
 
 if sys.version_info[0] >= 3:
     # pylint: disable=redefined-builtin
@@ -19,6 +21,22 @@ if sys.version_info[0] >= 3:
     basestring = str
 
 
+class ValidationError(AssertionError):
+    """
+    Raised when an attribute does not pass the validity checks.
+
+    The checks used to be `assert` statements; deriving from AssertionError
+    keeps the code that caught them working, while explicit checks are not
+    skipped under `python -O`.
+    """
+
+
+def check(condition, message):
+    "Raise ValidationError with the given message if the condition is false."
+    if not condition:
+        raise ValidationError(message)
+
+
 class AttributeCarrier(object):
     """
     Base class that provides utility methods.
@@ -28,7 +46,8 @@ class AttributeCarrier(object):
     as keyword arguments.
 
     Also, utility methods are provided to check the validity of the attributes
-    and emit XML trees for the represented objects.
+    and emit XML trees for the represented objects. Objects remember that
+    they passed the checks until one of their attributes is set again.
     """
     # pylint: disable=no-member
 
@@ -49,25 +68,77 @@ class AttributeCarrier(object):
             raise TypeError('Invalid keyword arguments: %s' % kwargs.keys())
         return kwargs
 
+    def __setattr__(self, name, value):
+        """
+        Setting a public attribute marks the object as not yet validated.
+        """
+        if not name.startswith('_'):
+            self.__dict__['_checked'] = False
+            self.__dict__.get('_truncations', {}).pop(name, None)
+        super(AttributeCarrier, self).__setattr__(name, value)
+
+    def ensure_checked(self):
+        """
+        Perform the validity checks, unless they have already succeeded and
+        no attribute has been set since then.
+        """
+        if not self.__dict__.get('_checked', False):
+            self.perform_checks()
+            # The checks may normalize attributes; mark the object as valid
+            # only once they are over.
+            self.__dict__['_checked'] = True
+
     def __tag__(self, *args, **kwargs):
         """
         Return a XML tag for the object, after performing all the validity
         checks.
         """
-        self.perform_checks()
+        self.ensure_checked()
+        self.report_truncations()
         return self.emit_tag(*args, **kwargs)
 
+    def truncation_collector(self):
+        """
+        Return the TruncationCollector recording the truncations of this
+        object's attributes, if any, and the sequence number of their
+        transaction.
+        """
+        return active_collector()
+
+    def report_truncations(self):
+        """
+        Record the truncations of this object's attributes with the current
+        collector, if any. Called each time the object is rendered.
+        """
+        collector, row = self.truncation_collector()
+        if collector is not None:
+            truncations = self.__dict__.get('_truncations', {})
+            for attribute_name in sorted(truncations):
+                value, length = truncations[attribute_name]
+                collector.record(self, attribute_name, value, length, row)
+
     def max_length(self, attribute_name, length, obj=None):
-        "Check that an attribute fits into the field length."
+        """
+        Check that an attribute fits into the field length. A truncated
+        attribute is kept by its object, to be recorded when it is rendered
+        (see `report_truncations()`); without a collector, it is warned
+        about at once.
+        """
         if obj is None:
             obj = self
         value = unicode(getattr(obj, attribute_name))
         if len(value) < 1:
             raise Exception('Attribute %r cannot be empty' % attribute_name)
         if len(value) > length:
-            warn('Attribute %r too long; truncating' % attribute_name,
-                 stacklevel=4)
+            collector, row = self.truncation_collector()
+            if collector is None:
+                warn('Attribute %r too long; truncating' % attribute_name,
+                     stacklevel=caller_stacklevel())
+            elif collector.mode == 'raise':
+                collector.record(obj, attribute_name, value, length, row)
             setattr(obj, attribute_name, value[:length])
+            obj.__dict__.setdefault('_truncations', {})[attribute_name] = \
+                (value, length)
         else:
             setattr(obj, attribute_name, value)
 
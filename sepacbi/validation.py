@@ -0,0 +1,289 @@
+#!/usr/bin/python
+
+"""
+Whole-batch validation: check every transaction, party, account and BIC of a
+payment (or of a list of transactions still to be added) and collect all
+the problems into a single report, instead of stopping at the first one.
+
+Transactions are checked in chunks, optionally in a process pool.
+"""
+
+__copyright__ = 'Copyright (c) 2014 Emanuele Pucciarelli, C.O.R.P. s.n.c.'
+__license__ = '3-clause BSD'
+
+import copy
+
+from .transaction import Transaction
+from .taxcode import invalid_tax_codes
+
+# Number of transactions sent to a worker process at once
+CHUNK_SIZE = 1000
+
+# Attributes of a transaction holding its parties
+PARTIES = ('ultimate_debtor', 'creditor', 'ultimate_creditor')
+
+
+class ValidationIssue(object):
+    """
+    A single problem: the row (the transaction's sequence number, or None
+    for the payment itself), the object it was found on, the exception
+    class name and the message.
+    """
+    def __init__(self, row, target, error, message):
+        self.row = row
+        self.target = target
+        self.error = error
+        self.message = message
+
+    def __repr__(self):
+        return '<ValidationIssue %s>' % self
+
+    def __str__(self):
+        where = 'payment' if self.row is None else 'row %d' % self.row
+        return '%s, %s: %s: %s' % (where, self.target, self.error,
+                                   self.message)
+
+
+class ValidationReport(object):
+    """
+    The outcome of a whole-batch validation: the list of issues, sorted by
+    row, and the number of checked transactions.
+    """
+    def __init__(self, issues, checked):
+        self.issues = sorted(issues, key=lambda issue: (
+            issue.row is not None, issue.row or 0))
+        self.checked = checked
+
+    @property
+    def ok(self):
+        "Whether no problem was found."
+        return len(self.issues) == 0
+
+    def __len__(self):
+        return len(self.issues)
+
+    def __iter__(self):
+        return iter(self.issues)
+
+    def rows(self):
+        "Return the sorted list of the rows with at least one problem."
+        return sorted(set(issue.row for issue in self.issues
+                          if issue.row is not None))
+
+    def summary(self):
+        "Return a human-readable report."
+        lines = ['%d transactions checked, %d problems in %d rows' % (
+            self.checked, len(self.issues), len(self.rows()))]
+        lines += ['  %s' % issue for issue in self.issues]
+        return '\n'.join(lines)
+
+
+def run_check(issues, row, target, function, *args):
+    "Run a check, recording its failure as an issue. Return its success."
+    try:
+        function(*args)
+    except Exception as exc:  # pylint: disable=broad-except
+        issues.append(ValidationIssue(row, target, exc.__class__.__name__,
+                                      str(exc)))
+        return False
+    return True
+
+
+def check_transaction(txr, row):
+    """
+    Check a transaction together with its account, parties and BIC. Return
+    the list of issues.
+    """
+    issues = []
+    if not run_check(issues, row, 'transaction', txr.perform_checks):
+        return issues
+    run_check(issues, row, 'account', txr.account.perform_checks)
+    for attribute in ('creditor', 'ultimate_debtor', 'ultimate_creditor'):
+        if hasattr(txr, attribute):
+            run_check(issues, row, attribute,
+                      getattr(txr, attribute).perform_checks)
+    run_check(issues, row, 'remittance', txr.remittance().ustrd)
+    return issues
+
+
+def check_chunk(chunk):
+    """
+    Check a chunk of (row, transaction or add_transaction() arguments) pairs.
+    This runs in the worker processes.
+    """
+    issues = []
+    for row, item in chunk:
+        if isinstance(item, dict):
+            kwargs = dict(item, payment_seq=row, payment_id='')
+            try:
+                item = Transaction(**kwargs)
+            except Exception as exc:  # pylint: disable=broad-except
+                issues.append(ValidationIssue(
+                    row, 'transaction', exc.__class__.__name__, str(exc)))
+                continue
+            # Uniqueness of the end-to-end IDs is checked by the caller.
+            item.eeid_registered = True
+        issues += check_transaction(item, row)
+    return issues
+
+
+def detach(txr):
+    """
+    Return a copy of a transaction without the references to its payment,
+    so that it can be sent to a worker process on its own.
+    """
+    detached = copy.copy(txr)
+    detached.__dict__.pop('payment', None)
+    detached.__dict__.pop('register_eeid_function', None)
+    detached.eeid_registered = True
+    return detached
+
+
+def check_payment(payment):
+    "Check the payment-level attributes. Return the list of issues."
+    issues = []
+    run_check(issues, None, 'payment', payment.perform_checks)
+    for attribute in ('debtor', 'initiator', 'ultimate_debtor', 'account',
+                      'charges_account'):
+        value = getattr(payment, attribute, None)
+        if hasattr(value, 'perform_checks'):
+            run_check(issues, None, attribute, value.perform_checks)
+    return issues
+
+
+def directory_issues(payment, items):
+    """
+    Fill in the missing BICs and check the ABI/CAB codes of a list of
+    (row, transaction) pairs with the payment's directories, in bulk.
+    """
+    issues = []
+    bic_directory = getattr(payment, 'bic_directory', None)
+    if bic_directory is not None:
+        missing = [(row, txr) for row, txr in items
+                   if txr.account.is_foreign() and not hasattr(txr, 'bic')]
+        bics = bic_directory.bics_for_ibans(
+            [txr.account.iban for _, txr in missing])
+        for (row, txr), bic in zip(missing, bics):
+            if bic is not None:
+                txr.bic = bic
+
+    abi_directory = getattr(payment, 'abi_directory', None)
+    if abi_directory is not None:
+        ibans = [txr.account.iban for _, txr in items]
+        for position, iban in abi_directory.unknown_ibans(ibans):
+            issues.append(ValidationIssue(
+                items[position][0], 'account', 'UnknownBankCodeError',
+                'Unknown ABI/CAB codes in %s' % iban))
+    return issues
+
+
+def tax_code_issues(rows, parties, target):
+    """
+    Check the Italian tax codes of a list of parties (None items are
+    skipped) in bulk, each distinct code only once. `rows` are the rows of
+    the parties.
+    """
+    codes = [u'%s' % party.cf
+             if hasattr(party, 'cf') and
+             getattr(party, 'country', 'IT') == 'IT' else None
+             for party in parties]
+    return [ValidationIssue(rows[position], target, 'InvalidTaxCodeError',
+                            reason)
+            for position, _, reason in invalid_tax_codes(codes)]
+
+
+def run_chunks(chunks, jobs):
+    "Check the chunks, in a process pool if `jobs` is more than one."
+    if jobs is None or jobs <= 1 or len(chunks) <= 1:
+        return [check_chunk(chunk) for chunk in chunks]
+    from multiprocessing import Pool
+    pool = Pool(min(jobs, len(chunks)))
+    try:
+        results = pool.map(check_chunk, chunks)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+
+def split(items, size):
+    "Split a list into chunks of at most `size` items."
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def validate_payment(payment, jobs=None, chunk_size=CHUNK_SIZE):
+    """
+    Check a payment and all of its transactions; return a ValidationReport.
+    """
+    issues = check_payment(payment)
+    items = [(txr.payment_seq, detach(txr)) for txr in payment.transactions]
+    issues += directory_issues(payment, items)
+    if getattr(payment, 'check_tax_codes', False):
+        rows = [row for row, _ in items]
+        for attribute in PARTIES:
+            issues += tax_code_issues(
+                rows, [getattr(txr, attribute, None) for _, txr in items],
+                attribute)
+    for chunk_issues in run_chunks(split(items, chunk_size), jobs):
+        issues += chunk_issues
+    return ValidationReport(issues, len(items))
+
+
+def validate_transactions(payment, rows, jobs=None, chunk_size=CHUNK_SIZE):
+    """
+    Check a list of keyword argument dictionaries, as they would be passed
+    to `payment.add_transaction()`, without adding them. Rows are numbered
+    from 1. Return a ValidationReport.
+    """
+    issues = []
+    items = []
+    seen = {}
+    for row, kwargs in enumerate(rows, 1):
+        eeid = kwargs.get('eeid')
+        if eeid is not None:
+            if eeid in seen or eeid in payment.eeid_set:
+                issues.append(ValidationIssue(
+                    row, 'transaction', 'InvalidEndToEndIDError',
+                    'Duplicate end-to-end ID: %r' % eeid))
+            seen[eeid] = row
+        items.append((row, kwargs))
+
+    # The directories cannot be sent to the worker processes; use them here.
+    bic_directory = getattr(payment, 'bic_directory', None)
+    abi_directory = getattr(payment, 'abi_directory', None)
+    if bic_directory is not None or abi_directory is not None:
+        accounts = []
+        for row, kwargs in items:
+            account = kwargs.get('account')
+            if hasattr(account, 'upper'):
+                account = account.upper().replace(' ', '')
+                accounts.append((row, account))
+        if bic_directory is not None:
+            positions = dict((row, idx) for idx, (row, _) in
+                             enumerate(items))
+            missing = [(row, iban) for row, iban in accounts
+                       if iban[:2] not in ('IT', 'SM') and
+                       'bic' not in items[positions[row]][1]]
+            bics = bic_directory.bics_for_ibans([iban for _, iban in missing])
+            for (row, _), bic in zip(missing, bics):
+                if bic is not None:
+                    idx = positions[row]
+                    items[idx] = (row, dict(items[idx][1], bic=bic))
+        if abi_directory is not None:
+            for position, iban in abi_directory.unknown_ibans(
+                    [iban for _, iban in accounts]):
+                issues.append(ValidationIssue(
+                    accounts[position][0], 'account', 'UnknownBankCodeError',
+                    'Unknown ABI/CAB codes in %s' % iban))
+
+    if getattr(payment, 'check_tax_codes', False):
+        rows = [row for row, _ in items]
+        for attribute in PARTIES:
+            issues += tax_code_issues(
+                rows, [kwargs.get(attribute) for _, kwargs in items],
+                attribute)
+
+    for chunk_issues in run_chunks(split(items, chunk_size), jobs):
+        issues += chunk_issues
+    return ValidationReport(issues, len(items))
@@ -33,5 +33,8 @@ setup(
     platforms="All",
     packages=find_packages("."),
     install_requires=['lxml', 'six', 'unidecode'],
+    entry_points={
+        'console_scripts': ['sepacbi = sepacbi.cli:main'],
+    },
     zip_safe=True
 )
@@ -154,3 +154,165 @@ def test_dup_e2eid():
     with pytest.raises(InvalidEndToEndIDError):
         payment.add_transaction(amount=2, creditor=beta, account=acct_37,
                                 eeid='Test1', rmtinfo='B')
+
+
+def test_document_render_cache():
+    from datetime import date
+    doc = Invoice(18512, 4500)
+    assert str(doc) == '/CINV/18512/ 4500.00'
+    assert doc.cbi() == '%24s      ' % 18512
+    assert doc.rendered('eact', None) == '/CINV/18512/ 4500.00'
+
+    doc.amount = 12.5
+    doc.date = date(2014, 5, 15)
+    assert str(doc) == '/CINV/18512/ 12.50/ 20140515'
+    assert doc.cbi() == '%24s15052014' % 18512
+
+
+def test_validate_once(monkeypatch):
+    "Objects that passed the checks are not checked again until changed."
+    from sepacbi.account import Account
+    payment = simple_payment()
+    payment.add_transaction(amount=1, account=acct_86, creditor=beta,
+                            rmtinfo='Test')
+    payment.xml()
+
+    calls = []
+    original = Account.perform_checks
+
+    def counting_checks(self):
+        calls.append(self.iban)
+        original(self)
+    monkeypatch.setattr(Account, 'perform_checks', counting_checks)
+
+    payment.xml()
+    assert calls == []
+
+    payment.transactions[0].account.iban = acct_37
+    payment.xml()
+    assert calls == [acct_37]
+
+    payment.transactions[0].account.iban = 'IT00INVALID'
+    with pytest.raises(InvalidIBANError):
+        payment.xml()
+    with pytest.raises(InvalidIBANError):
+        payment.xml()
+
+
+def test_charset_normalization():
+    from sepacbi.charset import SEPANormalizer
+    normalizer = SEPANormalizer()
+    assert normalizer.normalize(u'Caff\xe8 & M\xfcller \u2013 #1', 'name') \
+        == u'Caffe + Muller - .1'
+    assert normalizer.normalize(u'Plain text', 'name') == u'Plain text'
+    assert normalizer.replacements[(u'&', u'+')] == 1
+    assert normalizer.fields == {'name': 1}
+
+    creditor = IdHolder(name=u'Gro\xdfe & S\xf6hne', cf='01234567890',
+                        address=[u'Stra\xdfe 1', u'Z\xfcrich'])
+    payment = Payment(debtor=biz_with_cuc, account=acct_37,
+                      normalizer=True)
+    payment.add_transaction(amount=1, account=acct_86, creditor=creditor,
+                            rmtinfo=u'Fattura n\xb0 1 \u20ac')
+    xml = payment.xml_text(encoding='UTF-8')
+    assert b'<Nm>Grosse + Sohne</Nm>' in xml
+    assert b'<AdrLine>Zurich</AdrLine>' in xml
+    assert b'<Ustrd>Fattura n. 1 EUR</Ustrd>' in xml
+    assert payment.normalizer.fields == {'name': 1, 'address': 2,
+                                         'rmtinfo': 1}
+    assert 'characters replaced in 4 texts' in payment.normalizer.report()
+
+    # Without a normalizer, the text is left as it is
+    payment = Payment(debtor=biz_with_cuc, account=acct_37)
+    payment.add_transaction(amount=1, account=acct_86, creditor=creditor,
+                            rmtinfo='Test')
+    assert u'Gro\xdfe'.encode('utf-8') in payment.xml_text(encoding='UTF-8')
+
+
+def test_truncation_collector():
+    import warnings
+    from sepacbi.truncation import TruncationError
+
+    def build(truncations):
+        payment = Payment(debtor=biz_with_cuc, account=acct_37,
+                          req_id='Truncations', truncations=truncations)
+        for i in range(3):
+            creditor = IdHolder(name='Creditor %d ' % i + 'x' * 70)
+            payment.add_transaction(amount=1, account=acct_86,
+                                    creditor=creditor, rmtinfo='Test',
+                                    eeid='E%d' % i + 'y' * 40)
+        return payment
+
+    payment = build('collect')
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        payment.xml_text()
+    assert caught == []
+    collector = payment.truncations
+    assert collector.counts == {('Transaction', 'eeid'): 3,
+                                ('IdHolder', 'name'): 3}
+    assert collector.rows == {1: 2, 2: 2, 3: 2}
+    assert len(collector) == 6
+    assert collector.examples[('IdHolder', 'name')][0] == \
+        (1, 'Creditor 0 ' + 'x' * 70)
+    assert 'IdHolder.name: 3' in collector.report()
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        payment = build('warn')
+        payment.xml_text()
+    assert len(caught) == 2
+    assert len(payment.truncations) == 6
+
+    with pytest.raises(TruncationError):
+        build('raise')
+
+
+def test_long_documents_truncated():
+    import warnings
+    from datetime import date
+    payment = Payment(debtor=biz_with_cuc, account=acct_37,
+                      req_id='LongDocs', truncations='collect')
+    payment.add_transaction(amount=1, account=acct_86, creditor=alpha,
+                            docs=[Invoice(n, 1, date(2014, 1, 1))
+                                  for n in range(1, 8)])
+    root = payment.xml()
+    ustrd = root.xpath('//*[local-name()="Ustrd"]/text()')
+    assert [len(text) for text in ustrd] == [140]
+    assert payment.truncations.counts == {('Transaction', 'docs'): 1}
+
+    del payment.truncations
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        payment.xml_text()
+    assert len(caught) == 1
+
+
+def test_truncations_of_shared_parties():
+    import io
+    import warnings
+    creditor = IdHolder(name='Shared ' + 'x' * 70)
+
+    def build(req_id):
+        payment = Payment(debtor=biz_with_cuc, account=acct_37,
+                          req_id=req_id, truncations='collect')
+        payment.add_transaction(amount=1, account=acct_86,
+                                creditor=creditor, rmtinfo='Test')
+        return payment
+
+    first = build('First')
+    second = build('Second')
+    first.xml_text()
+    second.write_xml(io.BytesIO())
+    # The creditor is checked only once, but appears in both payments.
+    for payment in (first, second):
+        assert payment.truncations.counts == {('IdHolder', 'name'): 1}
+        assert payment.truncations.rows == {1: 1}
+
+    payment = build('Warned')
+    payment.truncations = 'warn'
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        payment.xml_text()
+    assert len(caught) == 1
+    assert caught[0].filename == __file__.replace('.pyc', '.py')
@@ -0,0 +1,85 @@
+from lxml import etree
+
+from sepacbi.batch import run_batch
+
+from .definitions import *
+
+
+def make_manifest(count):
+    jobs = []
+    for i in range(count):
+        jobs.append({
+            'name': 'job-%d' % i,
+            'output': 'payment-%d.xml' % i,
+            'payment': {'debtor': 'business', 'account': acct_37,
+                        'req_id': 'Batch%d' % i,
+                        'execution_date': '2014-05-15'},
+            'transactions': [
+                {'amount': '%d.50' % (n + 1), 'account': acct_86,
+                 'creditor': 'beta', 'rmtinfo': 'Invoice %d' % n}
+                for n in range(i + 1)],
+        })
+    return {
+        'parties': {
+            'business': {'name': 'Test Business S.P.A.', 'cf': '12312312311',
+                         'cuc': 'S0215325Z'},
+            'beta': {'name': 'Beta s.n.c.', 'code': 'ESQ01231244'},
+        },
+        'jobs': jobs,
+    }
+
+
+def test_batch(tmpdir):
+    manifest = make_manifest(4)
+    # A failing job does not stop the others
+    manifest['jobs'][1]['transactions'][0]['account'] = 'IT00INVALID'
+    report = run_batch(manifest, jobs=2, output_dir=str(tmpdir))
+
+    assert [result.name for result in report.results] == \
+        ['job-0', 'job-1', 'job-2', 'job-3']
+    assert [result.name for result in report.failed] == ['job-1']
+    assert 'InvalidIBANError' in report.failed[0].error
+    assert '1 failed' in report.summary()
+
+    tree = etree.parse(str(tmpdir.join('payment-3.xml')))
+    assert tree.getroot().findtext(
+        './/{urn:CBI:xsd:CBIPaymentRequest.00.04.00}NbOfTxs') == '4'
+    assert report.results[3].transactions == 4
+    assert not tmpdir.join('payment-1.xml').check()
+
+
+def test_batch_in_process():
+    manifest = make_manifest(2)
+    for job in manifest['jobs']:
+        del job['output']
+    report = run_batch(manifest, jobs=1)
+    assert len(report.succeeded) == 2
+    assert b'<MsgId>Batch1</MsgId>' in report.results[1].data
+
+
+def test_batch_party_redefined():
+    "A party defined differently by a later manifest is not reused."
+    names = []
+    for business in ('First Business S.P.A.', 'Second Business S.P.A.'):
+        manifest = make_manifest(1)
+        del manifest['jobs'][0]['output']
+        manifest['parties']['business']['name'] = business
+        report = run_batch(manifest, jobs=1)
+        root = etree.fromstring(report.results[0].data)
+        names.append(root.findtext(
+            './/{urn:CBI:xsd:CBIPaymentRequest.00.04.00}InitgPty/'
+            '{urn:CBI:xsd:CBIPaymentRequest.00.04.00}Nm'))
+    assert names == ['First Business S.P.A.', 'Second Business S.P.A.']
+
+
+def test_batch_malformed_party():
+    "A malformed party only fails the jobs that use it."
+    manifest = make_manifest(3)
+    for job in manifest['jobs']:
+        del job['output']
+    manifest['parties']['broken'] = {'name': 'Broken', 'unknown': 'x'}
+    manifest['jobs'][1]['transactions'][0]['creditor'] = 'broken'
+    for jobs in (1, 2):
+        report = run_batch(manifest, jobs=jobs)
+        assert [result.name for result in report.failed] == ['job-1']
+        assert 'TypeError' in report.failed[0].error
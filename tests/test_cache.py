@@ -0,0 +1,94 @@
+import os
+from copy import copy
+from datetime import datetime
+
+import pytest
+
+from sepacbi import Payment
+from sepacbi.cache import OutputCache
+from sepacbi.payment import UnpinnedPaymentError
+
+from .definitions import *
+
+debtor = copy(biz_with_cuc)
+debtor.sia_code = '0A123'
+
+
+def pinned_payment(amount=1):
+    payment = Payment(debtor=debtor, account=acct_37, req_id='Pinned',
+                      creation_time=datetime(2014, 3, 1, 10, 30))
+    payment.add_transaction(amount=amount, account=acct_86, creditor=alpha,
+                            rmtinfo='Cached')
+    return payment
+
+
+def test_deterministic_output():
+    first = pinned_payment()
+    second = pinned_payment()
+    assert first.xml_text() == second.xml_text()
+    assert b'<CreDtTm>2014-03-01T10:30:00</CreDtTm>' in first.xml_text()
+    assert first.cbi_text() == second.cbi_text()
+    assert first.content_hash() == second.content_hash()
+    assert first.content_hash() != pinned_payment(2).content_hash()
+    assert first.content_hash('xml') != first.content_hash('cbi')
+
+    with pytest.raises(UnpinnedPaymentError):
+        Payment(debtor=biz, account=acct_37).content_hash()
+
+
+def test_output_cache(tmpdir, monkeypatch):
+    cache = OutputCache(str(tmpdir))
+    payment = pinned_payment()
+    text = payment.xml_text(cache=cache)
+    assert os.listdir(str(tmpdir)) == [payment.content_hash('xml', [])]
+
+    # Served from the cache: the tree is not built again.
+    def fail(self):
+        raise AssertionError('Not cached')
+    monkeypatch.setattr(Payment, 'xml', fail)
+    assert pinned_payment().xml_text(cache=cache) == text
+    assert payment.cbi_text(cache=cache) == pinned_payment().cbi_text()
+    assert len(os.listdir(str(tmpdir))) == 2
+
+
+def test_cache_eviction(tmpdir):
+    cache = OutputCache(str(tmpdir), max_bytes=10)
+    cache.put('a', b'12345')
+    cache.put('b', b'12345')
+    # 'b' is the least recently used file
+    os.utime(str(tmpdir.join('a')), (2, 2))
+    os.utime(str(tmpdir.join('b')), (1, 1))
+    cache.put('c', b'12345')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'12345'
+    assert cache.size == 10
+
+
+def test_hash_helpers(tmpdir, monkeypatch):
+    "The helpers' configuration and the code versions are part of the key."
+    from sepacbi import cache
+    from sepacbi.charset import SEPANormalizer
+    from sepacbi.directory import SortedIndex
+
+    def hashed(**kwargs):
+        payment = pinned_payment()
+        for name, value in kwargs.items():
+            setattr(payment, name, value)
+        return payment.content_hash()
+
+    assert hashed(normalizer=SEPANormalizer()) == \
+        hashed(normalizer=SEPANormalizer())
+    assert hashed(normalizer=SEPANormalizer()) != \
+        hashed(normalizer=SEPANormalizer(replacement=u'?'))
+
+    path = str(tmpdir.join('bic.idx'))
+    directory = SortedIndex.build(path, [('IT07601', 'BPPIITRRXXX')])
+    first = hashed(bic_directory=directory)
+    directory.close()
+    directory = SortedIndex.build(path, [('IT07601', 'BPPIITRRYYY')])
+    assert hashed(bic_directory=directory) != first
+    directory.close()
+
+    plain = hashed()
+    monkeypatch.setattr(cache, 'CACHE_FORMAT', cache.CACHE_FORMAT + 1)
+    assert hashed() != plain
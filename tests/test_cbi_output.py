@@ -1,6 +1,7 @@
 from sepacbi import Payment, Invoice, DebitNote, Text
 from .definitions import *
 import re
+import pytest
 import sys
 from datetime import datetime, date
 
@@ -79,3 +80,94 @@ def test_payment_misc_features():
         category='SALA', docs=[Text('Salary payment')])
 
     compare_cbi(payment.cbi_text(), 'payment_misc_2.txt')
+
+
+def test_payment_bytes(tmpdir):
+    payment = Payment(debtor=biz_with_sia, account=acct_37, req_id='StaticId',
+                      execution_date=date(2014, 5, 15))
+    payment.add_transaction(amount=198.25, account=acct_86, creditor=beta,
+                            rmtinfo='Causale 1')
+    payment.add_transaction(amount=9532.21, account=acct_86, creditor=alpha,
+                            docs=[Invoice(18512, 4500),
+                                  DebitNote(1048, 5032.21,
+                                            date(1995, 4, 21))])
+    text = payment.cbi_text()
+    assert payment.cbi_bytes() == text.encode('ascii')
+    crlf = payment.cbi_bytes('cp1252', b'\r\n')
+    assert crlf == text.replace('\n', '\r\n').encode('cp1252')
+    assert len(crlf) == payment.cbi_record_count() * 122
+
+    path = tmpdir.join('payment.cbi')
+    assert payment.write_cbi_file(str(path)) == len(text)
+    assert path.read_binary() == text.encode('ascii')
+
+    # Neither builds the list of all the lines first.
+    def no_lines():
+        raise AssertionError('cbi_lines() called')
+    payment.cbi_lines = no_lines
+    assert payment.cbi_bytes() == text.encode('ascii')
+    assert payment.write_cbi_file(str(path)) == len(text)
+
+
+def test_format_many():
+    from decimal import Decimal
+    from sepacbi.cbibon_dom import TransferInfo
+    amounts = [Decimal('198.25'), Decimal('1.00'), Decimal('9532.21')]
+    lines = TransferInfo.format_many({
+        'prog_number': [1, 2, 3], 'amount': amounts,
+        'execution_date': [date(2014, 5, 15)] * 3, 'ord_abi': ['07601'] * 3})
+
+    expected = []
+    for prog, amount in zip([1, 2, 3], amounts):
+        record = TransferInfo()
+        record.prog_number = prog
+        record.amount = amount
+        record.execution_date = date(2014, 5, 15)
+        record.ord_abi = '07601'
+        expected.append(record.format())
+    assert lines == expected
+    assert all(len(line) == TransferInfo.length for line in lines)
+
+    from io import StringIO
+    out = StringIO()
+    assert TransferInfo.format_many({'prog_number': [1, 2]}, out=out) == 2
+    assert out.getvalue().count('\n') == 2
+
+    numpy = pytest.importorskip('numpy')
+    array = TransferInfo.format_many({
+        'prog_number': [1, 2, 3], 'amount': amounts,
+        'execution_date': [date(2014, 5, 15)] * 3, 'ord_abi': ['07601'] * 3},
+        use_numpy=True)
+    assert array.dtype == numpy.dtype('U120')
+    assert list(array) == expected
+
+
+def test_long_remittance():
+    "Remittance info longer than 90 characters spans multiple records."
+    payment = Payment(debtor=biz_with_sia, account=acct_37, req_id='StaticId',
+                      execution_date=date(2014, 5, 15))
+    rmtinfo = ''.join(chr(ord('A') + i % 26) for i in range(130))
+    payment.add_transaction(amount=1, account=acct_86, creditor=beta,
+                            rmtinfo=rmtinfo)
+    lines = payment.cbi_text().splitlines()
+    purpose = [line for line in lines if line[1:3] in ('50', '60')]
+    assert [line[1:3] for line in purpose] == ['60', '60']
+    assert ''.join(line[10:100] for line in purpose).rstrip() == rmtinfo
+    assert len(lines) == payment.cbi_record_count()
+
+
+def test_remittance_segments():
+    from sepacbi.rmtinfo import Remittance, RemittanceInfoError
+    docs = [Invoice(n) for n in range(1, 8)]
+    segments = Remittance(docs=docs).cbi_segments()
+    assert [len(line) for _, line in segments] == [90, 90, 30]
+    assert set(record_type for record_type, _ in segments) == set(['60'])
+    assert Remittance(docs=docs[:3]).cbi_segments()[0][0] == '50'
+
+    with pytest.raises(RemittanceInfoError):
+        Remittance(docs=[Invoice(n) for n in range(1, 17)]).cbi_segments()
+    with pytest.raises(RemittanceInfoError):
+        Remittance(rmtinfo='x' * 500).cbi_segments()
+    with pytest.raises(RemittanceInfoError):
+        Remittance(docs=[Invoice(n, 1, date(2014, 1, 1))
+                         for n in range(1, 8)]).ustrd()
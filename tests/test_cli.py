@@ -0,0 +1,104 @@
+import json
+
+from lxml import etree
+
+from sepacbi.cli import main
+
+from .definitions import *
+
+NS = {'pr': 'urn:CBI:xsd:CBIPaymentRequest.00.04.00'}
+
+CSV_INPUT = (
+    'Importo;IBAN;Beneficiario;Causale\n'
+    '198,25;%s;Beta s.n.c.;Causale 1\n'
+    '1.350,00;%s;Alpha s.r.l.;Causale 2\n'
+    '10,00;%s;Mario Rossi;Causale 3\n'
+) % (acct_86, acct_37, acct_86)
+
+DEBTOR_ARGS = ['--account', acct_37, '--debtor-name', 'Test Business',
+               '--debtor-cf', '12312312311', '--debtor-cuc', 'S0215325Z',
+               '--req-id', 'CliTest']
+
+
+def count_transactions(path):
+    tree = etree.parse(str(path))
+    return len(tree.findall('.//pr:CdtTrfTxInf', NS))
+
+
+def without_creation_time(data):
+    tree = etree.fromstring(data)
+    for item in tree.findall('.//pr:CreDtTm', NS):
+        item.text = ''
+    return etree.tostring(tree)
+
+
+def test_csv_to_xml(tmpdir):
+    source = tmpdir.join('input.csv')
+    source.write(CSV_INPUT)
+    output = tmpdir.join('out.xml')
+    assert main([str(source), '-o', str(output), '--delimiter', ';',
+                 '--decimal-comma', '-m', 'amount=Importo',
+                 '-m', 'account=IBAN', '-m', 'creditor_name=Beneficiario',
+                 '-m', 'rmtinfo=Causale'] + DEBTOR_ARGS) == 0
+    tree = etree.parse(str(output))
+    assert tree.findtext('.//pr:CtrlSum', namespaces=NS) == '1558.25'
+    assert tree.findtext('.//pr:MsgId', namespaces=NS) == 'CliTest'
+
+
+def test_jsonl_split_parallel(tmpdir):
+    source = tmpdir.join('input.jsonl')
+    source.write(''.join(json.dumps({
+        'amount': i + 1, 'account': acct_86, 'creditor_name': 'Beta',
+        'rmtinfo': 'Row %d' % i}) + '\n' for i in range(7)))
+    output = tmpdir.join('out.xml')
+    assert main([str(source), '-o', str(output), '--max-transactions', '3',
+                 '--jobs', '2'] + DEBTOR_ARGS) == 0
+    counts = [count_transactions(tmpdir.join('out-%04d.xml' % seq))
+              for seq in (1, 2, 3)]
+    assert counts == [3, 3, 1]
+    assert not tmpdir.join('out-0004.xml').check()
+
+
+def test_bad_row(tmpdir, capsys):
+    source = tmpdir.join('input.csv')
+    source.write('amount,account,creditor_name,rmtinfo\n'
+                 '1,%s,Beta,Ok\n'
+                 '2,IT00INVALID,Beta,Bad\n' % acct_86)
+    assert main([str(source), '-o', str(tmpdir.join('out.xml'))]
+                + DEBTOR_ARGS) == 1
+    assert 'Row 2' in capsys.readouterr().err
+    assert not tmpdir.join('out.xml').check()
+
+
+def test_single_output_streamed(tmpdir, capsysbinary):
+    "Unsplit output comes from the disk-backed store, optionally pipelined."
+    source = tmpdir.join('input.jsonl')
+    source.write(''.join(json.dumps({
+        'amount': 1000.5 + i, 'account': acct_86, 'creditor_name': 'Beta',
+        'rmtinfo': 'Row %d' % i}) + '\n' for i in range(5)))
+    outputs = []
+    for jobs in ('1', '2'):
+        output = tmpdir.join('out-%s.xml' % jobs)
+        # Numeric amounts are left alone by --decimal-comma.
+        assert main([str(source), '-o', str(output), '--jobs', jobs,
+                     '--decimal-comma'] + DEBTOR_ARGS) == 0
+        outputs.append(output.read_binary())
+    assert main([str(source), '--jobs', '2'] + DEBTOR_ARGS) == 0
+    outputs.append(capsysbinary.readouterr().out)
+    assert len(set(without_creation_time(data) for data in outputs)) == 1
+    tree = etree.fromstring(outputs[0])
+    assert tree.findtext('.//pr:CtrlSum', namespaces=NS) == '5012.50'
+    assert len(tree.findall('.//pr:CdtTrfTxInf', NS)) == 5
+
+
+def test_split_by_size(tmpdir):
+    source = tmpdir.join('input.csv')
+    source.write('amount,account,creditor_name,rmtinfo\n' + ''.join(
+        '%d,%s,Beta,Row %d\n' % (i + 1, acct_86, i) for i in range(5)))
+    output = tmpdir.join('out.xml')
+    # Each row holds 41 bytes of values.
+    assert main([str(source), '-o', str(output), '--max-bytes', '90']
+                + DEBTOR_ARGS) == 0
+    counts = [count_transactions(tmpdir.join('out-%04d.xml' % seq))
+              for seq in (1, 2, 3)]
+    assert counts == [2, 2, 1]
@@ -0,0 +1,82 @@
+from decimal import Decimal
+
+import pytest
+
+from sepacbi import Payment
+from sepacbi.columns import InvalidRowsError, ColumnError
+
+from .definitions import *
+
+
+def test_add_from_columns():
+    payment = Payment(debtor=biz_with_cuc, account=acct_37, req_id='Cols')
+    count = payment.add_transactions_from_columns({
+        'amount': [1, 2.5, '3.456'],
+        'iban': [acct_86, acct_86.lower(), acct_37],
+        'creditor_name': ['Alpha', 'Alpha', 'Beta'],
+        'creditor_cf': ['01234567890', '01234567890', None],
+        'rmtinfo': ['One', 'Two', 'Three'],
+        'eeid': ['E1', None, 'E3'],
+    }, columns={'account': 'iban'})
+    assert count == 3
+    first, second, third = payment.transactions
+    assert [txr.amount for txr in payment.transactions] == \
+        [Decimal('1.00'), Decimal('2.50'), Decimal('3.46')]
+    assert first.account is second.account
+    assert first.account.iban == 'IT86U0760111500000010117463'
+    assert first.creditor is second.creditor
+    assert third.creditor.name == 'Beta'
+    assert not hasattr(third.creditor, 'cf')
+    assert second.eeid == 'Cols-000002'
+    assert b'<EndToEndId>E3</EndToEndId>' in payment.xml_text()
+
+
+def test_invalid_rows():
+    payment = Payment(debtor=biz_with_cuc, account=acct_37)
+    with pytest.raises(InvalidRowsError) as info:
+        payment.add_transactions_from_columns({
+            'amount': [1, 'x', 3, None],
+            'account': [acct_86, acct_86, 'IT00INVALIDIBAN', acct_86],
+            'creditor_name': ['Alpha'] * 4,
+            'rmtinfo': ['A', 'B', 'C', 'D' * 141],
+            'eeid': ['E1', 'E2', 'E1', 'E4'],
+        })
+    report = info.value.report
+    assert report.rows() == [2, 3, 4]
+    assert len(report) == 5
+    assert payment.transactions == []
+
+    with pytest.raises(ColumnError):
+        payment.add_transactions_from_columns({'amount': [1]})
+
+
+def test_rows_failing_late():
+    payment = Payment(debtor=biz_with_cuc, account=acct_37, req_id='Late')
+    with pytest.raises(InvalidRowsError) as info:
+        payment.add_transactions_from_columns({
+            'amount': [1, 2], 'account': [acct_86, 12345],
+            'creditor_name': ['Alpha'] * 2, 'rmtinfo': ['A', 'B']})
+    assert [issue.row for issue in info.value.report] == [2]
+
+    # A row that only fails its own checks: nothing is added.
+    with pytest.raises(InvalidRowsError) as info:
+        payment.add_transactions_from_columns({
+            'amount': [1, 2], 'account': [acct_86] * 2,
+            'creditor_name': ['Alpha'] * 2, 'rmtinfo': ['A', 'B'],
+            'eeid': ['E1', 'E2'], 'purpose': ['SUPP', 'TOOLONG']})
+    assert [issue.row for issue in info.value.report] == [2]
+    assert payment.transactions == []
+    assert set(payment.eeid_set) == set()
+
+
+def test_from_structured_array():
+    numpy = pytest.importorskip('numpy')
+    data = numpy.array(
+        [(10.1, acct_86.encode('ascii'), b'Alpha', b'First'),
+         (20.2, acct_86.encode('ascii'), b'Beta', b'Second')],
+        dtype=[('amount', 'f8'), ('account', 'S40'),
+               ('creditor_name', 'S20'), ('rmtinfo', 'S20')])
+    payment = Payment.from_frame(data, debtor=biz_with_cuc, account=acct_37)
+    assert len(payment.transactions) == 2
+    assert payment.amount_sum() == Decimal('30.30')
+    assert payment.transactions[1].creditor.name == 'Beta'
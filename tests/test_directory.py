@@ -0,0 +1,111 @@
+import pytest
+
+from sepacbi import Payment
+from sepacbi.bank import InvalidBICError, UnknownBankCodeError, validate_bic
+from sepacbi.directory import BICDirectory, ABICABDirectory, SortedIndex, \
+    IndexFormatError
+from sepacbi.transaction import MissingBICError
+
+from .definitions import *
+
+BIC_CSV = (
+    'country,bank_code,bic\n'
+    'ES,2100,CAIXESBBXXX\n'
+    'DE,37040044,COBADEFFXXX\n'
+    'FR,30006,AGRIFRPP\n'
+    'XX,0000,NOT A BIC\n'
+)
+
+
+@pytest.fixture
+def bic_directory(tmpdir):
+    source = tmpdir.join('bic.csv')
+    source.write(BIC_CSV)
+    return BICDirectory.build_from_csv(str(source), str(tmpdir.join('bic.idx')))
+
+
+def test_sorted_index(tmpdir):
+    path = str(tmpdir.join('test.idx'))
+    items = [('%05d' % i, 'v%d' % i) for i in range(1000, 0, -3)]
+    with SortedIndex.build(path, items) as index:
+        assert len(index) == 334
+        assert index.get('00001') == 'v1'
+        assert index.get('01000') == 'v1000'
+        assert '00002' not in index
+        assert index.get_many(['00004', 'missing', '00004']) == \
+            ['v4', None, 'v4']
+
+    tmpdir.join('bad.idx').write('garbage')
+    with pytest.raises(IndexFormatError):
+        SortedIndex(str(tmpdir.join('bad.idx')))
+
+
+def test_bic_lookup(bic_directory):
+    assert len(bic_directory) == 3
+    assert bic_directory.bic_for_iban('ES3821001579800200255488') == \
+        'CAIXESBBXXX'
+    assert bic_directory.bics_for_ibans([
+        'DE89370400440532013000', 'ES3821001579800200255488',
+        'BE68539007547034']) == ['COBADEFFXXX', 'CAIXESBBXXX', None]
+
+
+def test_bic_filled_in(bic_directory):
+    payment = Payment(debtor=biz_with_cuc, account=acct_37,
+                      bic_directory=bic_directory)
+    payment.add_transaction(amount=1, account=foreign_acct, creditor=alpha,
+                            rmtinfo='Test')
+    assert payment.transactions[0].bic == 'CAIXESBBXXX'
+    with pytest.raises(MissingBICError):
+        payment.add_transaction(amount=1, account='BE68539007547034',
+                                creditor=alpha, rmtinfo='Test')
+
+
+def test_bic_format():
+    validate_bic('ABCDESNN')
+    validate_bic('CAIXESBB001')
+    for bic in ('ABCDESN', 'abcdesnn', '1BCDESNN', 'ABCDESNN00', 'ABCD12NN'):
+        with pytest.raises(InvalidBICError):
+            validate_bic(bic)
+
+
+ABI_CSV = (
+    'abi;cab;name\n'
+    '07601;01600;Poste Italiane - Roma\n'
+    '07601;11500;Poste Italiane - Udine\n'
+    '1005;3200;Banca Nazionale del Lavoro\n'
+)
+
+
+@pytest.fixture
+def abi_directory(tmpdir):
+    source = tmpdir.join('abicab.csv')
+    source.write(ABI_CSV)
+    return ABICABDirectory.build_from_csv(
+        str(source), str(tmpdir.join('abicab.idx')), with_names=True)
+
+
+def test_abi_cab_lookup(abi_directory):
+    assert abi_directory.has_abi('07601')
+    assert not abi_directory.has_abi('07602')
+    assert abi_directory.has_branch('01005', '03200')
+    assert abi_directory.branch_name('07601', '11500') == \
+        'Poste Italiane - Udine'
+    with pytest.raises(UnknownBankCodeError):
+        abi_directory.check('07601', '99999')
+
+    ibans = [acct_37, 'IT60X0542811101000000123456', foreign_acct,
+             acct_86.replace(' ', '')]
+    assert list(abi_directory.unknown_ibans(ibans)) == [
+        (1, 'IT60X0542811101000000123456')]
+
+
+def test_abi_cab_payment(abi_directory):
+    payment = Payment(debtor=biz_with_cuc, account=acct_37,
+                      abi_directory=abi_directory)
+    payment.add_transaction(amount=1, account=acct_86, creditor=alpha,
+                            rmtinfo='Test')
+    payment.xml()
+    with pytest.raises(UnknownBankCodeError):
+        payment.add_transaction(amount=1,
+                                account='IT60X0542811101000000123456',
+                                creditor=alpha, rmtinfo='Test')
@@ -0,0 +1,136 @@
+import io
+from copy import copy
+from datetime import datetime
+
+import pytest
+
+from sepacbi import Payment, Invoice, CreditNote
+from sepacbi.duplicates import DuplicateIndex, DuplicatePaymentError, \
+    fingerprint
+
+from .definitions import *
+
+debtor = copy(biz_with_cuc)
+debtor.sia_code = '0A123'
+
+
+def make_payment(req_id, created, **kwargs):
+    return Payment(debtor=debtor, account=acct_37, req_id=req_id,
+                   creation_time=created, **kwargs)
+
+
+def test_fingerprint():
+    base = {'amount': 10, 'account': acct_86, 'rmtinfo': 'Fattura n. 12/A'}
+    same = dict(base, amount='10.00', rmtinfo='FATTURA N.12 A')
+    assert fingerprint(base) == fingerprint(same)
+    assert fingerprint(base) != fingerprint(dict(base, amount=11))
+    assert fingerprint(base) != fingerprint(dict(base, account=acct_37))
+    docs = {'amount': 10, 'account': acct_86,
+            'docs': [Invoice(1), CreditNote(2)]}
+    assert fingerprint(docs) == fingerprint(
+        dict(docs, docs=[CreditNote('2'), Invoice(1)]))
+    assert fingerprint(docs) != fingerprint(dict(docs, docs=[Invoice(1)]))
+
+
+def test_duplicate_index(tmpdir):
+    index = DuplicateIndex(str(tmpdir.join('fingerprints.sqlite')), days=30)
+    first = make_payment('First', datetime(2014, 3, 1),
+                         duplicate_index=index)
+    first.add_transaction(amount=100, account=acct_86, creditor=alpha,
+                          rmtinfo='Invoice 1')
+    first.add_transaction(amount=200, account=acct_86, creditor=alpha,
+                          docs=[Invoice(2)])
+    first.xml_text()
+    assert len(index) == 0
+    first.mark_issued()
+    assert len(index) == 2
+
+    second = make_payment('Second', datetime(2014, 3, 20),
+                          duplicate_index=index, duplicate_policy='collect')
+    second.add_transaction(amount=100, account=acct_86, creditor=alpha,
+                           rmtinfo='INVOICE 1', eeid='Other')
+    second.add_transaction(amount=300, account=acct_86, creditor=alpha,
+                           rmtinfo='Invoice 3')
+    second.add_transaction(amount=300, account=acct_86, creditor=alpha,
+                           rmtinfo='Invoice 3')
+    duplicates = second.get_duplicates()
+    assert [(seq, eeid) for seq, eeid, _ in duplicates] == \
+        [(1, 'Other'), (3, 'Second-000003')]
+    assert duplicates[0][2][0].msg_id == 'First'
+    assert duplicates[1][2][0].eeid == 'Second-000002'
+    assert second.find_duplicates() == duplicates
+
+    # Outside of the window
+    later = make_payment('Later', datetime(2014, 4, 15),
+                         duplicate_index=index, duplicate_policy='raise')
+    later.add_transaction(amount=100, account=acct_86, creditor=alpha,
+                          rmtinfo='Invoice 1')
+    same_day = make_payment('SameDay', datetime(2014, 3, 2),
+                            duplicate_index=index, duplicate_policy='raise')
+    with pytest.raises(DuplicatePaymentError):
+        same_day.add_transaction(amount=200, account=acct_86,
+                                 creditor=alpha, docs=[Invoice(2)])
+    assert len(same_day.transactions) == 0
+    # The rejected transaction's end-to-end ID can be used again.
+    same_day.add_transaction(amount=250, account=acct_86, creditor=alpha,
+                             docs=[Invoice(5)])
+    assert [txr.eeid for txr in same_day.transactions] == ['SameDay-000001']
+
+    with pytest.warns(UserWarning) as caught:
+        make_payment('Warned', datetime(2014, 3, 2),
+                     duplicate_index=index).add_transaction(
+            amount=100, account=acct_86, creditor=alpha,
+            rmtinfo='Invoice 1')
+    # The warning points at the caller's code, whatever the call path.
+    assert caught[0].filename == __file__.replace('.pyc', '.py')
+    with pytest.warns(UserWarning) as caught:
+        make_payment('WarnedColumns', datetime(2014, 3, 2),
+                     duplicate_index=index).add_transactions_from_columns({
+                         'amount': [100], 'account': [acct_86],
+                         'creditor_name': ['Alpha'],
+                         'rmtinfo': ['Invoice 1']})
+    assert caught[0].filename == __file__.replace('.pyc', '.py')
+
+    # Writing a payment again does not make it a duplicate of itself
+    first.write_cbi(io.BytesIO())
+    assert len(index) == 2
+    assert first.find_duplicates() == []
+    with pytest.raises(ValueError):
+        make_payment('NoIndex', datetime(2014, 3, 2)).find_duplicates()
+    index.close()
+
+
+def test_duplicate_rows(tmpdir):
+    from sepacbi.columns import InvalidRowsError
+    index = DuplicateIndex(str(tmpdir.join('fingerprints.sqlite')))
+    payment = make_payment('Rows', datetime(2014, 3, 1),
+                           duplicate_index=index, duplicate_policy='raise')
+    rows = {'amount': [100, 200, 100], 'account': [acct_86] * 3,
+            'creditor_name': ['Alpha'] * 3,
+            'rmtinfo': ['Invoice 1', 'Invoice 2', 'Invoice 1']}
+    with pytest.raises(InvalidRowsError) as info:
+        payment.add_transactions_from_columns(rows)
+    assert [(issue.row, issue.error) for issue in info.value.report] == \
+        [(3, 'DuplicatePaymentError')]
+    assert len(payment.transactions) == 0
+    # The rejected rows leave no trace in the duplicate check.
+    rows = dict((name, values[:2]) for name, values in rows.items())
+    assert payment.add_transactions_from_columns(rows) == 2
+    index.close()
+
+
+def test_rejected_duplicate_with_storage(tmpdir):
+    index = DuplicateIndex(str(tmpdir.join('fingerprints.sqlite')))
+    payment = make_payment('Stored', datetime(2014, 3, 1), storage=True,
+                           duplicate_index=index, duplicate_policy='raise')
+    payment.add_transaction(amount=100, account=acct_86, creditor=alpha,
+                            rmtinfo='Invoice 1')
+    with pytest.raises(DuplicatePaymentError):
+        payment.add_transaction(amount=100, account=acct_86, creditor=alpha,
+                                rmtinfo='Invoice 1')
+    payment.add_transaction(amount=200, account=acct_86, creditor=alpha,
+                            rmtinfo='Invoice 2')
+    assert [txr.eeid for txr in payment.transactions] == \
+        ['Stored-000001', 'Stored-000002']
+    payment.transactions.close()
+    index.close()
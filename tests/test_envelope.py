@@ -0,0 +1,75 @@
+import io
+from datetime import datetime
+
+import pytest
+from lxml import etree
+
+from sepacbi import Payment
+from sepacbi.envelope import EnvelopeWriter, write_envelope
+from sepacbi.payment import NoTransactionsError
+
+from .definitions import *
+
+
+def make_payment(req_id, count, **kwargs):
+    payment = Payment(debtor=biz_with_cuc, account=acct_37, req_id=req_id,
+                      creation_time=datetime(2014, 3, 1, 10, 30), **kwargs)
+    for i in range(count):
+        payment.add_transaction(amount=i + 1, account=acct_86,
+                                creditor=alpha, rmtinfo='Row %d' % i)
+    return payment
+
+
+def test_single_payment_envelope():
+    "A single payment gives the same output as the envelope attribute."
+    for kwargs in ({}, {'encoding': 'UTF-8', 'xml_declaration': True}):
+        out = io.BytesIO()
+        write_envelope([make_payment('Single', 2)], out, **kwargs)
+        assert out.getvalue() == \
+            make_payment('Single', 2, envelope=True).xml_text(**kwargs)
+
+
+def test_multiple_payments():
+    def payments():
+        for seq in range(3):
+            yield make_payment('Request-%d' % seq, seq + 1)
+
+    out = io.BytesIO()
+    with EnvelopeWriter(out, encoding='UTF-8') as writer:
+        for payment in payments():
+            writer.write_payment(payment)
+    assert writer.payments == 3
+    assert writer.transactions == 6
+
+    root = etree.fromstring(out.getvalue())
+    assert etree.QName(root).localname == 'CBIBdyPaymentRequest'
+    envelopes = list(root)
+    assert [etree.QName(item).localname for item in envelopes] == \
+        ['CBIEnvelPaymentRequest'] * 3
+    ns = {'pr': 'urn:CBI:xsd:CBIPaymentRequest.00.04.00'}
+    assert root.xpath('//pr:GrpHdr/pr:MsgId/text()', namespaces=ns) == \
+        ['Request-0', 'Request-1', 'Request-2']
+    assert root.xpath('//pr:GrpHdr/pr:NbOfTxs/text()', namespaces=ns) == \
+        ['1', '2', '3']
+
+    with pytest.raises(NoTransactionsError):
+        write_envelope([], io.BytesIO())
+    out = io.BytesIO()
+    with pytest.raises(NoTransactionsError):
+        write_envelope([Payment(debtor=biz_with_cuc, account=acct_37)], out)
+    assert out.getvalue() == b''
+
+
+def test_invalid_later_payment():
+    out = io.BytesIO()
+    writer = EnvelopeWriter(out)
+    writer.write_payment(make_payment('Valid', 1))
+    written = out.getvalue()
+    with pytest.raises(NoTransactionsError):
+        writer.write_payment(make_payment('Empty', 0))
+    with pytest.raises(Exception):
+        writer.write_payment(Payment(debtor='Not a party', account=acct_37))
+    # Nothing of the rejected payments was written.
+    assert out.getvalue() == written
+    writer.close()
+    assert len(etree.fromstring(out.getvalue())) == 1
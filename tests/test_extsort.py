@@ -0,0 +1,52 @@
+import random
+from datetime import date
+from decimal import Decimal
+
+from sepacbi import IdHolder
+from sepacbi.extsort import ExternalSorter, external_sort, grouped_payments
+
+from .definitions import *
+
+
+def test_external_sort(tmpdir, monkeypatch):
+    import sepacbi.extsort
+    monkeypatch.setattr(sepacbi.extsort, 'MERGE_FAN_IN', 3)
+    rng = random.Random(42)
+    rows = [{'amount': rng.randint(1, 50), 'seq': seq,
+             'rmtinfo': rng.choice(['a', 'b', None])} for seq in range(500)]
+    expected = sorted(rows, key=lambda row: (
+        row['rmtinfo'] is not None, row['rmtinfo'] or '', row['amount']))
+    sorter = ExternalSorter(('rmtinfo', 'amount'), run_size=40,
+                            directory=str(tmpdir))
+    sorter.extend(rows)
+    assert len(sorter.runs) == 12
+    assert list(sorter) == expected
+    assert tmpdir.listdir() == []
+
+    # Without spilling, and with a key function
+    assert list(external_sort(rows, lambda row: -row['seq'])) == rows[::-1]
+
+
+def test_grouped_payments():
+    creditors = [IdHolder(name='Creditor %d' % i) for i in range(3)]
+    rows = []
+    for i in range(60):
+        rows.append({'amount': Decimal(i + 1), 'account': acct_86,
+                     'creditor': creditors[i % 3], 'rmtinfo': 'Row %d' % i,
+                     'category': ['SUPP', 'SALA'][i % 2],
+                     'execution_date': date(2014, 5, 15 + i % 2)})
+    payments = list(grouped_payments(
+        rows, ('execution_date', 'category'), order_by='creditor.name',
+        run_size=7, debtor=biz_with_cuc, account=acct_37, req_id='Grouped'))
+    assert [values for values, _ in payments] == [
+        (date(2014, 5, 15), 'SUPP'), (date(2014, 5, 16), 'SALA')]
+    first = payments[0][1]
+    assert first.req_id == 'Grouped-0001'
+    assert first.execution_date == date(2014, 5, 15)
+    assert len(first.transactions) == 30
+    names = [txr.creditor.name for txr in first.transactions]
+    assert names == sorted(names)
+    assert [txr.rmtinfo for txr in first.transactions[:2]] == \
+        ['Row 0', 'Row 6']
+    assert sum(payment.amount_sum() for _, payment in payments) == 1830
+    assert b'<Cd>SALA</Cd>' in payments[1][1].xml_text()
@@ -0,0 +1,74 @@
+import pytest
+
+from sepacbi import iban
+from sepacbi.iban import InvalidIBANError
+from sepacbi.iban_registry import IBANRegistry, parse_registry, \
+    load_registry, RegistryCacheError, RegistryFormatError, CACHE_VERSION
+
+from .definitions import *
+
+
+SWIFT_TXT = (
+    'Data element\tItaly\tGermany\n'
+    'IBAN prefix country code (ISO 3166)\tIT\tDE\n'
+    'Bank identifier position within the BBAN\t2-6\t1-8\n'
+    'Branch identifier position within the BBAN\t7-11\t\n'
+    'IBAN structure\tIT2!n1!a5!n5!n12!c\tDE2!n8!n10!n\n'
+    'IBAN length\t27\t22\n'
+)
+
+FLAT_CSV = (
+    'country,iban_structure,iban_length,bank_id_position\n'
+    'IT,IT2!n1!a5!n5!n12!c,27,2-6\n'
+)
+
+
+def test_parse_swift_txt():
+    registry = parse_registry(SWIFT_TXT, 'Test release')
+    assert registry.countries() == ['DE', 'IT']
+    rule = registry['IT']
+    assert rule.length == 27
+    assert rule.match('IT37Z0760101600000028426203')
+    assert rule.bank_code('IT37Z0760101600000028426203') == '07601'
+    assert rule.branch_code('IT37Z0760101600000028426203') == '01600'
+    assert registry['DE'].branch_code('DE89370400440532013000') is None
+
+
+def test_parse_flat_csv_and_text(tmpdir):
+    path = tmpdir.join('registry.csv')
+    path.write(FLAT_CSV)
+    registry = load_registry(str(path))
+    assert registry.countries() == ['IT']
+    assert registry['IT'].bank_code(acct_86.replace(' ', '')) == '07601'
+
+    registry = parse_registry('Structure: SM2!n1!a5!n5!n12!c (see PDF)')
+    assert registry.countries() == ['SM']
+
+    with pytest.raises(RegistryFormatError):
+        parse_registry('nothing useful here')
+
+
+def test_cache_roundtrip(tmpdir):
+    path = str(tmpdir.join('iban.cache'))
+    parse_registry(SWIFT_TXT, 'Test release').save_cache(path)
+    registry = IBANRegistry.load_cache(path)
+    assert registry.release == 'Test release'
+    assert registry['IT'].bank_id == (5, 10)
+
+    iban.install_registry(path)
+    try:
+        iban.validate('IT37Z0760101600000028426203')
+        # Spain is not in the loaded registry
+        with pytest.raises(InvalidIBANError):
+            iban.validate('ES3821001579800200255488')
+    finally:
+        iban.install_registry(None)
+    iban.validate('ES3821001579800200255488')
+
+
+def test_cache_version(tmpdir):
+    path = tmpdir.join('iban.cache')
+    path.write('{"format": "sepacbi-iban-registry", "version": %d}'
+               % (CACHE_VERSION + 1))
+    with pytest.raises(RegistryCacheError):
+        IBANRegistry.load_cache(str(path))
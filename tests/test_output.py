@@ -0,0 +1,172 @@
+import gzip
+import hashlib
+import io
+import json
+import zipfile
+from copy import copy
+from datetime import datetime
+
+import pytest
+
+from sepacbi import Payment, output
+from sepacbi.output import GzipSink, ZipSink, DirectorySink, HashingSink, \
+    OutputError
+
+from .definitions import *
+
+debtor = copy(biz_with_cuc)
+debtor.sia_code = '0A123'
+
+
+def make_payment(req_id, **kwargs):
+    payment = Payment(debtor=debtor, account=acct_37, req_id=req_id,
+                      creation_time=datetime(2014, 3, 1, 10, 30), **kwargs)
+    payment.add_transaction(amount=1, account=acct_86, creditor=alpha,
+                            rmtinfo=u'Fattura n. 1 \xe8')
+    payment.add_transaction(amount=2, account=acct_86, creditor=pvt,
+                            rmtinfo='Fattura n. 2')
+    return payment
+
+
+@pytest.mark.parametrize('envelope', [False, True])
+def test_write_xml(envelope):
+    payment = make_payment('Streamed', envelope=envelope)
+    for kwargs in ({}, {'encoding': 'UTF-8', 'xml_declaration': True}):
+        out = io.BytesIO()
+        payment.write_xml(out, **kwargs)
+        assert out.getvalue() == payment.xml_text(**kwargs)
+
+
+def test_write_cbi():
+    payment = make_payment('Streamed')
+    out = io.BytesIO()
+    size = payment.write_cbi(out)
+    assert out.getvalue() == bytes(payment.cbi_bytes())
+    assert size == len(out.getvalue())
+
+
+def test_gzip_sink(tmpdir):
+    payment = make_payment('Gzipped')
+    path = str(tmpdir.join('payment.xml.gz'))
+    with GzipSink(path) as sink:
+        sink.write_payment(payment)
+        with pytest.raises(OutputError):
+            sink.write_payment(make_payment('Other'))
+    with gzip.open(path) as source:
+        assert source.read() == payment.xml_text()
+
+
+def test_zip_sink(tmpdir):
+    first = make_payment('First')
+    second = make_payment('Second')
+    path = str(tmpdir.join('payments.zip'))
+    with ZipSink(path) as sink:
+        sink.write_payment(first)
+        sink.write_payment(second, output_format='cbi')
+        with pytest.raises(OutputError):
+            sink.write_payment(first)
+    with zipfile.ZipFile(path) as archive:
+        assert archive.namelist() == ['First.xml', 'Second.txt']
+        assert archive.read('First.xml') == first.xml_text()
+        assert archive.read('Second.txt') == \
+            second.cbi_text().encode('ascii')
+
+
+def test_zip_sink_spooled(tmpdir, monkeypatch):
+    # Before Python 3.6, members are written to a temporary file first.
+    monkeypatch.setattr(output, 'ZIP_OPEN_WRITE', False)
+    monkeypatch.setattr(output, 'ZIP_COMPRESSLEVEL', False)
+    payment = make_payment('Spooled')
+    path = str(tmpdir.join('payments.zip'))
+    with pytest.raises(OutputError):
+        ZipSink(path, compresslevel=9)
+    with ZipSink(path) as sink:
+        sink.write_payment(payment)
+    with zipfile.ZipFile(path) as archive:
+        assert archive.namelist() == ['Spooled.xml']
+        assert archive.read('Spooled.xml') == payment.xml_text()
+
+
+def test_directory_sink(tmpdir):
+    payment = make_payment('Plain')
+    sink = DirectorySink(str(tmpdir))
+    assert sink.write_payment(payment, 'out.xml') == 'out.xml'
+    assert tmpdir.join('out.xml').read_binary() == payment.xml_text()
+
+
+def test_hashing_sink(tmpdir):
+    first = make_payment('Hashed')
+    second = make_payment('HashedCbi')
+    path = str(tmpdir.join('payments.zip'))
+    with HashingSink(ZipSink(path), signer=lambda data: b'signed') as sink:
+        sink.write_payment(first)
+        sink.write_payment(second, output_format='cbi',
+                           line_terminator=b'\r\n')
+    xml_manifest, cbi_manifest = sink.manifests
+    cbi_data = second.cbi_text().replace('\n', '\r\n').encode('ascii')
+    assert xml_manifest.digest == \
+        hashlib.sha256(first.xml_text()).hexdigest()
+    assert xml_manifest.size == len(first.xml_text())
+    assert xml_manifest.records == xml_manifest.transactions == 2
+    assert cbi_manifest.digest == hashlib.sha256(cbi_data).hexdigest()
+    assert cbi_manifest.records == second.cbi_record_count()
+    # Zip members are not files of their own.
+    assert cbi_manifest.file_digest is None
+
+    with zipfile.ZipFile(path) as archive:
+        assert archive.namelist() == [
+            'Hashed.xml', 'Hashed.xml.manifest.json',
+            'Hashed.xml.manifest.json.sig', 'HashedCbi.txt',
+            'HashedCbi.txt.manifest.json', 'HashedCbi.txt.manifest.json.sig']
+        manifest = json.loads(
+            archive.read('Hashed.xml.manifest.json').decode('utf-8'))
+    assert manifest['msg_id'] == 'Hashed'
+    assert manifest['control_sum'] == '3.00'
+    assert manifest['digest'] == xml_manifest.digest
+
+    # A gzip file holds a single member: the manifest goes elsewhere.
+    gz_path = str(tmpdir.join('payment.xml.gz'))
+    manifests = tmpdir.mkdir('manifests')
+    with HashingSink(GzipSink(gz_path),
+                     manifest_sink=DirectorySink(str(manifests))) as sink:
+        sink.write_payment(first)
+        with pytest.raises(OutputError):
+            sink.write_payment(second)
+    with gzip.open(gz_path) as source:
+        assert hashlib.sha256(source.read()).hexdigest() == \
+            sink.manifests[0].digest
+    # The file digest is that of the compressed file actually written.
+    with open(gz_path, 'rb') as source:
+        data = source.read()
+    assert sink.manifests[0].file_digest == hashlib.sha256(data).hexdigest()
+    assert sink.manifests[0].file_size == len(data)
+    assert manifests.join('Hashed.xml.manifest.json').check()
+
+
+def test_hashing_sink_gzip_manifest(tmpdir):
+    # By default, the manifest of a gzip file is written next to it.
+    payment = make_payment('Next')
+    gz_path = str(tmpdir.join('next.xml.gz'))
+    with HashingSink(GzipSink(gz_path)) as sink:
+        sink.write_payment(payment)
+    assert tmpdir.join('Next.xml.manifest.json').check()
+
+    # A gzip file object has no place for it.
+    with pytest.raises(OutputError):
+        HashingSink(GzipSink(io.BytesIO()))
+    with pytest.raises(OutputError):
+        HashingSink(ZipSink(io.BytesIO()),
+                    manifest_sink=GzipSink(io.BytesIO()))
+    HashingSink(GzipSink(io.BytesIO()), manifests=False).close()
+
+    # The payment is only issued once the signature has been written.
+    def failing_signer(data):
+        raise ValueError('No key')
+    issued = []
+    payment = make_payment('Unsigned')
+    payment.mark_issued = lambda: issued.append(True)
+    sink = HashingSink(DirectorySink(str(tmpdir.mkdir('signed'))),
+                       signer=failing_signer)
+    with pytest.raises(ValueError):
+        sink.write_payment(payment)
+    assert issued == []
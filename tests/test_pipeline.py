@@ -0,0 +1,97 @@
+import gzip
+import io
+from copy import copy
+from datetime import datetime
+
+import pytest
+
+from sepacbi import Payment
+from sepacbi.pipeline import (Pipeline, write_cbi_pipelined,
+                              write_xml_pipelined)
+
+from .definitions import *
+
+
+def make_payment(count, **kwargs):
+    payment = Payment(debtor=biz_with_cuc, account=acct_37, req_id='Pipeline',
+                      creation_time=datetime(2014, 3, 1, 10, 30), **kwargs)
+    for i in range(count):
+        payment.add_transaction(amount=i + 1, account=acct_86,
+                                creditor=alpha, rmtinfo='Row %d' % i)
+    return payment
+
+
+def test_xml_pipeline():
+    "The pipelined output is the same as write_xml()'s."
+    for kwargs in ({}, {'encoding': 'UTF-8', 'xml_declaration': True}):
+        expected = io.BytesIO()
+        make_payment(10).write_xml(expected, **kwargs)
+        out = io.BytesIO()
+        report = write_xml_pipelined(make_payment(10), out, batch_size=3,
+                                     queue_size=1, **kwargs)
+        assert out.getvalue() == expected.getvalue()
+        assert [stats.name for stats in report.stages] == \
+            ['build', 'serialize', 'write']
+        # Head, four batches; the serializer adds the tail.
+        assert report['build'].items == 5
+        assert report['write'].items == 6
+        assert report['write'].bytes == len(expected.getvalue())
+        assert report.bottleneck() in ('build', 'serialize', 'write')
+        assert 'bottleneck' in report.summary()
+
+
+def test_compressed_pipeline():
+    debtor = copy(biz_with_cuc)
+    debtor.sia_code = '0A123'
+    payment = make_payment(7)
+    payment.debtor = debtor
+    expected = io.BytesIO()
+    payment.write_cbi(expected)
+
+    out = io.BytesIO()
+    report = write_cbi_pipelined(payment, out, compresslevel=6, batch_size=2)
+    assert [stats.name for stats in report.stages] == \
+        ['build', 'serialize', 'compress', 'write']
+    assert report['serialize'].bytes == len(expected.getvalue())
+    assert gzip.GzipFile(fileobj=io.BytesIO(out.getvalue())).read() == \
+        expected.getvalue()
+
+    out = io.BytesIO()
+    write_xml_pipelined(make_payment(7), out, compresslevel=1)
+    assert gzip.GzipFile(fileobj=io.BytesIO(out.getvalue())).read() == \
+        make_payment(7).xml_text()
+
+
+def test_pipeline_errors():
+    "A failing stage stops the pipeline, and its exception is raised."
+    written = []
+
+    def fail(item):
+        if item == 3:
+            raise ValueError('Bad item')
+        return item
+
+    pipeline = Pipeline(queue_size=1)
+    pipeline.add_stage('check', fail)
+    pipeline.add_stage('write', written.append)
+    with pytest.raises(ValueError):
+        pipeline.run(iter(range(1000)))
+    assert written == [0, 1, 2]
+
+    def source():
+        yield 1
+        raise KeyError('Broken source')
+
+    pipeline = Pipeline()
+    pipeline.add_stage('write', written.append)
+    with pytest.raises(KeyError):
+        pipeline.run(source())
+
+
+def test_stored_payment_pipeline():
+    "The build stage reads a disk-backed store on its own thread."
+    payment = make_payment(9, storage=True, memory_budget=4)
+    out = io.BytesIO()
+    write_xml_pipelined(payment, out, batch_size=2)
+    assert out.getvalue() == make_payment(9).xml_text()
+    payment.transactions.close()
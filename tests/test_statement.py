@@ -0,0 +1,139 @@
+import io
+from datetime import date, datetime
+from decimal import Decimal
+
+from sepacbi import Payment
+from sepacbi.cbirh_dom import OpeningBalance, Movement, MovementInfo
+from sepacbi.status import issued_transactions
+from sepacbi.statement import parse_cbi_rh, parse_camt053, \
+    match_statement
+
+from .definitions import *
+
+CAMT = b'''<?xml version="1.0" encoding="UTF-8"?>
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02">
+ <BkToCstmrStmt><Stmt>
+  <Acct><Id><IBAN>IT37Z0760101600000028426203</IBAN></Id></Acct>
+  <Ntry>
+   <Amt Ccy="EUR">10.00</Amt><CdtDbtInd>DBIT</CdtDbtInd>
+   <BookgDt><Dt>2014-03-03</Dt></BookgDt><ValDt><Dt>2014-03-03</Dt></ValDt>
+   <NtryDtls><TxDtls>
+    <Refs><EndToEndId>Stmt-000001</EndToEndId></Refs>
+    <RltdPties><CdtrAcct><Id><IBAN>IT86U0760111500000010117463</IBAN></Id>
+    </CdtrAcct></RltdPties>
+   </TxDtls></NtryDtls>
+  </Ntry>
+  <Ntry>
+   <Amt Ccy="EUR">19.50</Amt><CdtDbtInd>DBIT</CdtDbtInd>
+   <BookgDt><Dt>2014-03-04</Dt></BookgDt>
+   <NtryDtls><TxDtls>
+    <Refs><EndToEndId>NOTPROVIDED</EndToEndId></Refs>
+    <RltdPties><CdtrAcct><Id><IBAN>IT86U0760111500000010117463</IBAN></Id>
+    </CdtrAcct></RltdPties>
+   </TxDtls></NtryDtls>
+  </Ntry>
+  <Ntry>
+   <Amt Ccy="EUR">5.00</Amt><CdtDbtInd>CRDT</CdtDbtInd>
+   <BookgDt><Dt>2014-03-04</Dt></BookgDt>
+  </Ntry>
+  <Ntry>
+   <Amt Ccy="EUR">99.00</Amt><CdtDbtInd>DBIT</CdtDbtInd>
+   <BookgDt><Dt>2014-03-04</Dt></BookgDt>
+  </Ntry>
+ </Stmt></BkToCstmrStmt>
+</Document>
+'''
+
+
+def make_issued():
+    payment = Payment(debtor=biz_with_cuc, account=acct_37, req_id='Stmt',
+                      creation_time=datetime(2014, 3, 1))
+    for amount in (10, 20, 30):
+        payment.add_transaction(amount=amount, account=acct_86,
+                                creditor=alpha, rmtinfo='Test')
+    return issued_transactions(payment)
+
+
+def test_camt053():
+    entries = list(parse_camt053(io.BytesIO(CAMT)))
+    assert len(entries) == 4
+    assert entries[0].account == acct_37
+    assert entries[0].eeid == 'Stmt-000001'
+    assert entries[1].eeid is None
+    assert entries[1].booking_date == date(2014, 3, 4)
+
+    result = match_statement(entries, make_issued(),
+                             tolerance=Decimal('0.50'), days=10)
+    assert [(issued.seq, strategy) for issued, _, strategy in
+            result.matched] == [(1, 'eeid'), (2, 'tolerant')]
+    assert [entry.amount for entry in result.unmatched_entries] == \
+        [Decimal('99.00')]
+    assert [issued.seq for issued in result.unmatched_issued] == [3]
+    assert result.ignored == 1
+
+
+def rh_line(cls, **values):
+    record = cls()
+    for name, value in values.items():
+        setattr(record, name, value)
+    return record.format() + '\n'
+
+
+def test_cbi_rh():
+    text = rh_line(OpeningBalance, abi=7601, cab=1600,
+                   account='000028426203')
+    text += rh_line(Movement, prog_number=1, movement_number=1,
+                    accounting_date=date(2014, 3, 3), sign='D',
+                    amount=Decimal('30.00'), description='Bonifico')
+    text += rh_line(MovementInfo, prog_number=1, movement_number=1,
+                    description='EEID Stmt-000003 ALPHA SRL')
+    text += rh_line(Movement, prog_number=1, movement_number=2,
+                    accounting_date=date(2014, 3, 3), sign='D',
+                    amount=Decimal('30.00'), description='Stmt')
+    entries = list(parse_cbi_rh(io.StringIO(text)))
+    assert entries[0].account == '0760101600000028426203'
+    assert entries[0].amount == Decimal('30.00')
+    assert entries[0].text == 'Bonifico EEID Stmt-000003 ALPHA SRL'
+
+    result = match_statement(entries, make_issued())
+    assert [(issued.seq, strategy) for issued, _, strategy in
+            result.matched] == [(3, 'eeid'), (1, 'request'), (2, 'request')]
+    assert result.unmatched_issued == []
+
+
+def test_common_amounts():
+    "Many issued transactions with the same amount are matched oldest first."
+    from sepacbi.status import IssuedTransaction
+    from sepacbi.statement import StatementEntry
+    issued = [IssuedTransaction('Req-%d' % (i % 7), 'E%d' % i, i,
+                                Decimal('100.00'), None, 'Alpha',
+                                '2014-03-%02dT10:00:00' % (28 - i // 100))
+              for i in range(2000)]
+    entries = [StatementEntry(None, date(2014, 3, 30), None, True,
+                              Decimal('100.00'), None, None, None, None,
+                              None) for _ in range(1999)]
+    result = match_statement(entries, issued)
+    assert len(result.matched) == 1999
+    assert set(strategy for _, _, strategy in result.matched) == \
+        set(['tolerant'])
+    # The most recent one is left.
+    assert [item.seq for item in result.unmatched_issued] == [99]
+    assert result.matched[0][0].created == '2014-03-09T10:00:00'
+
+
+def test_exact_keys_first():
+    "An IBAN and amount match wins over a request named in the text."
+    from sepacbi.status import IssuedTransaction
+    from sepacbi.statement import StatementEntry
+    issued = [IssuedTransaction('Req-1', 'Req-1-%06d' % seq, seq,
+                                Decimal(amount), acct_86, 'Alpha',
+                                '2014-03-01T10:00:00')
+              for seq, amount in ((1, '10.00'), (2, '20.00'))] + [
+        IssuedTransaction('Req-2', 'Req-2-000001', 1, Decimal('30.00'),
+                          acct_37, 'Beta', '2014-03-01T10:00:00')]
+    entry = StatementEntry(None, date(2014, 3, 3), None, True,
+                           Decimal('30.00'), None, None, None, acct_37,
+                           'Payment Req-1')
+    result = match_statement([entry], issued)
+    assert [(item.eeid, strategy) for item, _, strategy in
+            result.matched] == [('Req-2-000001', 'amount_iban')]
@@ -0,0 +1,82 @@
+import io
+from decimal import Decimal
+
+import pytest
+
+from sepacbi import Payment
+from sepacbi.status import IssuedIndex, parse_status_report, reconcile
+
+from .definitions import *
+
+REPORT = b'''<?xml version="1.0" encoding="UTF-8"?>
+<CBIPaymentStatusReport xmlns="urn:CBI:xsd:CBIPaymentStatusReport.00.03.08">
+  <GrpHdr><MsgId>ESITO-1</MsgId></GrpHdr>
+  <OrgnlGrpInfAndSts>
+    <OrgnlMsgId>Req-1</OrgnlMsgId>
+    <OrgnlMsgNmId>CBIPaymentRequest.00.04.00</OrgnlMsgNmId>
+  </OrgnlGrpInfAndSts>
+  <OrgnlPmtInfAndSts>
+    <OrgnlPmtInfId>Req-1</OrgnlPmtInfId>
+    <TxInfAndSts>
+      <OrgnlInstrId>1</OrgnlInstrId>
+      <OrgnlEndToEndId>Req-1-000001</OrgnlEndToEndId>
+      <TxSts>ACCP</TxSts>
+      <OrgnlTxRef><Amt><InstdAmt Ccy="EUR">10.00</InstdAmt></Amt></OrgnlTxRef>
+    </TxInfAndSts>
+    <TxInfAndSts>
+      <OrgnlInstrId>2</OrgnlInstrId>
+      <OrgnlEndToEndId>Req-1-000002</OrgnlEndToEndId>
+      <TxSts>RJCT</TxSts>
+      <StsRsnInf><Rsn><Cd>AC01</Cd></Rsn></StsRsnInf>
+    </TxInfAndSts>
+    <TxInfAndSts>
+      <OrgnlEndToEndId>Unknown</OrgnlEndToEndId>
+      <TxSts>ACCP</TxSts>
+    </TxInfAndSts>
+  </OrgnlPmtInfAndSts>
+</CBIPaymentStatusReport>
+'''
+
+
+def test_parse_status_report():
+    statuses = list(parse_status_report(io.BytesIO(REPORT)))
+    assert [(status.msg_id, status.eeid, status.status, status.reason)
+            for status in statuses] == [
+                ('Req-1', 'Req-1-000001', 'ACCP', None),
+                ('Req-1', 'Req-1-000002', 'RJCT', 'AC01'),
+                ('Req-1', 'Unknown', 'ACCP', None)]
+    assert statuses[0].amount == Decimal('10.00')
+
+
+def test_reconcile(tmpdir):
+    index = IssuedIndex(str(tmpdir.join('issued.db')))
+    payment = Payment(debtor=biz_with_cuc, account=acct_37, req_id='Req-1',
+                      issued_index=index)
+    for amount in (10, 20, 30):
+        payment.add_transaction(amount=amount, account=acct_86,
+                                creditor=alpha, rmtinfo='Test')
+    # Previews are not recorded; writing the same request twice records
+    # it once.
+    payment.xml_text()
+    assert len(index) == 0
+
+    class FailingFile(object):
+        def write(self, data):
+            raise IOError('Disk full')
+    with pytest.raises(IOError):
+        payment.write_xml(FailingFile())
+    assert len(index) == 0
+    payment.write_xml(io.BytesIO())
+    payment.write_xml(io.BytesIO())
+    assert len(index) == 3
+    assert index.get('Req-1', 'Req-1-000002').amount == Decimal('20.00')
+    assert [issued.msg_id for issued in index.find_eeid('Req-1-000003')] == \
+        ['Req-1']
+
+    result = reconcile(parse_status_report(io.BytesIO(REPORT)), index)
+    assert [issued.seq for issued, _ in result.matched] == [1, 2]
+    assert [issued.eeid for issued, _ in result.rejected] == ['Req-1-000002']
+    assert [status.eeid for status in result.unknown] == ['Unknown']
+    assert [issued.seq for issued in result.pending] == [3]
+    assert result.summary() == '2 matched (1 rejected), 1 unknown, 1 pending'
+    index.close()
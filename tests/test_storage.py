@@ -0,0 +1,118 @@
+import gc
+import io
+import os
+from copy import copy
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from sepacbi import IdHolder, Payment
+from sepacbi.payment import InvalidEndToEndIDError
+from sepacbi.storage import StoreNotEmptyError, TransactionStore
+
+from .definitions import *
+
+debtor = copy(biz_with_cuc)
+debtor.sia_code = '0A123'
+
+
+def build(**kwargs):
+    payment = Payment(debtor=debtor, account=acct_37, req_id='Stored',
+                      creation_time=datetime(2014, 3, 1, 10, 30), **kwargs)
+    for i in range(25):
+        creditor = IdHolder(name='Creditor %d' % i,
+                            address=['Via Roma %d' % i, '00100 Roma'])
+        payment.add_transaction(amount='%d.10' % i, account=acct_86,
+                                creditor=creditor, rmtinfo='Row %d' % i)
+    return payment
+
+
+def test_disk_backed_payment(tmpdir):
+    in_memory = build()
+    stored = build(storage=str(tmpdir.join('store.sqlite')), memory_budget=7)
+    store = stored.transactions
+    assert isinstance(store, TransactionStore)
+    assert len(store) == 25
+    assert len(store.buffer) == 4
+    assert store[2].rmtinfo == 'Row 2'
+    assert store[-1].rmtinfo == 'Row 24'
+    assert store[2].payment is stored
+    assert stored.amount_sum() == in_memory.amount_sum() == Decimal('302.50')
+
+    assert stored.xml_text() == in_memory.xml_text()
+    assert stored.cbi_text() == in_memory.cbi_text()
+    output = io.BytesIO()
+    stored.write_xml(output)
+    assert output.getvalue() == in_memory.xml_text()
+    assert stored.content_hash() == in_memory.content_hash()
+
+    assert 'Stored-000003' in stored.eeid_set
+    with pytest.raises(InvalidEndToEndIDError):
+        stored.add_transaction(amount=1, account=acct_86, creditor=alpha,
+                               rmtinfo='Again', eeid='Stored-000003')
+    store.close()
+
+
+def test_temporary_store():
+    payment = build(storage=True)
+    path = payment.transactions.path
+    assert [txr.payment_seq for txr in payment.transactions] == \
+        list(range(1, 26))
+    payment.transactions.close()
+    assert not os.path.exists(path)
+
+    # The file is also removed once an unclosed store is collected.
+    payment = build(storage=True)
+    path = payment.transactions.path
+    assert os.path.exists(path)
+    del payment
+    gc.collect()
+    assert not os.path.exists(path)
+
+    with TransactionStore() as store:
+        path = store.path
+    assert not os.path.exists(path)
+
+
+def test_cbi_single_pass(monkeypatch):
+    "The CBI output reads each stored transaction back only once."
+    from sepacbi.pipeline import write_cbi_pipelined
+    expected = build().cbi_text().encode('ascii')
+    stored = build(storage=True, memory_budget=7)
+    loads = []
+    load = TransactionStore.load
+
+    def counting_load(self, data):
+        loads.append(1)
+        return load(self, data)
+    monkeypatch.setattr(TransactionStore, 'load', counting_load)
+
+    output = io.BytesIO()
+    stored.write_cbi(output)
+    assert output.getvalue() == expected
+    assert len(loads) == 25
+    output = io.BytesIO()
+    write_cbi_pipelined(stored, output, batch_size=4)
+    assert output.getvalue() == expected
+    assert len(loads) == 50
+    assert stored.cbi_bytes() == expected
+    stored.transactions.close()
+
+
+def test_existing_store(tmpdir):
+    "An existing store is never wiped."
+    path = str(tmpdir.join('store.sqlite'))
+    payment = build(storage=path)
+    payment.transactions.flush()
+    payment.transactions.close()
+    with pytest.raises(StoreNotEmptyError):
+        TransactionStore(path)
+    with pytest.raises(StoreNotEmptyError):
+        build(storage=path)
+    # An empty database can be used.
+    empty = str(tmpdir.join('empty.sqlite'))
+    TransactionStore(empty).close()
+    store = TransactionStore(empty)
+    assert len(store) == 0
+    store.close()
@@ -0,0 +1,122 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from sepacbi import IdHolder, Payment, Invoice
+from sepacbi.util import ValidationError
+from sepacbi.validation import validate_transactions
+
+from .definitions import *
+
+
+def test_validate_all():
+    payment = Payment(debtor=biz_with_cuc, account=acct_37)
+    payment.add_transaction(amount=1, account=acct_86, creditor=alpha,
+                            rmtinfo='Ok')
+    payment.add_transaction(amount=2, account='IT00INVALIDIBAN',
+                            creditor=alpha, rmtinfo='Bad IBAN')
+    payment.add_transaction(amount=3, account=acct_86, creditor=beta,
+                            rmtinfo='Ok')
+    payment.add_transaction(amount=4, account=acct_86,
+                            creditor=IdHolder(name='Bad', cf='X', code='Y'),
+                            rmtinfo='Bad creditor')
+    report = payment.validate_all(jobs=2)
+    assert not report.ok
+    assert report.checked == 4
+    assert report.rows() == [2, 4]
+    assert [issue.error for issue in report] == \
+        ['InvalidIBANError', 'ValidationError']
+    assert 'row 4, creditor' in report.summary()
+
+
+def test_validate_transactions():
+    payment = Payment(debtor=biz_with_cuc, account=acct_37)
+    rows = [
+        {'amount': 1, 'account': acct_86, 'creditor': beta, 'rmtinfo': 'A',
+         'eeid': 'E1'},
+        {'amount': 1, 'account': foreign_acct, 'creditor': beta,
+         'rmtinfo': 'No BIC'},
+        {'amount': 1, 'account': acct_86, 'creditor': beta, 'eeid': 'E1',
+         'rmtinfo': 'Duplicate'},
+        {'amount': 1, 'account': acct_86, 'creditor': beta},
+        {'amount': 1, 'account': acct_86, 'creditor': beta,
+         'docs': [Invoice(n) for n in range(1, 20)]},
+    ]
+    report = validate_transactions(payment, rows, jobs=2, chunk_size=2)
+    assert report.rows() == [2, 3, 4, 5]
+    errors = dict((issue.row, issue.error) for issue in report)
+    assert errors[2] == 'MissingBICError'
+    assert errors[3] == 'InvalidEndToEndIDError'
+    assert errors[4] == 'ValidationError'
+    assert errors[5] == 'RemittanceInfoError'
+    # Nothing was added to the payment
+    assert len(payment.transactions) == 0
+
+
+def test_checks_survive_optimization():
+    "Checks raise ValidationError, which is still an AssertionError."
+    payment = Payment(debtor=biz_with_cuc, account=acct_37)
+    with pytest.raises(ValidationError):
+        payment.add_transaction(amount=1, account=acct_86, creditor=beta)
+    assert issubclass(ValidationError, AssertionError)
+
+    # The same check, with the assert statements stripped by -O: the
+    # `assert False` line would fail otherwise.
+    script = '\n'.join([
+        'from sepacbi import Payment',
+        'from sepacbi.util import ValidationError',
+        'from tests.definitions import acct_37, acct_86, beta, biz_with_cuc',
+        'assert False',
+        'payment = Payment(debtor=biz_with_cuc, account=acct_37)',
+        'try:',
+        '    payment.add_transaction(amount=1, account=acct_86, creditor=beta)',
+        'except ValidationError:',
+        '    print("raised")',
+    ])
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, '-O', '-c', script],
+                               cwd=root, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    assert process.returncode == 0
+    assert output.strip() == b'raised'
+
+
+def test_tax_codes():
+    from sepacbi.taxcode import InvalidTaxCodeError, check_tax_code, \
+        invalid_tax_codes
+    assert check_tax_code('RSSMRA85T10A562S') is None
+    assert check_tax_code('rssmra85t10a562s') is None
+    assert check_tax_code('00743110157') is None
+    assert check_tax_code('IT00743110157') is None
+    assert 'check character' in check_tax_code('RSSMRA85T10A562X')
+    assert 'check digit' in check_tax_code('00743110158')
+    assert 'length' in check_tax_code('123')
+    assert invalid_tax_codes(['00743110157', None, '123', '123']) == [
+        (2, '123', "Invalid tax code length: '123'"),
+        (3, '123', "Invalid tax code length: '123'")]
+
+    valid = IdHolder(name='Valid', cf='00743110157')
+    invalid = IdHolder(name='Invalid', cf='00743110158')
+    foreign = IdHolder(name='Foreign', cf='ESQ0123124', country='ES')
+
+    # Without check_tax_codes, only the length is checked
+    payment = Payment(debtor=biz_with_cuc, account=acct_37)
+    payment.add_transaction(amount=1, account=acct_86, creditor=invalid,
+                            rmtinfo='Unchecked')
+
+    payment = Payment(debtor=biz_with_cuc, account=acct_37,
+                      check_tax_codes=True)
+    for creditor in (valid, foreign):
+        payment.add_transaction(amount=1, account=acct_86,
+                                creditor=creditor, rmtinfo='Checked')
+    with pytest.raises(InvalidTaxCodeError):
+        payment.add_transaction(amount=1, account=acct_86,
+                                creditor=invalid, rmtinfo='Checked')
+
+    rows = [{'amount': 1, 'account': acct_86, 'creditor': creditor,
+             'rmtinfo': 'Row'} for creditor in (valid, invalid, foreign)]
+    report = validate_transactions(payment, rows)
+    assert report.rows() == [2]
+    assert [issue.error for issue in report] == ['InvalidTaxCodeError']